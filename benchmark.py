@@ -0,0 +1,184 @@
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+from utils import pointcloud2dem, extract_ground_points, read_dem, interpolate_nodata, estimate_volume, peak_rss_mb
+from synthetic import make_basin_las, make_basin_dem
+
+DEFAULT_OUTPUT = 'benchmarks.jsonl'
+
+# Survey extents (width, height) in meters of each size of a sweep
+SIZES = {
+    'small': (100.0, 75.0),
+    'medium': (200.0, 150.0),
+    'large': (400.0, 300.0),
+    'xlarge': (800.0, 600.0)
+}
+
+def _stage_pointcloud2dem(workdir, las_path, dem_path):
+    pointcloud2dem(las_path, os.path.join(workdir, 'out_dem.tif'), resolution=0.5, classification_filter=[2], reducer='mean')
+
+def _stage_pointcloud2dem_griddata(workdir, las_path, dem_path):
+    pointcloud2dem(las_path, os.path.join(workdir, 'out_dem.tif'), resolution=0.5, classification_filter=[2])
+
+def _stage_extract_ground_points(workdir, las_path, dem_path):
+    extract_ground_points(las_path, os.path.join(workdir, 'ground.las'))
+
+def _stage_interpolate_nodata(workdir, las_path, dem_path):
+    dem_data, _, _, nodata_value, _ = read_dem(dem_path)
+    interpolate_nodata(dem_data, nodata_value)
+
+def _stage_estimate_volume(workdir, las_path, dem_path):
+    # the dam crest of synthetic.basin_surface is at 100
+    estimate_volume(dem_path, 100.0)
+
+# Stage name -> (function, input it scales with)
+STAGES = {
+    'pointcloud2dem': (_stage_pointcloud2dem, 'points'),
+    'pointcloud2dem_griddata': (_stage_pointcloud2dem_griddata, 'points'),
+    'extract_ground_points': (_stage_extract_ground_points, 'points'),
+    'interpolate_nodata': (_stage_interpolate_nodata, 'cells'),
+    'estimate_volume': (_stage_estimate_volume, 'cells')
+}
+
+# Libraries utils imports lazily, imported before a stage is timed
+STAGE_IMPORTS = ('rasterio', 'rasterio.transform', 'laspy', 'cv2', 'scipy.interpolate', 'scipy.ndimage', 'scipy.sparse.csgraph')
+
+def _run_stage(stage, workdir, las_path, dem_path, queue):
+    # Runs in a fresh process, so the peak RSS is that of the imports and the stage alone
+    for name in STAGE_IMPORTS:
+        importlib.import_module(name)
+    baseline = peak_rss_mb()
+    start_time = time.perf_counter()
+    STAGES[stage][0](workdir, las_path, dem_path)
+    wall_time = time.perf_counter() - start_time
+    queue.put((wall_time, peak_rss_mb(), baseline))
+
+def measure(stage, workdir, las_path, dem_path):
+    """
+    Run one stage in a spawned process.
+
+    Returns
+    -------
+    wall_time : float
+        Seconds spent in the stage, imports excluded.
+    peak_rss : float or None
+        Peak resident set size of the process in MB.
+    baseline_rss : float or None
+        Resident set size after the imports, before the stage ran.
+    """
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run_stage, args=(stage, workdir, las_path, dem_path, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"Stage {stage} failed with exit code {process.exitcode}")
+    return queue.get()
+
+def git_commit():
+    """Short hash of the checked out commit, or None outside a git repository."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(stages=None, sizes=('small', 'medium', 'large'), density=10.0, hole_fraction=0.02,
+                   vegetation_fraction=0.3, repeat=1, output_path=DEFAULT_OUTPUT, seed=0):
+    """
+    Time every stage over a sweep of synthetic survey sizes and append one JSON
+    line per measurement to output_path.
+
+    Parameters
+    ----------
+    stages : list of str, optional
+        Keys of STAGES. Default is every stage.
+    sizes : tuple of str, optional
+        Keys of SIZES. Default is ('small', 'medium', 'large').
+    density, hole_fraction, vegetation_fraction : float, optional
+        Passed to synthetic.make_basin_las.
+    repeat : int, optional
+        Measurements per stage and size. Default is 1.
+    output_path : str, optional
+        JSON lines file the results are appended to. Default is benchmarks.jsonl.
+    seed : int, optional
+        Seed of the synthetic surveys.
+
+    Returns
+    -------
+    records : list of dict
+        The records appended.
+    """
+    stages = list(STAGES) if stages is None else stages
+    run = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count()
+    }
+    records = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in sizes:
+            width, height = SIZES[size]
+            las_path = os.path.join(workdir, f'{size}.las')
+            dem_path = os.path.join(workdir, f'{size}.tif')
+            n_points = make_basin_las(las_path, width, height, density, hole_fraction, vegetation_fraction, seed=seed)
+            n_cells = make_basin_dem(dem_path, width, height, hole_fraction=hole_fraction, seed=seed)
+            for stage in stages:
+                unit = STAGES[stage][1]
+                n_items = n_points if unit == 'points' else n_cells
+                for _ in range(repeat):
+                    wall_time, peak_rss, baseline_rss = measure(stage, workdir, las_path, dem_path)
+                    record = dict(run)
+                    record.update({
+                        'stage': stage,
+                        'size': size,
+                        'width': width,
+                        'height': height,
+                        'density': density,
+                        'hole_fraction': hole_fraction,
+                        'vegetation_fraction': vegetation_fraction,
+                        unit: n_items,
+                        'wall_time': wall_time,
+                        'peak_rss_mb': peak_rss,
+                        'stage_rss_mb': None if peak_rss is None else peak_rss - baseline_rss,
+                        f'{unit}_per_s': n_items / max(wall_time, 1e-9)
+                    })
+                    records.append(record)
+                    rss_text = f"{peak_rss:.0f} MB" if peak_rss is not None else "n/a"
+                    print(f"{stage:<25} {size:<7} {n_items:>10} {unit:<6} {wall_time:8.3f} s "
+                          f"{n_items / max(wall_time, 1e-9):>14,.0f} {unit}/s  peak RSS {rss_text}")
+
+    with open(output_path, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    return records
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic surveys.")
+    parser.add_argument('--stage', action='append', choices=sorted(STAGES), default=None, help="stage to run (repeatable), default all")
+    parser.add_argument('--size', action='append', choices=list(SIZES), default=None, help="survey size to run (repeatable), default small, medium and large")
+    parser.add_argument('--density', type=float, default=10.0, help="points per square meter")
+    parser.add_argument('--hole-fraction', type=float, default=0.02, help="fraction of the extent without data")
+    parser.add_argument('--vegetation-fraction', type=float, default=0.3, help="fraction of non-ground points")
+    parser.add_argument('--repeat', type=int, default=1, help="measurements per stage and size")
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help="JSON lines file the results are appended to")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the synthetic surveys")
+    args = parser.parse_args()
+    run_benchmarks(
+        args.stage, tuple(args.size or ('small', 'medium', 'large')), args.density, args.hole_fraction,
+        args.vegetation_fraction, args.repeat, args.output, args.seed
+    )
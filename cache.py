@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import time
+
+DEFAULT_CACHE_DIR = '.capacity_cache'
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+
+def file_hash(path, memo_dir=None):
+    """
+    SHA-256 of a file's content.
+
+    Parameters
+    ----------
+    path : str
+        The file to hash.
+    memo_dir : str, optional
+        Directory where hashes are memoized by (path, size, mtime), so an
+        unchanged multi-GB LAS is only hashed once.
+
+    Returns
+    -------
+    digest : str
+        Hex digest of the file content.
+    """
+    stat = os.stat(path)
+    memo_path = None
+    if memo_dir is not None:
+        memo_path = _memo_path(memo_dir, path)
+        if os.path.exists(memo_path):
+            with open(memo_path, 'r') as f:
+                memo = json.load(f)
+            if memo['size'] == stat.st_size and memo['mtime_ns'] == stat.st_mtime_ns:
+                return memo['hash']
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+
+    if memo_path is not None:
+        _atomic_write_text(memo_path, json.dumps(
+            {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': digest}
+        ))
+    return digest
+
+def _memo_path(memo_dir, path):
+    path_key = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()
+    return os.path.join(memo_dir, path_key + '.json')
+
+def cache_key(*parts):
+    """Key of a cache entry from its input hashes and processing parameters."""
+    text = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def _atomic_write_text(path, text):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+class ContentCache:
+    """
+    On-disk cache of intermediate products keyed by cache_key.
+
+    Every entry is one file, <key><suffix>, written atomically so worker
+    processes can share the cache. The file's access time is refreshed on every
+    hit, and the least recently used entries are evicted once the cache grows
+    beyond max_bytes; their memoized hashes go with them, and the memoized
+    hashes of files that no longer exist are pruned when the cache is opened.
+    The hashes of the rasters the pipeline writes, and of those it found
+    without a LAS to grid them from, are also recorded, to tell rasters
+    produced by the pipeline from rasters supplied by hand.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entry_dir = os.path.join(cache_dir, 'entries')
+        self.memo_dir = os.path.join(cache_dir, 'hashes')
+        self.produced_dir = os.path.join(cache_dir, 'produced')
+        self.supplied_dir = os.path.join(cache_dir, 'supplied')
+        for directory in (self.entry_dir, self.memo_dir, self.produced_dir, self.supplied_dir):
+            os.makedirs(directory, exist_ok=True)
+        self.evict()
+        self.evict_hashes()
+
+    def hash(self, path):
+        """Memoized content hash of an input file."""
+        return file_hash(path, memo_dir=self.memo_dir)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.entry_dir, key + suffix)
+
+    def _touch(self, entry_path):
+        # only the access time moves, so the memoized hash of the entry stays valid
+        os.utime(entry_path, ns=(time.time_ns(), os.stat(entry_path).st_mtime_ns))
+
+    def get_file(self, key, suffix, dst_path):
+        """Copy a cached file to dst_path. Returns False on a miss."""
+        entry_path = self._path(key, suffix)
+        try:
+            self._touch(entry_path)
+            shutil.copyfile(entry_path, dst_path)
+        except FileNotFoundError:
+            # missing, or evicted by another worker meanwhile
+            return False
+        return True
+
+    def put_file(self, key, suffix, src_path):
+        """Store a copy of src_path under key."""
+        entry_path = self._path(key, suffix)
+        tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+        shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, entry_path)
+        self.evict()
+
+    def entry_hash(self, key, suffix):
+        """Content hash of a cached file, or None on a miss. A hit counts as a use of the entry."""
+        entry_path = self._path(key, suffix)
+        try:
+            self._touch(entry_path)
+            return self.hash(entry_path)
+        except FileNotFoundError:
+            return None
+
+    def mark_produced(self, path):
+        """Record that the current content of path was written by the pipeline."""
+        marker = os.path.join(self.produced_dir, self.hash(path))
+        open(marker, 'a').close()
+
+    def is_produced(self, path):
+        """Whether the content of path was written by the pipeline."""
+        return os.path.exists(os.path.join(self.produced_dir, self.hash(path)))
+
+    def mark_supplied(self, path):
+        """Record that the current content of path was supplied by hand, i.e., found without a LAS to grid it from."""
+        if not self.is_produced(path):
+            marker = os.path.join(self.supplied_dir, self.hash(path))
+            open(marker, 'a').close()
+
+    def is_supplied(self, path):
+        """Whether the content of path is known to be supplied by hand; unknown rasters are neither produced nor supplied."""
+        return os.path.exists(os.path.join(self.supplied_dir, self.hash(path)))
+
+    def get_object(self, key):
+        """Load a cached Python object, or None on a miss."""
+        entry_path = self._path(key, '.pkl')
+        try:
+            self._touch(entry_path)
+            with open(entry_path, 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put_object(self, key, obj):
+        """Store a picklable Python object (e.g., a filled raster) under key."""
+        entry_path = self._path(key, '.pkl')
+        tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, entry_path)
+        self.evict()
+
+    def _entry_stats(self):
+        """(atime, size, path) of every entry, stat'ed once; entries removed meanwhile by another worker are skipped."""
+        stats = []
+        for entry in os.scandir(self.entry_dir):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            stats.append((stat.st_atime, stat.st_size, entry.path))
+        return stats
+
+    def size(self):
+        """Total size of the cached entries in bytes."""
+        return sum(size for _, size, _ in self._entry_stats())
+
+    def evict(self):
+        """Remove least recently used entries, and their memoized hashes, until the cache fits in max_bytes."""
+        stats = self._entry_stats()
+        total = sum(size for _, size, _ in stats)
+        if total <= self.max_bytes:
+            return
+        stats.sort()
+        for _, size, entry_path in stats:
+            if total <= self.max_bytes:
+                break
+            # an entry another worker removed meanwhile is gone all the same
+            for path in (entry_path, _memo_path(self.memo_dir, entry_path)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+    def evict_hashes(self):
+        """Remove the memoized hashes of files that no longer exist, e.g., replaced LAS files or evicted entries."""
+        for entry in os.scandir(self.memo_dir):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                with open(entry.path, 'r') as f:
+                    path = json.load(f).get('path')
+            except (FileNotFoundError, ValueError):
+                continue
+            # memos written before the path was recorded are dropped too, and rewritten on the next hash
+            if path is None or not os.path.exists(path):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        """Remove every cached entry and memoized hash."""
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        for directory in (self.entry_dir, self.memo_dir, self.produced_dir, self.supplied_dir):
+            os.makedirs(directory, exist_ok=True)
@@ -1,160 +1,584 @@
 from utils import *
+from cache import ContentCache, cache_key, file_hash, DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES
+from instrumentation import RunReport, span
+from results_store import ResultsStore
+import ground_filter
 
-import csv
+import argparse
+import cProfile
 import os
+import time
+from contextlib import nullcontext
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from natsort import natsorted 
 
-def check_capacity_csv():
-    capaticy_csv = 'data/capacity.csv'
-    if not os.path.exists(capaticy_csv):
-        # Create a new capacity.csv file
-        with open(capaticy_csv, 'w') as f:
-            f.write('Name, Date, Upper_spillway_capacity, Lower_spillway_capacity, Upper_crest_capacity, Lower_crest_capacity\n')
+def check_capacity_csv(store=None):
+    """
+    Capacities of the processed folders, {name: {'Date', <capacities>}}, from
+    the results store. On first use, the store imports data/capacity.csv.
+    """
+    if store is not None:
+        return store.capacities()
+    with ResultsStore() as store:
+        return store.capacities()
+
+# gridding parameters of the ground DEM and the all-points DSM
+GRID_RESOLUTION = 0.5
+GRID_METHOD = 'linear'
+GRID_PRODUCTS = {'dem.tif': [2], 'dsm.tif': None}
+# how the pool is delineated when there is no outlet (see utils.capacity_curve):
+# 'contour' traces it per elevation as estimate_volume does; 'cumulative', one
+# pass that counts cells above the water inside the pool as dry, is opt-in and
+# gives larger DSM capacities, so changing it reprocesses every folder
+VOLUME_METHOD = 'contour'
+# optional basin footprint polygon of a survey folder, and the buffer kept around it
+FOOTPRINT_FILE = 'footprint.csv'
+FOOTPRINT_BUFFER = 10.0
+
+def outdated_folders(store):
+    """
+    Processed folders whose row records another volume method than the
+    current VOLUME_METHOD, so that they are processed again. Rows from before
+    the method was recorded count as contoured, or flooded with an outlet, as
+    they were computed; rows without provenance, imported from capacity.csv,
+    are kept as they are.
+    """
+    return set(name for name in store.capacities() if _outdated(store.provenance(name)))
+
+def _outdated(provenance):
+    if provenance is None or not provenance['parameters']:
+        return False
+    parameters = provenance['parameters']
+    flooded = parameters.get('outlet_xy') is not None
+    # rows from before the method was recorded were flooded or contoured per elevation
+    recorded = parameters.get('volume_method', 'flood' if flooded else 'contour')
+    return recorded != ('flood' if flooded else VOLUME_METHOD)
+
+def grid_folder(las_file, folder_path, cache=None, output_profile=None, footprint=None):
+    """
+    Grid dem.tif and dsm.tif of a survey folder from its LAS file,
+    in the given output profile (see utils.OUTPUT_PROFILES).
+
+    With a footprint, only the points within FOOTPRINT_BUFFER of it are read
+    and gridded, through the spatial index of the LAS.
+
+    With a cache, rasters already gridded from the same LAS content and gridding
+    parameters are copied from the cache instead of being regridded.
+    """
+    products = {os.path.join(folder_path, name): classification_filter for name, classification_filter in GRID_PRODUCTS.items()}
+    if cache is None:
+        # grid the ground DEM and the all-points DSM from a single read of the LAS
+        with span('pointcloud2dem', las=las_file, products=len(products)):
+            pointcloud2products(
+                las_file, products, resolution=GRID_RESOLUTION, method=GRID_METHOD, output_profile=output_profile,
+                polygon=footprint, buffer=FOOTPRINT_BUFFER
+            )
+        return
+
+    las_hash = cache.hash(las_file)
+    keys = {}
+    to_grid = {}
+    for dem_path, classification_filter in products.items():
+        keys[dem_path] = cache_key('grid', las_hash, GRID_RESOLUTION, GRID_METHOD, classification_filter, output_profile, *_footprint_key(footprint))
+        entry_hash = cache.entry_hash(keys[dem_path], '.tif')
+        if entry_hash is None:
+            to_grid[dem_path] = classification_filter
+        elif not (os.path.exists(dem_path) and cache.hash(dem_path) == entry_hash):
+            cache.get_file(keys[dem_path], '.tif', dem_path)
+
+    if len(to_grid) > 0:
+        with span('pointcloud2dem', las=las_file, products=len(to_grid)):
+            pointcloud2products(
+                las_file, to_grid, resolution=GRID_RESOLUTION, method=GRID_METHOD, output_profile=output_profile,
+                polygon=footprint, buffer=FOOTPRINT_BUFFER
+            )
+        for dem_path in to_grid:
+            cache.put_file(keys[dem_path], '.tif', dem_path)
+            cache.mark_produced(dem_path)
+
+def _footprint_key(footprint):
+    """Extra cache key parts of a footprint; none without one, so the keys stay those of the whole raster."""
+    if footprint is None:
+        return ()
+    return ('footprint', np.asarray(footprint).tolist(), FOOTPRINT_BUFFER)
+
+def _load_filled_dem(dem_file, footprint):
+    with span('load_filled_dem', path=dem_file):
+        return load_filled_dem(dem_file, footprint, FOOTPRINT_BUFFER)
+
+def _restore_masked(cache, masked, save_paths):
+    """Make sure the masked rasters in the folder match the cached ones."""
+    for save_path, masked_key in masked.items():
+        entry_hash = cache.entry_hash(masked_key, '.tif')
+        if entry_hash is None:
+            return False
+        if os.path.exists(save_path) and cache.hash(save_path) == entry_hash:
+            continue
+        cache.get_file(masked_key, '.tif', save_path)
+    return True
+
+def _capacity_curve(dem, elevations, save_paths, output_profile, outlet_xy):
+    if outlet_xy is not None:
+        with span('flood_capacity_curve', elevations=len(elevations)):
+            return flood_capacity_curve(dem, elevations, outlet_xy, save_paths=save_paths, output_profile=output_profile)
+    with span('capacity_curve', elevations=len(elevations)):
+        return capacity_curve(dem, elevations, method=VOLUME_METHOD, save_paths=save_paths, output_profile=output_profile)
+
+def estimate_capacities(dem_file, spillway_height, crest_height, folder_path, prefix, cache=None, output_profile=None, outlet_xy=None, footprint=None):
+    """
+    Spillway and crest capacities of one raster (dem or dsm) from a single load,
+    saving the masked rasters as <prefix>_spillway_masked.tif and <prefix>_crest_masked.tif.
+
+    With an outlet coordinate, the pool is flooded from the outlet
+    (see utils.flood_capacity_curve) instead of traced as the largest contour.
+
+    With a footprint, the raster is clipped to it, widened by FOOTPRINT_BUFFER,
+    before it is filled and contoured (see utils.clip_to_footprint).
+
+    With a cache, the volumes and masked rasters are reused while neither the
+    raster content nor the reference elevations change, and the filled raster
+    is reused when only the reference elevations change.
+    """
+    # (elevation, path) pairs, so equal spillway and crest heights still save both rasters
+    save_paths = [
+        (spillway_height, os.path.join(folder_path, f'{prefix}_spillway_masked.tif')),
+        (crest_height, os.path.join(folder_path, f'{prefix}_crest_masked.tif'))
+    ]
+    elevations = [spillway_height, crest_height]
+    if cache is None:
+        dem = dem_file if footprint is None else _load_filled_dem(dem_file, footprint)
+        spillway_capacity, crest_capacity = _capacity_curve(dem, elevations, save_paths, output_profile, outlet_xy)
+        return spillway_capacity, crest_capacity
+
+    dem_hash = cache.hash(dem_file)
+    volume_key = cache_key('volumes', dem_hash, elevations, outlet_xy or VOLUME_METHOD, output_profile, *_footprint_key(footprint))
+    cached = cache.get_object(volume_key)
+    if cached is not None and _restore_masked(cache, cached['masked'], save_paths):
+        spillway_capacity, crest_capacity = cached['volumes']
+        return spillway_capacity, crest_capacity
+
+    filled_key = cache_key('filled', dem_hash, *_footprint_key(footprint))
+    dem = cache.get_object(filled_key)
+    if dem is None:
+        dem = _load_filled_dem(dem_file, footprint)
+        cache.put_object(filled_key, dem)
+    spillway_capacity, crest_capacity = _capacity_curve(dem, elevations, save_paths, output_profile, outlet_xy)
+
+    masked = {}
+    for reference_elevation, save_path in save_paths:
+        if os.path.exists(save_path):
+            masked[save_path] = cache_key('masked', volume_key, reference_elevation)
+            cache.put_file(masked[save_path], '.tif', save_path)
+    cache.put_object(volume_key, {'volumes': [float(spillway_capacity), float(crest_capacity)], 'masked': masked})
+    return spillway_capacity, crest_capacity
+
+def read_height_references(folder_path):
+    """
+    Read the height_references.csv of a survey folder.
+
+    Returns
+    -------
+    spillway_height, crest_height : float
+        Reference elevations, 0 if not surveyed yet.
+    outlet_xy : tuple of float or None
+        Optional outlet coordinate, to flood the pool from the outlet.
+    """
+    with open(os.path.join(folder_path, 'height_references.csv'), 'r') as f:
+        lines = f.readlines()
+        f.close()
+    # get the height references
+    spillway_height = float(lines[0].split(',')[1])
+    crest_height = float(lines[1].split(',')[1])
+
+    references = dict((line.split(',')[0].strip(), float(line.split(',')[1])) for line in lines[2:] if ',' in line)
+    outlet_xy = None
+    if 'outlet_x' in references and 'outlet_y' in references:
+        outlet_xy = (references['outlet_x'], references['outlet_y'])
+    return spillway_height, crest_height, outlet_xy
+
+def read_footprint(folder_path):
+    """
+    The basin footprint polygon of a survey folder, from the "x, y" lines of
+    its footprint.csv, as an (n, 2) array, or None if it has none.
+    """
+    footprint_path = os.path.join(folder_path, FOOTPRINT_FILE)
+    if not os.path.exists(footprint_path):
+        return None
+    vertices = []
+    with open(footprint_path, 'r') as f:
+        for line in f:
+            values = line.split(',')
+            try:
+                vertices.append((float(values[0]), float(values[1])))
+            except (ValueError, IndexError):
+                # header or blank line
+                continue
+    if len(vertices) < 3:
+        raise ValueError(f"{footprint_path} has fewer than 3 vertices")
+    return np.array(vertices)
+
+def prepare_folder(folder, cache=None, classify_ground=False):
+    """
+    Check that a survey folder under data/ is ready and read its references.
+
+    Parameters
+    ----------
+    folder : str
+        Folder name, <Basin>_<YYYYMMDD>.
+    cache : cache.ContentCache, optional
+        See process_folder.
+    classify_ground : bool, optional
+        See process_folder.
+
+    Returns
+    -------
+    plan : dict or None
+        The folder's 'folder', 'folder_path', 'files', 'spillway_height',
+        'crest_height', 'outlet_xy', 'footprint', 'dem_file', 'dsm_file' and
+        'las_file', the LAS to regrid them from or None to use the rasters as
+        they are. None if the folder is not ready (no height references, or no
+        DEM/DSM/LAS to work from).
+    """
+    print(f"Processing folder: {folder}")
+    # get the path of the folder
+    folder_path = os.path.join('data', folder)
+    # get the list of files in the folder
+    files = os.listdir(folder_path)
+    # continue if the folder is empty
+    if len(files) == 0:
+        return None
+    # check whether height_references.csv exists
+    if 'height_references.csv' not in files:
+        # create a new height_references.csv file
+        with open(os.path.join(folder_path, 'height_references.csv'), 'w') as f:
+            f.write('spillway_elevation, 0\n')
+            f.write('crest_elevation, 0\n')
             f.close()
+        return None
+    spillway_height, crest_height, outlet_xy = read_height_references(folder_path)
+    if spillway_height == 0 or crest_height == 0:
+        return None
+    footprint = read_footprint(folder_path)
 
-        # return an empty dictionary
-        return {}
+    dsm_file = os.path.join(folder_path, 'dsm.tif')
+    dem_file = os.path.join(folder_path, 'dem.tif')
+    has_rasters = ('dsm.tif' in files) and ('dem.tif' in files)
+
+    # check if .las file exists
+    pc_files = ground_filter.survey_las_files(files)
+    if has_rasters and cache is not None and len(pc_files) == 1:
+        # rasters are kept only when known to be supplied by hand; rasters the
+        # pipeline produced, or of unknown provenance such as those gridded
+        # before the cache existed, may be stale and are regridded from the LAS
+        regrid = not (cache.is_supplied(dem_file) and cache.is_supplied(dsm_file))
+        if regrid and not (cache.is_produced(dem_file) and cache.is_produced(dsm_file)):
+            print(f"Regridding rasters of unknown provenance from the LAS in {folder}")
     else:
-        # Read the capacity.csv file
-        with open(capaticy_csv, 'r') as f:
-            lines = f.readlines()
-            f.close()
+        regrid = not has_rasters
+        if has_rasters and cache is not None and len(pc_files) == 0:
+            cache.mark_supplied(dem_file)
+            cache.mark_supplied(dsm_file)
 
-        processed_data = {}
-        for i in range(1, len(lines)):
-            # check if this line is empty
-            if len(lines[i]) == 1:
-                continue
-            name = lines[i].split(',')[0]
-            date = int(lines[i].split(',')[1])
-            upper_spillway_capacity = float(lines[i].split(',')[2])
-            lower_spillway_capacity = float(lines[i].split(',')[3])
-            upper_crest_capacity = float(lines[i].split(',')[4])
-            lower_crest_capacity = float(lines[i].split(',')[5])
-            processed_data[name] = {
-                'Date': date,
-                'Upper_spillway_capacity': upper_spillway_capacity,
-                'Lower_spillway_capacity': lower_spillway_capacity,
-                'Upper_crest_capacity': upper_crest_capacity,
-                'Lower_crest_capacity': lower_crest_capacity
-            }
-
-        return processed_data
-    
-def process_capacity_estimation():
-    processed_data = check_capacity_csv()
+    if not (regrid and len(pc_files) == 1) and not has_rasters:
+        print(f"No DSM or DEM or LAS file found in {folder}")
+        return None
+
+    las_file = os.path.join(folder_path, pc_files[0]) if regrid and len(pc_files) == 1 else None
+    if las_file is not None:
+        # grid from the classified copy of the LAS, if any, which is made here
+        # when asked for; the raw survey is never rewritten
+        ground_las = ground_filter.classified_las(las_file)
+        if ground_las == las_file and classify_ground and not ground_filter.has_ground(las_file):
+            ground_las = ground_filter.ground_las_path(las_file)
+            with span('classify_ground', las=las_file):
+                ground_filter.classify_ground(las_file, ground_las)
+        las_file = ground_las
+
+    return {
+        'folder': folder,
+        'folder_path': folder_path,
+        'files': files,
+        'spillway_height': spillway_height,
+        'crest_height': crest_height,
+        'outlet_xy': outlet_xy,
+        'footprint': footprint,
+        'dem_file': dem_file,
+        'dsm_file': dsm_file,
+        'las_file': las_file
+    }
+
+def folder_result(plan, capacities, output_profile=None, cache=None):
+    """
+    The capacity.csv row of a folder as a dict, with the 'Parameters' and
+    'Inputs' recorded as its provenance in the results store.
+
+    Parameters
+    ----------
+    plan : dict
+        The folder's plan from prepare_folder.
+    capacities : dict
+        Maps the results_store.CAPACITY_KEYS to the folder's capacities.
+    """
+    result = dict()
+    result['Name'] = plan['folder']
+    result['Date'] = int(plan['folder'].split('_')[-1])
+    result.update(capacities)
+    result['Parameters'] = {
+        'grid_resolution': GRID_RESOLUTION,
+        'grid_method': GRID_METHOD,
+        'regridded': plan['las_file'] is not None,
+        'output_profile': output_profile,
+        'spillway_elevation': plan['spillway_height'],
+        'crest_elevation': plan['crest_height'],
+        'outlet_xy': plan['outlet_xy'],
+        'volume_method': 'flood' if plan['outlet_xy'] is not None else VOLUME_METHOD,
+        'footprint_buffer': FOOTPRINT_BUFFER if plan['footprint'] is not None else None
+    }
+    result['Inputs'] = input_hashes(plan['folder_path'], plan['files'], cache)
+    return result
+
+def process_folder(folder, cache=None, output_profile=None, classify_ground=False):
+    """
+    Estimate the capacities of one survey folder under data/.
+
+    Parameters
+    ----------
+    folder : str
+        Folder name, <Basin>_<YYYYMMDD>.
+    cache : cache.ContentCache, optional
+        Cache of gridded rasters, filled rasters and volumes. With a cache,
+        rasters next to a LAS are regridded when the LAS changes, unless
+        they are known to be supplied by hand, i.e., they were first found
+        in the folder without a LAS.
+    output_profile : {'cog', 'cog-zstd'}, optional
+        Compact layout of the rasters written (see utils.OUTPUT_PROFILES).
+    classify_ground : bool, optional
+        If True, a LAS without ground points is classified by the progressive
+        morphological filter (see ground_filter.classify_ground) into
+        <name>.ground.las next to it, which is gridded instead.
+
+    Returns
+    -------
+    result : dict or None
+        The capacity.csv row as a dict, or None if the folder is not ready
+        (no height references, or no DEM/DSM/LAS to work from).
+    """
+    plan = prepare_folder(folder, cache, classify_ground)
+    if plan is None:
+        return None
+    folder_path, footprint = plan['folder_path'], plan['footprint']
+    spillway_height, crest_height, outlet_xy = plan['spillway_height'], plan['crest_height'], plan['outlet_xy']
+    if plan['las_file'] is not None:
+        grid_folder(plan['las_file'], folder_path, cache, output_profile, footprint)
+
+    with span('estimate_capacities', raster='dsm'):
+        lower_spillway_capacity, lower_crest_capacity = estimate_capacities(plan['dsm_file'], spillway_height, crest_height, folder_path, 'dsm', cache, output_profile, outlet_xy, footprint)
+    with span('estimate_capacities', raster='dem'):
+        upper_spillway_capacity, upper_crest_capacity = estimate_capacities(plan['dem_file'], spillway_height, crest_height, folder_path, 'dem', cache, output_profile, outlet_xy, footprint)
+    capacities = {
+        'Lower_spillway_capacity': lower_spillway_capacity,
+        'Lower_crest_capacity': lower_crest_capacity,
+        'Upper_spillway_capacity': upper_spillway_capacity,
+        'Upper_crest_capacity': upper_crest_capacity
+    }
+    return folder_result(plan, capacities, output_profile, cache)
+
+def input_hashes(folder_path, files, cache=None):
+    """
+    Content hashes of the inputs of a folder, recorded as provenance in the
+    results store. The LAS file is hashed only with a cache, whose hashes are
+    memoized, to avoid reading it again when its rasters already exist.
+    """
+    names = ['dem.tif', 'dsm.tif', 'height_references.csv']
+    if FOOTPRINT_FILE in files:
+        names.append(FOOTPRINT_FILE)
+    if cache is not None:
+        names += ground_filter.survey_las_files(files)
+    hash_file = cache.hash if cache is not None else file_hash
+    return {name: hash_file(os.path.join(folder_path, name)) for name in names}
+
+def _timed_process_folder(folder, cache=None, output_profile=None, instrument=False, profile_path=None, classify_ground=False):
+    """
+    Run process_folder in a worker and return (result, error, wall time, raster bytes written, spans).
+
+    With instrument, the stages of the folder are recorded as spans (see
+    instrumentation.RunReport), else spans is None. With profile_path, the
+    folder runs under cProfile and the statistics are dumped to profile_path.
+    """
+    start_time = time.perf_counter()
+    start_bytes = raster_bytes_written()
+    report = RunReport() if instrument else None
+    with report or nullcontext():
+        try:
+            with span('folder', folder=folder):
+                if profile_path is None:
+                    result = process_folder(folder, cache, output_profile, classify_ground)
+                else:
+                    profiler = cProfile.Profile()
+                    try:
+                        result = profiler.runcall(process_folder, folder, cache, output_profile, classify_ground)
+                    finally:
+                        profiler.dump_stats(profile_path)
+                        print(f"Profile of {folder} saved to: {profile_path}")
+            error = None
+        except Exception as e:
+            result = None
+            error = f"{type(e).__name__}: {e}"
+    spans = report.spans if report is not None else None
+    return result, error, time.perf_counter() - start_time, raster_bytes_written() - start_bytes, spans
+
+def _changed(result, processed):
+    keys = ['Upper_spillway_capacity', 'Lower_spillway_capacity', 'Upper_crest_capacity', 'Lower_crest_capacity']
+    return any(float(result[key]) != processed[key] for key in keys)
+
+def record_outcome(store, folder, result, error, wall_time, n_bytes, processed=None):
+    """
+    Upsert the result of one folder into the results store, unless it failed,
+    was skipped or has the same capacities as `processed`, its current row,
+    and that row is not outdated (see outdated_folders).
+
+    Returns
+    -------
+    status : {'done', 'updated', 'cached', 'skipped', 'failed'}
+    """
+    if error is not None:
+        print(f"Failed folder: {folder} ({error})")
+        return 'failed'
+    if result is None:
+        return 'skipped'
+    if processed is not None and not _changed(result, processed) and not _outdated(store.provenance(folder)):
+        return 'cached'
+    store.upsert(
+        result, parameters=result['Parameters'], inputs=result['Inputs'],
+        timings={'wall_time': wall_time, 'raster_bytes': n_bytes}
+    )
+    return 'done' if processed is None else 'updated'
+
+def _folder_args(folder, cache, output_profile, run_report, profile_folder, classify_ground):
+    profile_path = f'profile_{folder}.prof' if folder == profile_folder else None
+    return folder, cache, output_profile, run_report is not None, profile_path, classify_ground
+
+def process_capacity_estimation(workers=1, cache=None, output_profile=None, report_path=None, profile_folder=None, classify_ground=False):
+    """
+    Estimate the capacities of every unprocessed folder under data/, upsert
+    them with their provenance into the results store (data/capacity.sqlite,
+    see results_store.ResultsStore) and export data/capacity.csv.
+
+    Parameters
+    ----------
+    workers : int, optional
+        Number of worker processes. With more than one, folders are processed in
+        a process pool. Only this process writes the store, in folder order,
+        and a failure in one folder does not stop the others. Default is 1.
+    cache : cache.ContentCache, optional
+        Cache of intermediate rasters and volumes. With a cache, folders already
+        in the store are re-evaluated too: unchanged inputs are served from
+        the cache, and rows whose inputs changed (a new LAS, edited
+        height_references.csv) are updated in place.
+    output_profile : {'cog', 'cog-zstd'}, optional
+        Compact layout of the rasters written (see utils.OUTPUT_PROFILES).
+        If None, rasters are written as uncompressed float64 GeoTIFFs.
+    report_path : str, optional
+        If given, time every stage of every folder (LAS reading, gridding,
+        nodata filling, contours, raster writes, ...) and write the spans and
+        their per-folder totals to this JSON file (see instrumentation.RunReport).
+    profile_folder : str, optional
+        If given, run this folder under cProfile and dump the statistics to
+        profile_<folder>.prof, e.g., for snakeviz or pstats.
+    classify_ground : bool, optional
+        If True, classify the ground points of the LAS files that have none
+        before gridding them (see process_folder).
+    """
+    run_report = RunReport() if report_path is not None else None
+    store = ResultsStore()
+    processed_data = check_capacity_csv(store)
     processed_folders = list(processed_data.keys())
     print(f"Processed folders: {processed_folders}")
     # list all folders under the data folder
     folders = [f for f in os.listdir('data') if os.path.isdir(os.path.join('data', f))]
-    # sort the folders
-    folders = natsorted(folders)
-    for folder in folders:
-        # check if the folder is already processed
-        if folder in processed_data:
-            continue
-        print(f"Processing folder: {folder}")
-        # get the path of the folder
-        folder_path = os.path.join('data', folder)
-        # get the list of files in the folder
-        files = os.listdir(folder_path)
-        # continue if the folder is empty
-        if len(files) == 0:
-            continue
-        # check whether height_references.csv exists
-        if 'height_references.csv' not in files:
-            # create a new height_references.csv file
-            with open(os.path.join(folder_path, 'height_references.csv'), 'w') as f:
-                f.write('spillway_elevation, 0\n')
-                f.write('crest_elevation, 0\n')
-                f.close()
-            continue
-        # read the height_references.csv file
-        with open(os.path.join(folder_path, 'height_references.csv'), 'r') as f:
-            lines = f.readlines()
-            f.close()
-        # get the height references
-        spillway_height = float(lines[0].split(',')[1])
-        crest_height = float(lines[1].split(',')[1])
+    # sort the folders and skip the ones that are already processed, unless cached or outdated
+    outdated = outdated_folders(store)
+    folders = [f for f in natsorted(folders) if cache is not None or f not in processed_data or f in outdated]
 
-        if spillway_height == 0 or crest_height == 0:
-            continue
+    if workers > 1 and len(folders) > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        futures = [executor.submit(_timed_process_folder, *_folder_args(folder, cache, output_profile, run_report, profile_folder, classify_ground)) for folder in folders]
+        # collect in submission order so the rows are appended in folder order
+        outcomes = (future.result() for future in futures)
+    else:
+        executor = None
+        outcomes = (_timed_process_folder(*_folder_args(folder, cache, output_profile, run_report, profile_folder, classify_ground)) for folder in folders)
 
-        result = dict()
-        result['Name'] = folder
-        result['Date'] = int(folder.split('_')[-1])
-        if 'dsm.tif' in files:
-            dsm_file = os.path.join(folder_path, 'dsm.tif')
-            lower_spillway_capacity = estimate_volume(dsm_file, spillway_height, os.path.join(folder_path, 'dsm_spillway_masked.tif'))
-            lower_crest_capacity = estimate_volume(dsm_file, crest_height, os.path.join(folder_path, 'dsm_crest_masked.tif'))
-            result['Lower_spillway_capacity'] = lower_spillway_capacity
-            result['Lower_crest_capacity'] = lower_crest_capacity
-
-        if 'dem.tif' in files:
-            dem_file = os.path.join(folder_path, 'dem.tif')
-            upper_spillway_capacity = estimate_volume(dem_file, spillway_height, os.path.join(folder_path, 'dem_spillway_masked.tif'))
-            upper_crest_capacity = estimate_volume(dem_file, crest_height, os.path.join(folder_path, 'dem_crest_masked.tif'))
-            result['Upper_spillway_capacity'] = upper_spillway_capacity
-            result['Upper_crest_capacity'] = upper_crest_capacity
-
-        if ('dsm.tif' in files) and ('dem.tif' in files):
-            # append the result to the capacity.csv file
-            with open('data/capacity.csv', 'a') as f:
-                f.write(f"{result['Name']}, {result['Date']}, {result['Upper_spillway_capacity']}, {result['Lower_spillway_capacity']}, {result['Upper_crest_capacity']}, {result['Lower_crest_capacity']}\n")
-                f.close()
-            continue
+    timings = []
+    n_written = 0
+    try:
+        for folder, (result, error, wall_time, n_bytes, spans) in zip(folders, outcomes):
+            if spans is not None:
+                run_report.extend(spans)
+            status = record_outcome(store, folder, result, error, wall_time, n_bytes, processed_data.get(folder))
+            if status in ('done', 'updated'):
+                n_written += 1
+            timings.append((folder, status, wall_time, n_bytes))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        # keep capacity.csv in step with the store for the scripts that read it
+        if n_written > 0:
+            store.export_csv()
+        store.close()
+
+    print_timings(timings)
 
-        # check if .las file exists
-        pc_files = [f for f in files if f.endswith('.las')]
-        if len(pc_files) == 1:
-            las_file = os.path.join(folder_path, pc_files[0])
-            dsm_file = os.path.join(folder_path, 'dsm.tif')
-            dem_file = os.path.join(folder_path, 'dem.tif')
-            pointcloud2dem(las_file, dem_file, resolution=0.5, method='linear', classification_filter=[2])
-            pointcloud2dem(las_file, dsm_file, resolution=0.5, method='linear')
-            lower_spillway_capacity = estimate_volume(dsm_file, spillway_height, os.path.join(folder_path, 'dsm_spillway_masked.tif'))
-            lower_crest_capacity = estimate_volume(dsm_file, crest_height, os.path.join(folder_path, 'dsm_crest_masked.tif'))
-            upper_spillway_capacity = estimate_volume(dem_file, spillway_height, os.path.join(folder_path, 'dem_spillway_masked.tif'))
-            upper_crest_capacity = estimate_volume(dem_file, crest_height, os.path.join(folder_path, 'dem_crest_masked.tif'))
-            result['Lower_spillway_capacity'] = lower_spillway_capacity
-            result['Lower_crest_capacity'] = lower_crest_capacity
-            result['Upper_spillway_capacity'] = upper_spillway_capacity
-            result['Upper_crest_capacity'] = upper_crest_capacity
-            # append the result to the capacity.csv file
-            with open('data/capacity.csv', 'a') as f:
-                f.write(f"{result['Name']}, {result['Date']}, {result['Upper_spillway_capacity']}, {result['Lower_spillway_capacity']}, {result['Upper_crest_capacity']}, {result['Lower_crest_capacity']}\n")
-                f.close()
-
-        # if result is empty, raise an error
-        result_keys = list(result.keys())
-        if len(result_keys) > 2:
-            print("No DSM or DEM or LAS file found")
+    if run_report is not None:
+        run_report.write(report_path)
         
+def print_timings(timings):
+    """Print the (folder, status, wall time, raster bytes written) of every folder and their totals."""
+    if len(timings) == 0:
+        return
+    print("Per-folder wall time and raster bytes written:")
+    for folder, status, wall_time, n_bytes in timings:
+        print(f"  {folder:<30} {status:<8} {wall_time:8.2f} s {n_bytes / 1024 ** 2:10.1f} MB")
+    total_bytes = sum(n_bytes for _, _, _, n_bytes in timings)
+    print(f"  {'Total':<39} {sum(t for _, _, t, _ in timings):8.2f} s {total_bytes / 1024 ** 2:10.1f} MB")
+
 def sort_csv():
-    with open('data/capacity.csv', 'r') as f:
-        lines = f.readlines()
-        f.close()
-    data = []
-    for i in range(1, len(lines)):
-        name = lines[i].split(',')[0]
-        date = int(lines[i].split(',')[1])
-        upper_spillway_capacity = float(lines[i].split(',')[2])
-        lower_spillway_capacity = float(lines[i].split(',')[3])
-        upper_crest_capacity = float(lines[i].split(',')[4])
-        lower_crest_capacity = float(lines[i].split(',')[5])
-        data.append([name, date, upper_spillway_capacity, lower_spillway_capacity, upper_crest_capacity, lower_crest_capacity])
-    data = np.array(data)
-    # sort the data by name
-    data = data[data[:, 0].argsort()]
-    with open('data/capacity.csv', 'w') as f:
-        f.write('Name, Date, Upper_spillway_capacity, Lower_spillway_capacity, Upper_crest_capacity, Lower_crest_capacity\n')
-        for i in range(len(data)):
-            f.write(f"{data[i][0]}, {data[i][1]}, {data[i][2]}, {data[i][3]}, {data[i][4]}, {data[i][5]}\n")
-        f.close()
+    """Rewrite data/capacity.csv, sorted by name, from the results store."""
+    with ResultsStore() as store:
+        store.export_csv()
 
-if __name__ == "__main__":
-    process_capacity_estimation()
-    sort_csv()
+def add_arguments(parser):
+    """Options of the capacity estimation, shared with the `capacity` command of cli.py."""
+    parser.add_argument('--workers', type=int, default=1, help="number of folders processed in parallel")
+    parser.add_argument('--cache', action='store_true', help="reuse intermediate rasters and volumes whose inputs have not changed")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help="directory of the cache")
+    parser.add_argument('--cache-size', type=float, default=DEFAULT_MAX_BYTES / 1024 ** 3, help="cache size cap in GB")
+    parser.add_argument('--output-profile', choices=sorted(OUTPUT_PROFILES), default=None, help="write float32, compressed, tiled rasters with overviews (COG)")
+    parser.add_argument('--report', default=None, help="write a JSON report of the time and memory of every stage to this path")
+    parser.add_argument('--profile', default=None, help="run this folder under cProfile and dump the statistics to profile_<folder>.prof")
+    parser.add_argument('--classify-ground', action='store_true', help="classify the ground points of LAS files that have none into <name>.ground.las, and grid from it")
+    parser.add_argument('--pipeline', action='store_true', help="overlap reading, computing and writing folders in a staged pipeline (see pipeline.py)")
+    parser.add_argument('--io-workers', type=int, default=2, help="threads of each I/O stage of the pipeline")
+    parser.add_argument('--queue-depth', type=int, default=2, help="folders held between two stages of the pipeline")
 
+def main(args):
+    if args.pipeline:
+        if args.cache or args.report or args.profile:
+            raise SystemExit("capacity: --pipeline does not support --cache, --report or --profile")
+        import pipeline
+        pipeline.process_capacity_pipeline(
+            workers=args.workers, io_workers=args.io_workers, queue_depth=args.queue_depth, output_profile=args.output_profile,
+            classify_ground=args.classify_ground
+        )
+        return
+    cache = ContentCache(args.cache_dir, int(args.cache_size * 1024 ** 3)) if args.cache else None
+    process_capacity_estimation(
+        workers=args.workers, cache=cache, output_profile=args.output_profile,
+        report_path=args.report, profile_folder=args.profile, classify_ground=args.classify_ground
+    )
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Estimate debris basin capacities for the folders under data/.")
+    add_arguments(parser)
+    main(parser.parse_args())
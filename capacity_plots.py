@@ -1,34 +1,62 @@
 import os
-import matplotlib.pyplot as plt
 import numpy as np
 import csv
-import matplotlib.dates as mdates
 from datetime import datetime
-import matplotlib.ticker as mticker
-import pandas as pd
 from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor
+from cache import cache_key
+from lazy import LazyModule, lazy_function
+from results_store import ResultsStore, CAPACITY_KEYS
+from uncertainty import read_uncertainty
+
+# matplotlib and pandas are imported on first use, so writing results.csv does not load matplotlib
+plt = LazyModule('matplotlib.pyplot')
+mdates = LazyModule('matplotlib.dates')
+mticker = LazyModule('matplotlib.ticker')
+pd = LazyModule('pandas')
+mpimg = LazyModule('matplotlib.image')
+Figure = lazy_function('matplotlib.figure', 'Figure')
+
+PERCENTILES = ('P5', 'P50', 'P95')
+
+# Per-basin panels of plot_panels, cached in PANEL_DIR
+PANEL_DIR = 'docs/capacity_plots/panels'
+PANEL_SIZE = (6.5, 5.0)
+PANEL_DPI = 150
+STORM_DATES = [20250127, 20250206, 20250212]
+PANEL_FIGURES = {
+    'capacity': (
+        "Remaining Debris Basin Capacity",
+        "Remaining debris basin capacity, cubic yard",
+        'docs/capacity_plots/capacity.png'
+    ),
+    'capacity_ratio': (
+        "Remaining Debris Basin Capacity relative to the Design Capacity",
+        "Remaining debris basin capacity relative to the design capacity, %",
+        'docs/capacity_plots/capacity_ratio.png'
+    )
+}
 
 def read_capacity_estimation_data():
     data = dict()
-    with open('data/capacity.csv', 'r') as f:
-        reader = csv.reader(f)
-        # skip the header
-        next(reader)
-        for row in reader:
-            name = row[0].split('_')[0]
-            date = int(row[1])
-            upper_spillway_capacity = float(row[2]) 
-            lower_spillway_capacity = float(row[3])
-            upper_crest_capacity = float(row[4])
-            lower_crest_capacity = float(row[5])
-            # convert cubic meters to cubic yards
-            upper_spillway_capacity *= 1.30795
-            lower_spillway_capacity *= 1.30795
-            upper_crest_capacity *= 1.30795
-            lower_crest_capacity *= 1.30795
-            if name not in data:
-                data[name] = dict()
-            data[name][date] = {'Upper_spillway_capacity': upper_spillway_capacity, 'Lower_spillway_capacity': lower_spillway_capacity, 'Upper_crest_capacity': upper_crest_capacity, 'Lower_crest_capacity': lower_crest_capacity}
+    # the results store imports data/capacity.csv on first use
+    with ResultsStore() as store:
+        processed_data = store.capacities()
+    for folder, capacities in processed_data.items():
+        name = folder.split('_')[0]
+        date = capacities['Date']
+        upper_spillway_capacity = capacities['Upper_spillway_capacity']
+        lower_spillway_capacity = capacities['Lower_spillway_capacity']
+        upper_crest_capacity = capacities['Upper_crest_capacity']
+        lower_crest_capacity = capacities['Lower_crest_capacity']
+        # convert cubic meters to cubic yards
+        upper_spillway_capacity *= 1.30795
+        lower_spillway_capacity *= 1.30795
+        upper_crest_capacity *= 1.30795
+        lower_crest_capacity *= 1.30795
+        if name not in data:
+            data[name] = dict()
+        data[name][date] = {'Folder': folder, 'Upper_spillway_capacity': upper_spillway_capacity, 'Lower_spillway_capacity': lower_spillway_capacity, 'Upper_crest_capacity': upper_crest_capacity, 'Lower_crest_capacity': lower_crest_capacity}
     return data
 
 def read_capacity_design_data(data):
@@ -272,12 +300,155 @@ def plot_capacity_raito(data, max_capacity_data):
     plt.savefig('docs/capacity_plots/capacity_ratio.png')
     plt.show()
 
+def panel_key(kind, name, name_data, max_capacity=None):
+    """Cache key of a basin panel: its kind, basin, rows, design capacity and layout."""
+    rows = [[date] + [name_data[date][key] for key in CAPACITY_KEYS] for date in sorted(name_data.keys())]
+    return cache_key(kind, name, rows, max_capacity, PANEL_SIZE, PANEL_DPI)
+
+def render_panel(kind, name, name_data, max_capacity, panel_path):
+    """
+    Draw the crest capacity of one basin, as in plot_capacity ('capacity') or
+    plot_capacity_raito ('capacity_ratio'), into its own PNG.
+
+    The panel is drawn on a matplotlib Figure without pyplot, so panels can be
+    rendered in parallel worker processes. Unlike the shared axes of
+    plot_capacity, the dates on its x axis are those of the basin alone, so a
+    new survey of one basin leaves the panels of the others valid.
+    """
+    dates = sorted(name_data.keys())
+    formatted_dates = [datetime.strptime(str(date), "%Y%m%d") for date in dates]
+    scale = max_capacity if kind == 'capacity_ratio' else 1.0
+
+    # Compute middle capacities and variances
+    middle_crest_capacities = [
+        0.5 * (name_data[date]['Upper_crest_capacity'] + name_data[date]['Lower_crest_capacity']) / scale
+        for date in dates
+    ]
+    variance_crest = [
+        0.5 * abs(name_data[date]['Upper_crest_capacity'] - name_data[date]['Lower_crest_capacity']) / scale
+        for date in dates
+    ]
+    if kind == 'capacity_ratio':
+        # limit the ratio to 1
+        middle_crest_capacities = [min(1, x) for x in middle_crest_capacities]
+
+    fig = Figure(figsize=PANEL_SIZE)
+    ax = fig.subplots()
+    ax.errorbar(formatted_dates, middle_crest_capacities, yerr=variance_crest, fmt='-s', label="Crest", capsize=3)
+    for storm_date in [datetime.strptime(str(d), "%Y%m%d") for d in STORM_DATES]:
+        ax.axvspan(storm_date - timedelta(days=1), storm_date + timedelta(days=1), color='gray', alpha=0.3, label="Storm Event")
+
+    ax.set_xticks(formatted_dates)
+    ax.set_xticklabels([d.strftime("%m/%d") for d in formatted_dates], rotation=45, fontsize=14)
+    if kind == 'capacity_ratio':
+        ax.yaxis.set_major_formatter(mticker.FuncFormatter(lambda x, _: f"{x:.0%}"))
+    else:
+        ax.yaxis.set_major_formatter(mticker.FuncFormatter(lambda x, _: f"{x:,.0f}"))
+    ax.tick_params(axis='y', labelsize=14)
+    ax.set_title(name, fontsize=16)
+    ax.grid(True, linestyle='-.', linewidth=0.5)
+    fig.tight_layout()
+
+    # write next to the panel and rename, so a cached panel is never half written
+    tmp_path = f"{panel_path}.{os.getpid()}.tmp.png"
+    fig.savefig(tmp_path, dpi=PANEL_DPI)
+    os.replace(tmp_path, panel_path)
+    return panel_path
+
+def render_panels(data, max_capacity_data=None, workers=1, panel_dir=PANEL_DIR):
+    """
+    Render the panel of every basin and kind whose data changed since the
+    last run, in a process pool with more than one worker.
+
+    A panel is cached in panel_dir as <kind>_<basin>_<key>.png, where key is
+    panel_key of its rows, so after a new survey only that basin's panels are
+    drawn again. Panels of older data are removed.
+
+    Returns
+    -------
+    panels : dict
+        {kind: [panel path of each basin, in name order]}. Basins without a
+        design capacity have no 'capacity_ratio' panel.
+    """
+    os.makedirs(panel_dir, exist_ok=True)
+    max_capacity_data = max_capacity_data or dict()
+    panels = {kind: [] for kind in PANEL_FIGURES}
+    jobs = []
+    for name in sorted(data.keys()):
+        for kind in PANEL_FIGURES:
+            max_capacity = max_capacity_data.get(name) if kind == 'capacity_ratio' else None
+            if kind == 'capacity_ratio' and max_capacity is None:
+                continue
+            key = panel_key(kind, name, data[name], max_capacity)
+            panel_path = os.path.join(panel_dir, f"{kind}_{name}_{key[:16]}.png")
+            panels[kind].append(panel_path)
+            # remove the panels of older data
+            for f in os.listdir(panel_dir):
+                if f.startswith(f"{kind}_{name}_") and f != os.path.basename(panel_path):
+                    os.remove(os.path.join(panel_dir, f))
+            if not os.path.exists(panel_path):
+                jobs.append((kind, name, data[name], max_capacity, panel_path))
+
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(render_panel, *zip(*jobs)))
+    else:
+        for job in jobs:
+            render_panel(*job)
+    n_panels = sum(len(paths) for paths in panels.values())
+    print(f"Rendered {len(jobs)} of {n_panels} panels, reused {n_panels - len(jobs)} from {panel_dir}")
+    return panels
+
+def compose_panels(panel_paths, title, ylabel, output_path, n_cols=3):
+    """
+    Composite basin panels into one summary figure, in a grid of n_cols
+    columns, the way docs/pointcloud_screenshots/compose_figures.py does.
+    """
+    n_rows = max(1, -(-len(panel_paths) // n_cols))
+    fig = Figure(figsize=(20, 5 * n_rows))
+    axs = fig.subplots(n_rows, n_cols, squeeze=False)
+    for ax, panel_path in zip(axs.flatten(), panel_paths):
+        ax.imshow(mpimg.imread(panel_path))
+        ax.axis("off")
+    # Remove empty subplots
+    for ax in axs.flatten()[len(panel_paths):]:
+        fig.delaxes(ax)
+
+    fig.suptitle(title, fontsize=24, y=0.97)
+    fig.text(0.5, 0.04, "Date", ha="center", fontsize=24)
+    fig.text(0.02, 0.5, ylabel, va="center", rotation="vertical", fontsize=24)
+    fig.tight_layout(rect=[0.05, 0.05, 1, 0.95])
+    fig.savefig(output_path, dpi=PANEL_DPI)
+    print(f"Figure saved to: {output_path}")
+
+def plot_panels(data, max_capacity_data=None, workers=1, panel_dir=PANEL_DIR):
+    """
+    Incremental counterpart of plot_capacity and plot_capacity_raito: render
+    the changed basin panels (see render_panels) and composite the cached
+    panels into docs/capacity_plots/capacity.png and capacity_ratio.png.
+    """
+    panels = render_panels(data, max_capacity_data, workers, panel_dir)
+    for kind, (title, ylabel, output_path) in PANEL_FIGURES.items():
+        if len(panels[kind]) > 0:
+            compose_panels(panels[kind], title, ylabel, output_path)
+
 def save_results(data, max_capacity_data):
     with open('data/results.csv', 'w') as f:
         writer = csv.writer(f)
-        writer.writerow(['Name', 'Date', 'Spillway Capacity (cy)', 'Spillway Capacity Uncertainty (cy)', 'Crest Capacity (cy)', 'Crest Capacity Uncertainty (cy)', 'Spillway Capacity Ratio', 'Crest Capacity Ratio', "Max Design Capacity (cy)"])
+        # Monte Carlo percentiles from uncertainty.py, blank for folders without an uncertainty.csv
+        percentile_header = [f'Spillway Capacity {p} (cy)' for p in PERCENTILES] + [f'Crest Capacity {p} (cy)' for p in PERCENTILES]
+        writer.writerow(['Name', 'Date', 'Spillway Capacity (cy)', 'Spillway Capacity Uncertainty (cy)', 'Crest Capacity (cy)', 'Crest Capacity Uncertainty (cy)', 'Spillway Capacity Ratio', 'Crest Capacity Ratio', "Max Design Capacity (cy)"] + percentile_header)
         for name, dates in data.items():
             for date, capacities in dates.items():
+                uncertainty = read_uncertainty(os.path.join('data', capacities['Folder'], 'uncertainty.csv'))
+                percentile_values = []
+                for reference in ['spillway', 'crest']:
+                    for p in PERCENTILES:
+                        if reference in uncertainty:
+                            # convert cubic meters to cubic yards
+                            percentile_values.append(int(uncertainty[reference][p] * 1.30795))
+                        else:
+                            percentile_values.append('')
                 spillway_capacity = int(0.5 * (capacities['Upper_spillway_capacity'] + capacities['Lower_spillway_capacity']))
                 spillway_capacity_uncertainty = int(0.5 * abs(capacities['Upper_spillway_capacity'] - capacities['Lower_spillway_capacity']))
                 crest_capacity = int(0.5 * (capacities['Upper_crest_capacity'] + capacities['Lower_crest_capacity']))
@@ -286,7 +457,7 @@ def save_results(data, max_capacity_data):
                 spillway_capacity_ratio = "{:.2%}".format(spillway_capacity_ratio)
                 crest_capacity_ratio = crest_capacity / max_capacity_data[name]
                 crest_capacity_ratio = "{:.2%}".format(crest_capacity_ratio)
-                writer.writerow([name, date, spillway_capacity, spillway_capacity_uncertainty, crest_capacity, crest_capacity_uncertainty, spillway_capacity_ratio, crest_capacity_ratio, max_capacity_data[name]])
+                writer.writerow([name, date, spillway_capacity, spillway_capacity_uncertainty, crest_capacity, crest_capacity_uncertainty, spillway_capacity_ratio, crest_capacity_ratio, max_capacity_data[name]] + percentile_values)
         
 # main 
 if __name__ == '__main__':
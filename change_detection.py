@@ -0,0 +1,250 @@
+import argparse
+import csv
+import os
+import time
+
+import numpy as np
+from natsort import natsorted
+
+from lazy import LazyModule
+from utils import RasterAccumulator, OUTPUT_PROFILES, fill_empty_cells, parse_las_crs, write_dem, report_throughput
+from capacity_estimation import GRID_RESOLUTION, GRID_METHOD
+from ground_filter import classified_las, survey_las_files
+
+laspy = LazyModule('laspy')
+rasterio = LazyModule('rasterio')
+warp = LazyModule('rasterio.warp')
+
+def survey_folders(data_dir='data'):
+    """
+    Group the survey folders under data_dir by basin.
+
+    Returns
+    -------
+    surveys : dict
+        {basin: [(date, folder path), ...]} with the dates in increasing order.
+        Only folders with a LAS file or a dem.tif are listed.
+    """
+    surveys = dict()
+    for folder in natsorted(os.listdir(data_dir)):
+        folder_path = os.path.join(data_dir, folder)
+        if not os.path.isdir(folder_path) or '_' not in folder:
+            continue
+        files = os.listdir(folder_path)
+        if 'dem.tif' not in files and not any(f.endswith('.las') for f in files):
+            continue
+        basin = folder.split('_')[0]
+        date = int(folder.split('_')[-1])
+        surveys.setdefault(basin, []).append((date, folder_path))
+    for basin in surveys:
+        surveys[basin].sort()
+    return surveys
+
+def survey_source(folder_path):
+    """
+    The LAS file of a survey folder, or its classified copy (see
+    ground_filter.classified_las), if there is exactly one, else its dem.tif.
+    """
+    las_files = survey_las_files(os.listdir(folder_path))
+    if len(las_files) == 1:
+        return classified_las(os.path.join(folder_path, las_files[0]))
+    return os.path.join(folder_path, 'dem.tif')
+
+def source_bounds(path):
+    """(min_x, min_y, max_x, max_y) of a LAS file, from its header, or of a raster."""
+    if path.endswith('.las'):
+        with laspy.open(path) as reader:
+            header = reader.header
+            return header.mins[0], header.mins[1], header.maxs[0], header.maxs[1]
+    with rasterio.open(path) as src:
+        return tuple(src.bounds)
+
+def shared_grid(paths, resolution):
+    """
+    Grid covering every survey, snapped to multiples of the resolution.
+
+    Snapping makes the grid independent of which surveys are included, so a
+    new date only widens the grid by whole cells and never shifts the nodes.
+
+    Returns
+    -------
+    min_x, min_y : float
+        Coordinates of grid node (0, 0).
+    n_rows, n_cols : int
+        Grid shape.
+    """
+    return snapped_grid([source_bounds(path) for path in paths], resolution)
+
+def snapped_grid(bounds, resolution):
+    """shared_grid from a list of (min_x, min_y, max_x, max_y) bounds."""
+    bounds = np.asarray(bounds, dtype=float)
+    min_x = np.floor(bounds[:, 0].min() / resolution) * resolution
+    min_y = np.floor(bounds[:, 1].min() / resolution) * resolution
+    n_cols = int(np.ceil((bounds[:, 2].max() - min_x) / resolution)) + 1
+    n_rows = int(np.ceil((bounds[:, 3].max() - min_y) / resolution)) + 1
+    return min_x, min_y, n_rows, n_cols
+
+def grid_on(path, min_x, min_y, n_rows, n_cols, resolution, classification_filter=(2,), method=GRID_METHOD, chunk_size=5_000_000):
+    """
+    Grid one survey onto a given grid.
+
+    A LAS file is streamed into a RasterAccumulator (mean of the points of
+    classification_filter) and its empty cells are filled by TIN interpolation.
+    A DEM supplied without its point cloud is resampled onto the grid once.
+
+    Returns
+    -------
+    grid_z : 2D np.ndarray
+        Elevations, row 0 at min_y, NaN where the survey has no data.
+    crs_info : pyproj.CRS or None
+        Coordinate reference system of the survey.
+    """
+    if path.endswith('.las'):
+        start_time = time.perf_counter()
+        accumulator = RasterAccumulator(min_x, min_y, n_rows, n_cols, resolution, 'mean')
+        with laspy.open(path) as reader:
+            crs_info = parse_las_crs(reader.header)
+            n_read = 0
+            for chunk in reader.chunk_iterator(chunk_size):
+                n_read += len(chunk)
+                if classification_filter is None:
+                    accumulator.add(chunk.x, chunk.y, chunk.z)
+                else:
+                    keep_mask = np.isin(chunk.classification, classification_filter)
+                    accumulator.add(chunk.x[keep_mask], chunk.y[keep_mask], chunk.z[keep_mask])
+        report_throughput(n_read, start_time, label='Gridded')
+        return fill_empty_cells(accumulator.result(), method=method), crs_info
+
+    grid_z = np.full((n_rows, n_cols), np.nan)
+    with rasterio.open(path) as src:
+        crs_info = src.crs
+        # both grids share one CRS; any CRS stands in when the raster carries none
+        crs = crs_info or 'EPSG:3857'
+        warp.reproject(
+            source=rasterio.band(src, 1),
+            destination=grid_z,
+            dst_transform=rasterio.transform.from_origin(min_x, min_y, resolution, -resolution),
+            src_crs=crs,
+            dst_crs=crs,
+            dst_nodata=np.nan,
+            resampling=warp.Resampling.bilinear
+        )
+    return grid_z, crs_info
+
+def dem_of_difference(stack, cell_area, min_change=0.0):
+    """
+    Differences between consecutive surveys and their deposition and erosion volumes.
+
+    Parameters
+    ----------
+    stack : 3D np.ndarray
+        Elevations of shape (n_dates, n_rows, n_cols) on a shared grid, NaN
+        where a survey has no data.
+    cell_area : float
+        Area of one cell.
+    min_change : float, optional
+        Level of detection: elevation changes smaller in magnitude are counted
+        as no change. Default is 0.
+
+    Returns
+    -------
+    dod : 3D np.ndarray
+        Elevation change of shape (n_dates - 1, n_rows, n_cols), positive for
+        deposition, NaN where either survey has no data.
+    deposition, erosion : 1D np.ndarray
+        Deposited and eroded volume (both positive) between consecutive dates.
+    """
+    dod = np.diff(stack, axis=0)
+    change = np.where(np.abs(dod) >= min_change, dod, 0)
+    change = np.nan_to_num(change, nan=0.0)
+    deposition = np.sum(np.maximum(change, 0), axis=(1, 2)) * cell_area
+    erosion = -np.sum(np.minimum(change, 0), axis=(1, 2)) * cell_area
+    return dod, deposition, erosion
+
+def detect_changes(basin, surveys, resolution=GRID_RESOLUTION, min_change=0.0, output_dir='change', output_profile=None):
+    """
+    Grid every survey of a basin onto one shared grid and write the DEM of
+    difference between each pair of consecutive dates.
+
+    Parameters
+    ----------
+    basin : str
+        Basin name.
+    surveys : list of (int, str)
+        (date, folder path) of each survey, in increasing date order.
+    resolution : float, optional
+        Grid spacing. Default is GRID_RESOLUTION.
+    min_change : float, optional
+        Level of detection, see dem_of_difference.
+    output_dir : str, optional
+        The rasters go to <output_dir>/<basin>/dod_<date>_<date>.tif and the
+        volumes to <output_dir>/<basin>/change.csv.
+    output_profile : {'cog', 'cog-zstd'}, optional
+        Compact layout of the rasters written (see utils.OUTPUT_PROFILES).
+
+    Returns
+    -------
+    rows : list of dict
+        The rows of change.csv.
+    """
+    if len(surveys) < 2:
+        return []
+    basin_dir = os.path.join(output_dir, basin)
+
+    # 1. One snapped grid for all dates
+    paths = [survey_source(folder_path) for _, folder_path in surveys]
+    min_x, min_y, n_rows, n_cols = shared_grid(paths, resolution)
+    print(f"Shared grid of {basin}: {n_rows} x {n_cols} cells at ({min_x}, {min_y})")
+
+    # 2. Grid every survey once into a (date, row, col) stack
+    stack = np.empty((len(paths), n_rows, n_cols))
+    crs_info = None
+    for i, path in enumerate(paths):
+        stack[i], survey_crs = grid_on(path, min_x, min_y, n_rows, n_cols, resolution)
+        crs_info = crs_info or survey_crs
+
+    # 3. All differences at once
+    dod, deposition, erosion = dem_of_difference(stack, resolution * resolution, min_change)
+
+    dates = [date for date, _ in surveys]
+    return write_changes(basin_dir, dates, dod, deposition, erosion, min_x, min_y, resolution, crs_info, output_profile)
+
+def write_changes(basin_dir, dates, dod, deposition, erosion, min_x, min_y, resolution, crs_info=None, output_profile=None):
+    """Write the rasters and change.csv of detect_changes. Returns the rows of change.csv."""
+    os.makedirs(basin_dir, exist_ok=True)
+    rows = []
+    for i in range(len(dod)):
+        dod_path = os.path.join(basin_dir, f'dod_{dates[i]}_{dates[i + 1]}.tif')
+        write_dem(dod_path, np.array(dod[i]), min_x, min_y, resolution, crs_info, output_profile=output_profile)
+        rows.append({
+            'From': dates[i],
+            'To': dates[i + 1],
+            'Deposition': deposition[i],
+            'Erosion': erosion[i],
+            'Net': deposition[i] - erosion[i]
+        })
+
+    with open(os.path.join(basin_dir, 'change.csv'), 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=['From', 'To', 'Deposition', 'Erosion', 'Net'])
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
+
+def process_change_detection(resolution=GRID_RESOLUTION, min_change=0.0, output_dir='change', basins=None, output_profile=None):
+    """Run detect_changes for every basin under data/ with at least two surveys."""
+    for basin, surveys in survey_folders().items():
+        if basins is not None and basin not in basins:
+            continue
+        rows = detect_changes(basin, surveys, resolution, min_change, output_dir, output_profile)
+        for row in rows:
+            print(f"  {basin} {row['From']} -> {row['To']}: +{row['Deposition']:.1f} / -{row['Erosion']:.1f} m3 (net {row['Net']:.1f} m3)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DEM of difference between consecutive surveys of each basin under data/.")
+    parser.add_argument('--resolution', type=float, default=GRID_RESOLUTION, help="grid spacing of the shared grid")
+    parser.add_argument('--min-change', type=float, default=0.0, help="level of detection; smaller elevation changes count as no change")
+    parser.add_argument('--output-dir', default='change', help="directory of the difference rasters and change.csv files")
+    parser.add_argument('--basin', action='append', default=None, help="only process this basin (repeatable)")
+    parser.add_argument('--output-profile', choices=sorted(OUTPUT_PROFILES), default=None, help="write float32, compressed, tiled rasters with overviews (COG)")
+    args = parser.parse_args()
+    process_change_detection(args.resolution, args.min_change, args.output_dir, args.basin, args.output_profile)
@@ -0,0 +1,171 @@
+import argparse
+import os
+
+import capacity_estimation
+import watch
+from capacity_estimation import GRID_RESOLUTION, GRID_METHOD, GRID_PRODUCTS
+from cache import DEFAULT_CACHE_DIR
+from ground_filter import GROUND_CELL_SIZE, MAX_WINDOW, TERRAIN_SLOPE
+from utils import OUTPUT_PROFILES, REDUCERS
+
+def grid(args):
+    """Grid the ground DEM and the all-points DSM of a LAS file."""
+    from utils import pointcloud2products
+    folder_path = os.path.dirname(args.las)
+    dem_path = args.dem or os.path.join(folder_path, 'dem.tif')
+    dsm_path = args.dsm or os.path.join(folder_path, 'dsm.tif')
+    products = {dem_path: GRID_PRODUCTS['dem.tif'], dsm_path: GRID_PRODUCTS['dsm.tif']}
+    pointcloud2products(
+        args.las, products, resolution=args.resolution, method=args.method,
+        reducer=args.reducer, chunk_size=args.chunk_size, output_profile=args.output_profile
+    )
+
+def classify(args):
+    """Classify the ground points of a LAS file with a progressive morphological filter."""
+    import ground_filter
+    ground_filter.classify_ground(
+        args.las, args.output, chunk_size=args.chunk_size, cell_size=args.cell_size,
+        in_place=args.in_place, max_window=args.max_window, slope=args.slope
+    )
+
+def fill(args):
+    """Fill the nodata cells of a DEM."""
+    from utils import read_dem, interpolate_nodata, write_raster
+    dem_data, _, _, nodata_value, profile = read_dem(args.dem)
+    ring_width = None if args.ring_width == 0 else args.ring_width
+    dem_filled = interpolate_nodata(dem_data, nodata_value, ring_width=ring_width)
+    profile = dict(profile, dtype='float64')
+    n_bytes = write_raster(args.output, dem_filled, profile, args.output_profile)
+    print(f"Filled DEM saved to: {args.output} ({n_bytes} bytes)")
+
+def plot(args):
+    """Plot the capacities and capacity ratios of every basin to docs/capacity_plots/."""
+    import capacity_plots
+    data = capacity_plots.read_capacity_estimation_data()
+    max_capacity_data = capacity_plots.read_capacity_design_data(data)
+    if args.panels:
+        capacity_plots.plot_panels(data, max_capacity_data, workers=args.workers)
+        return
+    capacity_plots.plot_capacity(data)
+    capacity_plots.plot_capacity_raito(data, max_capacity_data)
+
+def report(args):
+    """Write data/results.csv."""
+    import capacity_plots
+    data = capacity_plots.read_capacity_estimation_data()
+    max_capacity_data = capacity_plots.read_capacity_design_data(data)
+    capacity_plots.save_results(data, max_capacity_data)
+    print("Results saved to: data/results.csv")
+
+def clean(args):
+    """Remove LAS files and/or derived rasters from the survey folders."""
+    from utils import clear_las, clear_data
+    if not (args.las or args.rasters):
+        raise SystemExit("clean: nothing to do, pass --las and/or --rasters")
+    if args.rasters:
+        clear_data()
+    if args.las:
+        clear_las()
+
+def sort(args):
+    """Export data/capacity.csv, sorted by name, from the results store."""
+    capacity_estimation.sort_csv()
+
+def sweep(args):
+    """Capacities at several grid resolutions, gridded from point pyramids of the LAS files."""
+    import point_pyramid
+    from cache import ContentCache
+    cache = ContentCache(args.cache_dir) if args.cache else None
+    point_pyramid.process_resolution_sweep(args.resolution or point_pyramid.SWEEP_RESOLUTIONS, cache, args.folder, args.output_profile)
+
+def watch_folders(args):
+    """Process survey folders under data/ as they land and keep the results up to date."""
+    watch.main(args)
+
+def tin(args):
+    """Capacities from TINs of the LAS points, without rasters, cross-checked against the results store."""
+    import tin_volume
+    from cache import ContentCache
+    cache = ContentCache(args.cache_dir) if args.cache else None
+    tin_volume.process_tin_capacities(args.folder, cache, args.cell_size)
+
+COMMANDS = {
+    'grid': grid,
+    'classify': classify,
+    'fill': fill,
+    'capacity': capacity_estimation.main,
+    'plot': plot,
+    'report': report,
+    'clean': clean,
+    'sort': sort,
+    'sweep': sweep,
+    'tin': tin,
+    'watch': watch_folders
+}
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Debris basin capacity pipeline.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    grid_parser = subparsers.add_parser('grid', help=grid.__doc__)
+    grid_parser.add_argument('las', help="input LAS/LAZ file")
+    grid_parser.add_argument('--dem', default=None, help="output ground DEM, default dem.tif next to the LAS")
+    grid_parser.add_argument('--dsm', default=None, help="output DSM, default dsm.tif next to the LAS")
+    grid_parser.add_argument('--resolution', type=float, default=GRID_RESOLUTION, help="cell size")
+    grid_parser.add_argument('--method', default=GRID_METHOD, choices=('linear', 'nearest', 'cubic'), help="interpolation method")
+    grid_parser.add_argument('--reducer', default=None, choices=REDUCERS, help="bin points with this reducer instead of triangulating them all")
+    grid_parser.add_argument('--chunk-size', type=int, default=None, help="stream the LAS in chunks of this many points")
+    grid_parser.add_argument('--output-profile', choices=sorted(OUTPUT_PROFILES), default=None, help="write float32, compressed, tiled rasters with overviews (COG)")
+
+    classify_parser = subparsers.add_parser('classify', help=classify.__doc__)
+    classify_parser.add_argument('las', help="input LAS file")
+    classify_parser.add_argument('--output', default=None, help="output LAS file, default <name>.ground.las next to the input")
+    classify_parser.add_argument('--in-place', action='store_true', help="rewrite the input in place instead")
+    classify_parser.add_argument('--chunk-size', type=int, default=None, help="stream the LAS in chunks of this many points")
+    classify_parser.add_argument('--cell-size', type=float, default=GROUND_CELL_SIZE, help="cell size of the surface of lowest points")
+    classify_parser.add_argument('--max-window', type=float, default=MAX_WINDOW, help="largest window, about the size of the largest building")
+    classify_parser.add_argument('--slope', type=float, default=TERRAIN_SLOPE, help="largest terrain slope kept as ground")
+
+    fill_parser = subparsers.add_parser('fill', help=fill.__doc__)
+    fill_parser.add_argument('dem', help="input DEM")
+    fill_parser.add_argument('output', help="output filled DEM")
+    fill_parser.add_argument('--ring-width', type=int, default=2, help="width of the ring of valid cells around the holes; 0 fills from the whole grid")
+    fill_parser.add_argument('--output-profile', choices=sorted(OUTPUT_PROFILES), default=None, help="write a float32, compressed, tiled raster with overviews (COG)")
+
+    capacity_parser = subparsers.add_parser('capacity', help="Estimate the capacities of the folders under data/.")
+    capacity_estimation.add_arguments(capacity_parser)
+
+    plot_parser = subparsers.add_parser('plot', help=plot.__doc__)
+    plot_parser.add_argument('--panels', action='store_true', help="render only the basin panels whose data changed and composite the cached panels")
+    plot_parser.add_argument('--workers', type=int, default=1, help="number of panels rendered in parallel")
+    subparsers.add_parser('report', help=report.__doc__)
+
+    clean_parser = subparsers.add_parser('clean', help=clean.__doc__)
+    clean_parser.add_argument('--las', action='store_true', help="remove the LAS files")
+    clean_parser.add_argument('--rasters', action='store_true', help="remove every file but the CSV and LAS files")
+
+    subparsers.add_parser('sort', help=sort.__doc__)
+
+    sweep_parser = subparsers.add_parser('sweep', help=sweep.__doc__)
+    sweep_parser.add_argument('--resolution', type=float, action='append', default=None, help="grid resolution (repeatable), default 0.25, 0.5, 1 and 2")
+    sweep_parser.add_argument('--folder', action='append', default=None, help="only process this folder (repeatable)")
+    sweep_parser.add_argument('--cache', action='store_true', help="memoize the LAS hashes in the cache directory")
+    sweep_parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help="directory of the cache")
+    sweep_parser.add_argument('--output-profile', choices=sorted(OUTPUT_PROFILES), default=None, help="write float32, compressed, tiled rasters with overviews (COG)")
+
+    tin_parser = subparsers.add_parser('tin', help=tin.__doc__)
+    tin_parser.add_argument('--folder', action='append', default=None, help="only process this folder (repeatable)")
+    tin_parser.add_argument('--cell-size', type=float, default=0.25, help="thin the points to about one per cell of this size")
+    tin_parser.add_argument('--cache', action='store_true', help="memoize the LAS hashes in the cache directory")
+    tin_parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help="directory of the cache")
+
+    watch_parser = subparsers.add_parser('watch', help=watch_folders.__doc__)
+    watch.add_arguments(watch_parser)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    COMMANDS[args.command](args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+import argparse
+import copy
+import os
+import time
+
+import numpy as np
+from natsort import natsorted
+
+from lazy import LazyModule, lazy_function
+from utils import RasterAccumulator, fill_empty_cells, report_throughput
+
+laspy = LazyModule('laspy')
+grey_opening = lazy_function('scipy.ndimage', 'grey_opening')
+
+# ASPRS classification codes
+GROUND_CLASS = 2
+UNCLASSIFIED_CLASS = 1
+NOISE_CLASSES = (7, 18)
+
+# Progressive morphological filter parameters (Zhang et al., 2003)
+GROUND_CELL_SIZE = 1.0
+MAX_WINDOW = 20.0
+TERRAIN_SLOPE = 0.3
+INITIAL_THRESHOLD = 0.3
+MAX_THRESHOLD = 2.5
+
+# Classified copy of a survey LAS, written next to it so the raw survey is kept
+GROUND_SUFFIX = '.ground.las'
+
+def window_sizes(cell_size=GROUND_CELL_SIZE, max_window=MAX_WINDOW):
+    """Odd window sizes in cells, 3, 5, 9, 17, ..., growing up to max_window in map units."""
+    sizes = []
+    k = 0
+    while 2 * 2 ** k + 1 <= max(max_window / cell_size, 3):
+        sizes.append(2 * 2 ** k + 1)
+        k += 1
+    return sizes
+
+def ground_ceiling(min_surface, cell_size=GROUND_CELL_SIZE, max_window=MAX_WINDOW, slope=TERRAIN_SLOPE,
+                   initial_threshold=INITIAL_THRESHOLD, max_threshold=MAX_THRESHOLD):
+    """
+    Highest ground elevation of every cell by the progressive morphological filter.
+
+    The surface of the lowest point of every cell is opened with windows of
+    growing size. An opening of w cells flattens objects narrower than w, such
+    as trees and buildings, while the terrain, whose elevation changes by at most
+    slope * (w - w_prev) * cell_size between two openings, stays within the
+    elevation threshold of that window. A point is off the ground when it is
+    above any of the opened surfaces by more than their threshold, so the
+    ceiling is the minimum over the windows of opened surface plus threshold.
+
+    Parameters
+    ----------
+    min_surface : 2D np.ndarray
+        Lowest elevation of the points in every cell, without empty cells.
+    cell_size : float, optional
+        Cell size of the surface in map units. Default is 1.
+    max_window : float, optional
+        Largest window in map units, about the size of the largest building. Default is 20.
+    slope : float, optional
+        Largest terrain slope (rise over run) kept as ground. Default is 0.3.
+    initial_threshold : float, optional
+        Elevation threshold of the first window, about the point noise. Default is 0.3.
+    max_threshold : float, optional
+        Largest elevation threshold, below the height of the lowest objects
+        to remove. Default is 2.5.
+
+    Returns
+    -------
+    ceiling : 2D np.ndarray
+        Points at or below the ceiling of their cell are ground.
+    """
+    surface = min_surface
+    ceiling = np.full(min_surface.shape, np.inf)
+    previous_size = 1
+    for k, size in enumerate(window_sizes(cell_size, max_window)):
+        surface = grey_opening(surface, size=(size, size))
+        if k == 0:
+            threshold = initial_threshold
+        else:
+            threshold = min(slope * (size - previous_size) * cell_size + initial_threshold, max_threshold)
+        ceiling = np.minimum(ceiling, surface + threshold)
+        previous_size = size
+    return ceiling
+
+class GroundFilter:
+    """
+    Progressive morphological ground filter over the grid of a LAS file,
+    whose points arrive in one array or in chunks:
+
+        ground_filter = GroundFilter(las.header)
+        for chunk in chunks:
+            ground_filter.add(chunk.x, chunk.y, chunk.z, chunk.classification)
+        ground_filter.build()
+        ground_mask = ground_filter.classify(x, y, z, classification)
+
+    Points of the NOISE_CLASSES do not shape the surface and are never ground.
+    """
+
+    def __init__(self, header, cell_size=GROUND_CELL_SIZE, **parameters):
+        min_x, min_y = header.mins[0], header.mins[1]
+        n_cols = int(np.rint((header.maxs[0] - min_x) / cell_size)) + 1
+        n_rows = int(np.rint((header.maxs[1] - min_y) / cell_size)) + 1
+        self.cell_size = cell_size
+        self.parameters = parameters
+        self.accumulator = RasterAccumulator(min_x, min_y, n_rows, n_cols, cell_size, 'min')
+        self.ceiling = None
+
+    def add(self, x, y, z, classification):
+        """Add points to the surface of the lowest point of every cell."""
+        keep = ~np.isin(classification, NOISE_CLASSES)
+        self.accumulator.add(np.asarray(x)[keep], np.asarray(y)[keep], np.asarray(z)[keep])
+
+    def build(self):
+        """Fill the empty cells of the surface and compute the ground ceiling."""
+        min_surface = self.accumulator.result()
+        if np.all(np.isnan(min_surface)):
+            raise ValueError("No points to filter")
+        min_surface = fill_empty_cells(min_surface, method='nearest')
+        self.ceiling = ground_ceiling(min_surface, self.cell_size, **self.parameters)
+
+    def classify(self, x, y, z, classification):
+        """Mask of the ground points, at or below the ceiling of their cell."""
+        accumulator = self.accumulator
+        col = np.clip(np.rint((np.asarray(x) - accumulator.min_x) / self.cell_size).astype(np.int64), 0, accumulator.n_cols - 1)
+        row = np.clip(np.rint((np.asarray(y) - accumulator.min_y) / self.cell_size).astype(np.int64), 0, accumulator.n_rows - 1)
+        return (np.asarray(z) <= self.ceiling[row, col]) & ~np.isin(classification, NOISE_CLASSES)
+
+def ground_classes(classification, ground_mask):
+    """
+    Classification codes with the ground points set to GROUND_CLASS, former
+    ground points set to UNCLASSIFIED_CLASS and the other classes kept.
+    """
+    classification = np.asarray(classification)
+    reset = np.where(classification == GROUND_CLASS, UNCLASSIFIED_CLASS, classification)
+    return np.where(ground_mask, GROUND_CLASS, reset).astype(classification.dtype)
+
+def ground_las_path(las_path):
+    """Path of the classified copy of a LAS file, <name>.ground.las next to it."""
+    return os.path.splitext(las_path)[0] + GROUND_SUFFIX
+
+def survey_las_files(files):
+    """The survey LAS files among file names, leaving out their classified copies."""
+    return [f for f in files if f.endswith('.las') and not f.endswith(GROUND_SUFFIX)]
+
+def classified_las(las_path):
+    """
+    The classified copy of a LAS file if it exists and is not older than the
+    LAS, else the LAS itself.
+    """
+    ground_path = ground_las_path(las_path)
+    if os.path.exists(ground_path) and os.path.getmtime(ground_path) >= os.path.getmtime(las_path):
+        return ground_path
+    return las_path
+
+def has_ground(las_path, chunk_size=5_000_000):
+    """Whether any point of a LAS file is classified as ground; stops at the first chunk that has one."""
+    with laspy.open(las_path) as reader:
+        for chunk in reader.chunk_iterator(chunk_size):
+            if np.any(chunk.classification == GROUND_CLASS):
+                return True
+    return False
+
+def classify_ground(las_path, output_path=None, chunk_size=None, cell_size=GROUND_CELL_SIZE, in_place=False, **parameters):
+    """
+    Classify the ground points of a LAS file with the progressive morphological
+    filter (see ground_ceiling) and write their classification codes
+    (see ground_classes) to a LAS file.
+
+    Parameters
+    ----------
+    las_path : str
+        Path to the input LAS file.
+    output_path : str, optional
+        Path to the output LAS file. Default is <name>.ground.las next to the
+        input (see ground_las_path), which is left as it is.
+    chunk_size : int, optional
+        If given, stream the file twice in chunks of this many points, once
+        for the surface and once to classify and write, so memory is bounded
+        by the chunk size and the grid, not by the size of the file.
+    cell_size : float, optional
+        Cell size of the surface in map units. Default is 1.
+    in_place : bool, optional
+        If True, and no output_path is given, rewrite the input in place.
+    **parameters
+        max_window, slope, initial_threshold and max_threshold of ground_ceiling.
+
+    Returns
+    -------
+    n_ground : int
+        Number of ground points.
+    """
+    start_time = time.perf_counter()
+    if output_path is None and not in_place:
+        output_path = ground_las_path(las_path)
+    if output_path is None:
+        root, ext = os.path.splitext(las_path)
+        write_path = f"{root}.{os.getpid()}.tmp{ext}"
+    else:
+        write_path = output_path
+
+    if chunk_size is None:
+        las = laspy.read(las_path)
+        ground_filter = GroundFilter(las.header, cell_size, **parameters)
+        ground_filter.add(las.x, las.y, las.z, las.classification)
+        ground_filter.build()
+        ground_mask = ground_filter.classify(las.x, las.y, las.z, las.classification)
+        las.classification = ground_classes(las.classification, ground_mask)
+        las.write(write_path)
+        n_points = len(las.points)
+        n_ground = int(np.count_nonzero(ground_mask))
+    else:
+        # 1. Surface of the lowest points
+        with laspy.open(las_path) as reader:
+            ground_filter = GroundFilter(reader.header, cell_size, **parameters)
+            for chunk in reader.chunk_iterator(chunk_size):
+                ground_filter.add(chunk.x, chunk.y, chunk.z, chunk.classification)
+        ground_filter.build()
+
+        # 2. Classify and write chunk by chunk
+        n_points = 0
+        n_ground = 0
+        with laspy.open(las_path) as reader:
+            with laspy.open(write_path, mode='w', header=copy.deepcopy(reader.header)) as writer:
+                for chunk in reader.chunk_iterator(chunk_size):
+                    ground_mask = ground_filter.classify(chunk.x, chunk.y, chunk.z, chunk.classification)
+                    chunk.classification = ground_classes(chunk.classification, ground_mask)
+                    writer.write_points(chunk)
+                    n_points += len(chunk)
+                    n_ground += int(np.count_nonzero(ground_mask))
+
+    if output_path is None:
+        os.replace(write_path, las_path)
+    print(f"Classified {n_ground} of {n_points} points as ground: {output_path or las_path}")
+    report_throughput(n_points, start_time, label='Classified')
+    return n_ground
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Classify the ground points of the LAS files under data/ that have none, into <name>.ground.las next to them.")
+    parser.add_argument('las', nargs='*', help="LAS files to classify whether or not they have ground points; default, those under data/ without any")
+    parser.add_argument('--chunk-size', type=int, default=None, help="stream the LAS in chunks of this many points")
+    parser.add_argument('--cell-size', type=float, default=GROUND_CELL_SIZE, help="cell size of the surface")
+    parser.add_argument('--max-window', type=float, default=MAX_WINDOW, help="largest window, about the size of the largest building")
+    parser.add_argument('--slope', type=float, default=TERRAIN_SLOPE, help="largest terrain slope kept as ground")
+    parser.add_argument('--initial-threshold', type=float, default=INITIAL_THRESHOLD, help="elevation threshold of the first window")
+    parser.add_argument('--max-threshold', type=float, default=MAX_THRESHOLD, help="largest elevation threshold")
+    parser.add_argument('--in-place', action='store_true', help="rewrite the LAS files in place instead")
+    args = parser.parse_args()
+    parameters = dict(max_window=args.max_window, slope=args.slope, initial_threshold=args.initial_threshold, max_threshold=args.max_threshold)
+    las_paths = args.las
+    if len(las_paths) == 0:
+        for folder in natsorted(os.listdir('data')):
+            folder_path = os.path.join('data', folder)
+            if os.path.isdir(folder_path):
+                las_paths += [os.path.join(folder_path, f) for f in survey_las_files(natsorted(os.listdir(folder_path)))]
+        las_paths = [las_path for las_path in las_paths if classified_las(las_path) == las_path and not has_ground(las_path)]
+    for las_path in las_paths:
+        classify_ground(las_path, chunk_size=args.chunk_size, cell_size=args.cell_size, in_place=args.in_place, **parameters)
@@ -0,0 +1,135 @@
+import json
+import os
+import platform
+import sys
+import time
+from contextlib import contextmanager
+
+# The RunReport spans are recorded into, or None when instrumentation is off
+_active_report = None
+
+def peak_rss_mb():
+    """
+    Peak resident set size of the current process in megabytes,
+    or None where the resource module is unavailable (e.g., Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if sys.platform == 'darwin':
+        return rss / 1024 ** 2
+    return rss / 1024
+
+class RunReport:
+    """
+    Spans recorded while the report is active, e.g.,
+
+        with RunReport() as report:
+            with span('folder', folder='Bailey_20250125'):
+                process_folder('Bailey_20250125')
+        report.write('run_report.json')
+
+    Each span records its wall and CPU time, the peak RSS of the process when
+    it ended and how much the span raised it, the attributes set by the
+    instrumented code (array sizes, point counts, bytes written) and the
+    folder of the enclosing 'folder' span. The peak RSS is that of the whole
+    process, which only grows, so the growth is attributed to the first span
+    that reached a new peak.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._stack = []
+        self._previous = None
+        self.start_time = time.perf_counter()
+
+    def __enter__(self):
+        global _active_report
+        self._previous = _active_report
+        _active_report = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _active_report
+        _active_report = self._previous
+        return False
+
+    def extend(self, spans):
+        """Add spans recorded by another process, e.g., a worker of a process pool."""
+        self.spans.extend(spans)
+
+    def summary(self):
+        """Total wall and CPU time of each stage, per folder."""
+        folders = dict()
+        for record in self.spans:
+            stages = folders.setdefault(record['folder'], dict())
+            stage = stages.setdefault(record['path'], {'count': 0, 'wall_time': 0.0, 'cpu_time': 0.0})
+            stage['count'] += 1
+            stage['wall_time'] += record['wall_time']
+            stage['cpu_time'] += record['cpu_time']
+        return folders
+
+    def write(self, report_path):
+        """Write the spans and their per-folder summary to a JSON file."""
+        report = {
+            'info': {
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'argv': sys.argv,
+                'python': platform.python_version(),
+                'cpu_count': os.cpu_count(),
+                'wall_time': time.perf_counter() - self.start_time,
+                'peak_rss_mb': peak_rss_mb()
+            },
+            'folders': self.summary(),
+            'spans': self.spans
+        }
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+        print(f"Run report saved to: {report_path}")
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Time a stage of the pipeline into the active RunReport.
+
+    Yields a dict of attributes the stage can fill in, e.g.,
+
+        with span('read_dem', path=dem_path) as attrs:
+            dem_data = src.read(1)
+            attrs['cells'] = dem_data.size
+
+    Without an active report, the span costs a dict and records nothing.
+    """
+    report = _active_report
+    if report is None:
+        yield attrs
+        return
+
+    parent = report._stack[-1] if report._stack else None
+    record = {
+        'name': name,
+        'path': name if parent is None else f"{parent['path']}/{name}",
+        'folder': attrs.get('folder', parent['folder'] if parent else None),
+        'attrs': attrs
+    }
+    report._stack.append(record)
+    rss_before = peak_rss_mb()
+    cpu_start = time.process_time()
+    start_time = time.perf_counter()
+    try:
+        yield attrs
+    except BaseException as e:
+        record['error'] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        record['start'] = start_time - report.start_time
+        record['wall_time'] = time.perf_counter() - start_time
+        record['cpu_time'] = time.process_time() - cpu_start
+        record['peak_rss_mb'] = peak_rss_mb()
+        if rss_before is not None:
+            record['rss_growth_mb'] = record['peak_rss_mb'] - rss_before
+        report._stack.pop()
+        report.spans.append(record)
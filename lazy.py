@@ -0,0 +1,39 @@
+import importlib
+
+class LazyModule:
+    """
+    Stand-in for a module that is imported on first attribute access, e.g.,
+
+        rasterio = LazyModule('rasterio')
+        rasterio.open(path)  # rasterio is imported here
+
+    Heavy geospatial libraries (rasterio, laspy, cv2, scipy, matplotlib) take
+    from 0.1 to 0.7 s each to import, so the commands that do not use them,
+    such as sorting or cleaning, start without them.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self.__dict__['_name'])
+            self.__dict__['_module'] = module
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return f"<lazy module '{self.__dict__['_name']}'>"
+
+def lazy_function(module_name, name):
+    """
+    Callable that imports module_name on first call and forwards to its
+    attribute `name`, for names imported with `from module import name`.
+    """
+    def call(*args, **kwargs):
+        return getattr(importlib.import_module(module_name), name)(*args, **kwargs)
+    call.__name__ = name
+    call.__qualname__ = name
+    call.__doc__ = f"Lazily imported {module_name}.{name}."
+    return call
@@ -0,0 +1,262 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from natsort import natsorted
+
+from capacity_estimation import (
+    GRID_RESOLUTION, GRID_METHOD, GRID_PRODUCTS, FOOTPRINT_BUFFER,
+    check_capacity_csv, outdated_folders, prepare_folder, folder_result, record_outcome, print_timings, _capacity_curve
+)
+from results_store import ResultsStore
+from utils import (
+    laspy, read_region, read_dem, fill_dem, grid_points, dem_raster, parse_las_crs,
+    write_raster, output_creation_profile, defer_raster_writes
+)
+
+# Folders held between two stages, which bounds the point clouds and rasters in memory
+QUEUE_DEPTH = 2
+# Threads reading LAS files and rasters, and threads writing rasters
+IO_WORKERS = 2
+
+class Stage:
+    """
+    One stage of the pipeline: `threads` threads take jobs from `inbox`, run
+    `work` on each and put it into `outbox`. Jobs that failed or whose folder
+    is not ready pass through. A None job marks the end of the input; the
+    last thread to take it passes it on to the next stage.
+
+    The stage keeps the time its threads spent working and the depth of its
+    inbox each time a thread took a job.
+    """
+
+    def __init__(self, name, work, threads, inbox, outbox):
+        self.name = name
+        self.work = work
+        self.threads = threads
+        self.inbox = inbox
+        self.outbox = outbox
+        self.busy_time = 0.0
+        self.depths = []
+        self._running = threads
+        self._lock = threading.Lock()
+
+    def start(self):
+        for i in range(self.threads):
+            threading.Thread(target=self._run, name=f'{self.name}-{i}', daemon=True).start()
+
+    def _run(self):
+        while True:
+            self.depths.append(self.inbox.qsize())
+            job = self.inbox.get()
+            if job is None:
+                with self._lock:
+                    self._running -= 1
+                    last = self._running == 0
+                # wake the next thread of this stage, or the next stage
+                (self.outbox if last else self.inbox).put(None)
+                return
+            if job.get('error') is None and job.get('plan', True) is not None:
+                start_time = time.perf_counter()
+                try:
+                    job = self.work(job)
+                except Exception as e:
+                    job['error'] = f"{type(e).__name__}: {e}"
+                    # free the points and rasters of a failed folder
+                    job.pop('points', None)
+                    job.pop('rasters', None)
+                elapsed = time.perf_counter() - start_time
+                job.setdefault('stage_times', dict())[self.name] = elapsed
+                with self._lock:
+                    self.busy_time += elapsed
+            self.outbox.put(job)
+
+    def utilization(self, wall_time):
+        """Fraction of the wall time the threads of the stage spent working."""
+        return self.busy_time / (self.threads * wall_time) if wall_time > 0 else 0.0
+
+def read_folder(job, classify_ground=False):
+    """
+    I/O stage: check the folder and read its LAS points, or its DEM and DSM
+    if it is not regridded.
+    """
+    plan = prepare_folder(job['folder'], classify_ground=classify_ground)
+    job['plan'] = plan
+    if plan is None:
+        return job
+    if plan['las_file'] is None:
+        job['rasters'] = {'dem': read_dem(plan['dem_file']), 'dsm': read_dem(plan['dsm_file'])}
+        return job
+    if plan['footprint'] is None:
+        las = laspy.read(plan['las_file'])
+    else:
+        las = read_region(plan['las_file'], None, plan['footprint'], buffer=FOOTPRINT_BUFFER)
+    job['points'] = (
+        np.asarray(las.x), np.asarray(las.y), np.asarray(las.z),
+        np.asarray(las.classification), parse_las_crs(las.header)
+    )
+    return job
+
+def grid_rasters(plan, x, y, z, classification, crs_info, output_profile=None):
+    """
+    Grid the GRID_PRODUCTS of a folder from its points, as grid_folder does,
+    and queue their writes.
+
+    Returns
+    -------
+    rasters : dict
+        Maps 'dem' and 'dsm' to the read_dem tuple of each raster, with the
+        values as they will read back from the file, e.g., float32 in a COG.
+    """
+    rasters = dict()
+    for name, classification_filter in GRID_PRODUCTS.items():
+        keep = slice(None) if classification_filter is None else np.isin(classification, classification_filter)
+        grid_z, min_x, min_y = grid_points(
+            x[keep], y[keep], z[keep], GRID_RESOLUTION, GRID_METHOD, None, plan['footprint'], FOOTPRINT_BUFFER
+        )
+        grid_z, profile = dem_raster(grid_z, min_x, min_y, GRID_RESOLUTION, crs_info)
+        write_raster(os.path.join(plan['folder_path'], name), grid_z, profile, output_profile)
+        dtype = output_creation_profile(profile, output_profile)['dtype']
+        rasters[name.split('.')[0]] = (
+            grid_z.astype(dtype, copy=False), GRID_RESOLUTION, GRID_RESOLUTION, profile['nodata'], dict(profile, dtype=dtype)
+        )
+    return rasters
+
+def compute_folder(plan, points=None, rasters=None, output_profile=None):
+    """
+    CPU stage, run in a worker process: grid the DEM and DSM from the points,
+    if any, then fill them and estimate their capacities as process_folder does.
+
+    Returns
+    -------
+    capacities : dict
+        Maps the results_store.CAPACITY_KEYS to the folder's capacities.
+    writes : list
+        The (path, array, profile, output_profile) GeoTIFF writes of the folder,
+        for the I/O stage (see utils.defer_raster_writes).
+    """
+    elevations = [plan['spillway_height'], plan['crest_height']]
+    capacities = dict()
+    with defer_raster_writes() as writes:
+        if points is not None:
+            rasters = grid_rasters(plan, *points, output_profile)
+        for prefix, level in (('dsm', 'Lower'), ('dem', 'Upper')):
+            save_paths = [
+                (plan['spillway_height'], os.path.join(plan['folder_path'], f'{prefix}_spillway_masked.tif')),
+                (plan['crest_height'], os.path.join(plan['folder_path'], f'{prefix}_crest_masked.tif'))
+            ]
+            dem = fill_dem(*rasters[prefix], footprint=plan['footprint'], buffer=FOOTPRINT_BUFFER)
+            spillway_capacity, crest_capacity = _capacity_curve(dem, elevations, save_paths, output_profile, plan['outlet_xy'])
+            capacities[f'{level}_spillway_capacity'] = spillway_capacity
+            capacities[f'{level}_crest_capacity'] = crest_capacity
+    return capacities, writes
+
+def process_capacity_pipeline(workers=2, io_workers=IO_WORKERS, queue_depth=QUEUE_DEPTH, output_profile=None, classify_ground=False):
+    """
+    Estimate the capacities of every unprocessed folder under data/, as
+    capacity_estimation.process_capacity_estimation does, in a pipeline of
+    three stages, so that reading folder N+1 and writing folder N-1 overlap
+    computing folder N:
+
+    1. read: `io_workers` threads read the LAS points, or the DEM and DSM;
+    2. compute: `workers` processes grid, fill and contour the rasters;
+    3. write: `io_workers` threads write the rasters and hash the inputs.
+
+    Stages hand folders over through queues of at most `queue_depth` folders,
+    so a slow stage holds back the ones before it instead of piling up point
+    clouds in memory. Rasters are handed from gridding to contouring in
+    memory, without the GeoTIFF round trip. The utilization of each stage and
+    the depth of its queue are reported at the end.
+
+    Parameters
+    ----------
+    workers : int, optional
+        Number of worker processes of the compute stage. Default is 2.
+    io_workers : int, optional
+        Number of threads of each I/O stage. Default is 2.
+    queue_depth : int, optional
+        Capacity, in folders, of the queues between stages. Default is 2.
+    output_profile : {'cog', 'cog-zstd'}, optional
+        Compact layout of the rasters written (see utils.OUTPUT_PROFILES).
+    classify_ground : bool, optional
+        If True, the read stage classifies the ground points of the LAS files
+        that have none (see capacity_estimation.process_folder).
+    """
+    store = ResultsStore()
+    processed_data = check_capacity_csv(store)
+    print(f"Processed folders: {list(processed_data.keys())}")
+    outdated = outdated_folders(store)
+    folders = [
+        f for f in natsorted(os.listdir('data'))
+        if os.path.isdir(os.path.join('data', f)) and (f not in processed_data or f in outdated)
+    ]
+
+    executor = ProcessPoolExecutor(max_workers=workers)
+
+    def compute(job):
+        points, rasters = job.pop('points', None), job.pop('rasters', None)
+        job['capacities'], job['writes'] = executor.submit(compute_folder, job['plan'], points, rasters, output_profile).result()
+        return job
+
+    def write(job):
+        job['n_bytes'] = 0
+        for path, array, profile, write_profile in job.pop('writes'):
+            n_bytes = write_raster(path, array, profile, write_profile)
+            job['n_bytes'] += n_bytes
+            if os.path.basename(path) in GRID_PRODUCTS:
+                print(f"DEM saved to: {path} ({n_bytes} bytes)")
+        job['result'] = folder_result(job['plan'], job.pop('capacities'), output_profile)
+        return job
+
+    # 1. Wire the stages: the folder queue is filled up front, the others are bounded
+    inbox = queue.Queue()
+    queues = [inbox, queue.Queue(maxsize=queue_depth), queue.Queue(maxsize=queue_depth), queue.Queue()]
+    stages = [
+        Stage('read', lambda job: read_folder(job, classify_ground), io_workers, queues[0], queues[1]),
+        Stage('compute', compute, workers, queues[1], queues[2]),
+        Stage('write', write, io_workers, queues[2], queues[3])
+    ]
+    start_time = time.perf_counter()
+    for folder in folders:
+        inbox.put({'folder': folder})
+    inbox.put(None)
+    for stage in stages:
+        stage.start()
+
+    # 2. Record the folders in the order they finish; only this thread writes the store
+    timings = []
+    n_written = 0
+    try:
+        while True:
+            job = queues[-1].get()
+            if job is None:
+                break
+            # time spent on the folder by the stages, without the time it waited in queues
+            wall_time = sum(job.get('stage_times', dict()).values())
+            n_bytes = job.get('n_bytes', 0)
+            status = record_outcome(
+                store, job['folder'], job.get('result'), job.get('error'), wall_time, n_bytes, processed_data.get(job['folder'])
+            )
+            if status in ('done', 'updated'):
+                n_written += 1
+            timings.append((job['folder'], status, wall_time, n_bytes))
+    finally:
+        executor.shutdown(cancel_futures=True)
+        if n_written > 0:
+            store.export_csv()
+        store.close()
+    wall_time = time.perf_counter() - start_time
+
+    print_timings(timings)
+    print(f"Pipeline stages over {wall_time:.2f} s:")
+    for stage in stages:
+        depths = stage.depths or [0]
+        capacity = f" of {stage.inbox.maxsize}" if stage.inbox.maxsize > 0 else ''
+        print(
+            f"  {stage.name:<8} {stage.threads:3d} {'processes' if stage.name == 'compute' else 'threads':<9}"
+            f" busy {100 * stage.utilization(wall_time):5.1f}%"
+            f"  queue depth mean {np.mean(depths):4.1f} max {max(depths):3d}{capacity}"
+        )
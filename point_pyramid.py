@@ -0,0 +1,348 @@
+import argparse
+import csv
+import os
+import time
+
+import numpy as np
+from natsort import natsorted
+
+from cache import ContentCache, file_hash, DEFAULT_CACHE_DIR
+from capacity_estimation import GRID_METHOD, GRID_PRODUCTS, read_footprint, read_height_references, _capacity_curve, _load_filled_dem
+from ground_filter import classified_las, survey_las_files
+from instrumentation import span
+from lazy import LazyModule
+from utils import RasterAccumulator, OUTPUT_PROFILES, fill_empty_cells, parse_las_crs, write_dem, _keep_mask, report_throughput
+
+laspy = LazyModule('laspy')
+
+# Cell size of level 0 and number of levels; level k has cells of PYRAMID_BASE_RESOLUTION * 2 ** k
+PYRAMID_BASE_RESOLUTION = 0.125
+PYRAMID_LEVELS = 5
+PYRAMID_FILE = 'pyramid.npz'
+SWEEP_RESOLUTIONS = (0.25, 0.5, 1.0, 2.0)
+
+# Per-cell aggregates kept at every level
+FIELDS = ('rows', 'cols', 'count', 'x', 'y', 'z', 'z_min', 'z_max')
+
+def _reduce_cells(key, count, sum_x, sum_y, sum_z, z_min, z_max):
+    """Merge the aggregates that share a cell key; returns them sorted by key."""
+    order = np.argsort(key, kind='stable')
+    key = key[order]
+    starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+    return (
+        key[starts],
+        np.add.reduceat(count[order], starts),
+        np.add.reduceat(sum_x[order], starts),
+        np.add.reduceat(sum_y[order], starts),
+        np.add.reduceat(sum_z[order], starts),
+        np.minimum.reduceat(z_min[order], starts),
+        np.maximum.reduceat(z_max[order], starts)
+    )
+
+def _merge_parts(parts):
+    return _reduce_cells(*[np.concatenate(arrays) for arrays in zip(*parts)])
+
+class PointPyramid:
+    """
+    Voxel-thinned levels of a point cloud, one set of levels per product
+    (e.g., 'dem.tif' from the ground points and 'dsm.tif' from all points).
+
+    Level k bins the points into square cells of base_resolution * 2 ** k,
+    aligned on a common origin so that each cell of level k is made of exactly
+    four cells of level k - 1. Every occupied cell keeps its point count, the
+    mean x, y and z of its points, and their minimum and maximum z, so a
+    coarser level is built from the finer one without the raw points.
+
+    A DEM at resolution r is gridded from the coarsest level whose cells are
+    at most r / 2, by binning the cell means weighted by their point counts
+    (see dem), instead of from the full-density cloud.
+    """
+
+    def __init__(self, origin, base_resolution, levels, bounds, crs_wkt=None, source_hash=None):
+        self.origin = origin
+        self.base_resolution = base_resolution
+        self.levels = levels
+        self.bounds = bounds
+        self.crs_wkt = crs_wkt
+        self.source_hash = source_hash
+
+    @property
+    def products(self):
+        return list(self.levels.keys())
+
+    def cell_size(self, level):
+        return self.base_resolution * 2 ** level
+
+    def level_for(self, resolution):
+        """The coarsest level whose cells are at most half the resolution, else level 0."""
+        n_levels = len(next(iter(self.levels.values())))
+        level = 0
+        while level + 1 < n_levels and self.cell_size(level + 1) <= 0.5 * resolution + 1e-9:
+            level += 1
+        return level
+
+    def points(self, product, cell_size):
+        """
+        Mean x, y and z of the cells of the coarsest level whose cells are at
+        most cell_size, i.e., the points of a product thinned to about one per cell.
+        """
+        n_levels = len(self.levels[product])
+        level = 0
+        while level + 1 < n_levels and self.cell_size(level + 1) <= cell_size + 1e-9:
+            level += 1
+        cells = self.levels[product][level]
+        return cells['x'], cells['y'], cells['z']
+
+    def dem(self, product, resolution, method=GRID_METHOD, reducer='mean'):
+        """
+        Grid a product at a resolution from its pyramid level, on the grid
+        grid_points would span for the same points.
+
+        Parameters
+        ----------
+        product : str
+            Key of the product, e.g., 'dem.tif'.
+        resolution : float
+            Grid spacing.
+        method : {'linear', 'nearest', 'cubic'}, optional
+            Interpolation method of the empty cells (see utils.fill_empty_cells).
+        reducer : {'mean', 'min', 'max'}, optional
+            'mean' averages the points of each grid cell, through the count
+            weighted cell means; 'min' and 'max' take the extreme elevations.
+
+        Returns
+        -------
+        grid_z : 2D np.ndarray
+            Gridded elevations, row 0 at min_y, NaN where nothing could be interpolated.
+        min_x, min_y : float
+            Coordinates of grid node (0, 0).
+        """
+        if reducer not in ('mean', 'min', 'max'):
+            raise ValueError(f"Unknown pyramid reducer '{reducer}', expected 'mean', 'min' or 'max'")
+        level = self.levels[product][self.level_for(resolution)]
+        min_x, min_y, max_x, max_y = self.bounds[product]
+        n_cols = len(np.arange(min_x, max_x, resolution))
+        n_rows = len(np.arange(min_y, max_y, resolution))
+        accumulator = RasterAccumulator(min_x, min_y, n_rows, n_cols, resolution, reducer)
+        if reducer == 'mean':
+            accumulator.add(level['x'], level['y'], level['z'], weights=level['count'])
+        else:
+            accumulator.add(level['x'], level['y'], level['z_' + reducer])
+        with span('fill_empty_cells', cells=n_rows * n_cols, method=method):
+            grid_z = fill_empty_cells(accumulator.result(), method=method)
+        return grid_z, min_x, min_y
+
+    def save(self, path):
+        arrays = {
+            'origin': np.asarray(self.origin),
+            'base_resolution': np.asarray(self.base_resolution),
+            'products': np.asarray(self.products),
+            'crs_wkt': np.asarray(self.crs_wkt or ''),
+            'source_hash': np.asarray(self.source_hash or '')
+        }
+        for i, product in enumerate(self.products):
+            arrays[f'bounds_{i}'] = np.asarray(self.bounds[product])
+            for k, level in enumerate(self.levels[product]):
+                for field in FIELDS:
+                    arrays[f'{i}_{k}_{field}'] = level[field]
+        # write next to the file and rename, so a pyramid is never half written
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            products = [str(p) for p in arrays['products']]
+            levels = dict()
+            bounds = dict()
+            for i, product in enumerate(products):
+                bounds[product] = tuple(arrays[f'bounds_{i}'])
+                n_levels = sum(1 for name in arrays.files if name.startswith(f'{i}_') and name.endswith('_rows'))
+                levels[product] = [
+                    {field: arrays[f'{i}_{k}_{field}'] for field in FIELDS} for k in range(n_levels)
+                ]
+            return cls(
+                tuple(arrays['origin']), float(arrays['base_resolution']), levels, bounds,
+                str(arrays['crs_wkt']) or None, str(arrays['source_hash']) or None
+            )
+
+def build_pyramid(
+    las_path,
+    products=GRID_PRODUCTS,
+    base_resolution=PYRAMID_BASE_RESOLUTION,
+    n_levels=PYRAMID_LEVELS,
+    chunk_size=5_000_000
+):
+    """
+    Build the PointPyramid of a LAS file in one streamed read.
+
+    Parameters
+    ----------
+    las_path : str
+        Path to the input LAS/LAZ file.
+    products : dict, optional
+        Maps each product name to its list of classification codes to keep,
+        or None to use all points, as in utils.pointcloud2products.
+        Default is capacity_estimation.GRID_PRODUCTS.
+    base_resolution : float, optional
+        Cell size of level 0. Default is 0.125.
+    n_levels : int, optional
+        Number of levels. Default is 5, i.e., cells of 0.125 to 2 m.
+    chunk_size : int, optional
+        Number of points read per chunk. Default is 5,000,000.
+
+    Returns
+    -------
+    pyramid : PointPyramid
+    """
+    start_time = time.perf_counter()
+    top = base_resolution * 2 ** (n_levels - 1)
+    with span('build_pyramid', path=las_path) as attrs, laspy.open(las_path) as reader:
+        header = reader.header
+        # 1. Align the origin on the coarsest cells, so the levels nest
+        origin_x = np.floor(header.mins[0] / top) * top
+        origin_y = np.floor(header.mins[1] / top) * top
+        n_cols = int(np.ceil((header.maxs[0] - origin_x) / base_resolution)) + 1
+
+        # 2. Reduce each chunk to level 0 cells, merging the chunks as they pile up
+        parts = {product: [] for product in products}
+        bounds = {product: [np.inf, np.inf, -np.inf, -np.inf] for product in products}
+        n_read = 0
+        for chunk in reader.chunk_iterator(chunk_size):
+            n_read += len(chunk)
+            x, y, z = np.asarray(chunk.x), np.asarray(chunk.y), np.asarray(chunk.z)
+            for product, classification_filter in products.items():
+                keep_mask = _keep_mask(chunk, classification_filter, None)
+                if keep_mask is None:
+                    px, py, pz = x, y, z
+                else:
+                    px, py, pz = x[keep_mask], y[keep_mask], z[keep_mask]
+                if len(pz) == 0:
+                    continue
+                col = np.floor((px - origin_x) / base_resolution).astype(np.int64)
+                row = np.floor((py - origin_y) / base_resolution).astype(np.int64)
+                parts[product].append(_reduce_cells(row * n_cols + col, np.ones(len(pz), dtype=np.int64), px, py, pz, pz, pz))
+                if len(parts[product]) > 8:
+                    parts[product] = [_merge_parts(parts[product])]
+                bounds[product] = [
+                    min(bounds[product][0], px.min()), min(bounds[product][1], py.min()),
+                    max(bounds[product][2], px.max()), max(bounds[product][3], py.max())
+                ]
+        crs_info = parse_las_crs(header)
+        attrs['points'] = n_read
+
+    # 3. Coarsen level k - 1 into level k from its aggregates
+    levels = dict()
+    for product in products:
+        if len(parts[product]) == 0:
+            raise ValueError(f"No points of {product} in {las_path}")
+        key, count, sum_x, sum_y, sum_z, z_min, z_max = _merge_parts(parts[product])
+        rows, cols = key // n_cols, key % n_cols
+        levels[product] = []
+        for k in range(n_levels):
+            if k > 0:
+                rows, cols = rows // 2, cols // 2
+                key, count, sum_x, sum_y, sum_z, z_min, z_max = _reduce_cells(
+                    rows * n_cols + cols, count, sum_x, sum_y, sum_z, z_min, z_max
+                )
+                rows, cols = key // n_cols, key % n_cols
+            levels[product].append({
+                'rows': rows, 'cols': cols, 'count': count,
+                'x': sum_x / count, 'y': sum_y / count, 'z': sum_z / count,
+                'z_min': z_min, 'z_max': z_max
+            })
+    report_throughput(n_read, start_time, label='Pyramid built from')
+
+    crs_wkt = crs_info.to_wkt() if crs_info is not None else None
+    return PointPyramid((origin_x, origin_y), base_resolution, levels, {p: tuple(b) for p, b in bounds.items()}, crs_wkt)
+
+def load_pyramid(las_path, cache=None, **kwargs):
+    """
+    The PointPyramid of a LAS file, from pyramid.npz next to it while the
+    LAS content is unchanged, else built and saved there.
+
+    With a cache (see cache.ContentCache), the hash of the LAS is memoized, so
+    an unchanged LAS is not read at all.
+    """
+    pyramid_path = os.path.join(os.path.dirname(las_path), PYRAMID_FILE)
+    las_hash = cache.hash(las_path) if cache is not None else file_hash(las_path)
+    if os.path.exists(pyramid_path):
+        pyramid = PointPyramid.load(pyramid_path)
+        if pyramid.source_hash == las_hash:
+            return pyramid
+    pyramid = build_pyramid(las_path, **kwargs)
+    pyramid.source_hash = las_hash
+    pyramid.save(pyramid_path)
+    print(f"Pyramid saved to: {pyramid_path}")
+    return pyramid
+
+def resolution_sweep(folder_path, resolutions=SWEEP_RESOLUTIONS, cache=None, method=GRID_METHOD, output_profile=None):
+    """
+    Capacities of one survey folder at several grid resolutions, with the
+    DEM and DSM of every resolution gridded from the folder's PointPyramid.
+    The rasters are written to <folder>/resolution/ and the capacities to
+    <folder>/resolution_sensitivity.csv. The pool is delineated as in
+    process_folder, with the folder's outlet, footprint and VOLUME_METHOD.
+
+    Returns
+    -------
+    rows : list of list
+        [resolution, upper spillway, lower spillway, upper crest, lower crest
+        capacity] per resolution, as in capacity.csv, or None if the folder
+        has no single LAS file or no height references.
+    """
+    las_files = survey_las_files(os.listdir(folder_path))
+    if len(las_files) != 1 or not os.path.exists(os.path.join(folder_path, 'height_references.csv')):
+        return None
+    spillway_height, crest_height, outlet_xy = read_height_references(folder_path)
+    if spillway_height == 0 or crest_height == 0:
+        return None
+    footprint = read_footprint(folder_path)
+
+    pyramid = load_pyramid(classified_las(os.path.join(folder_path, las_files[0])), cache)
+    output_dir = os.path.join(folder_path, 'resolution')
+    os.makedirs(output_dir, exist_ok=True)
+    rows = []
+    for resolution in resolutions:
+        capacities = dict()
+        for product in pyramid.products:
+            grid_z, min_x, min_y = pyramid.dem(product, resolution, method)
+            dem_path = os.path.join(output_dir, f"{os.path.splitext(product)[0]}_{resolution:g}.tif")
+            write_dem(dem_path, grid_z, min_x, min_y, resolution, pyramid.crs_wkt, output_profile=output_profile)
+            dem = dem_path if footprint is None else _load_filled_dem(dem_path, footprint)
+            capacities[product] = _capacity_curve(dem, [spillway_height, crest_height], None, None, outlet_xy)
+        # the DEM bounds the capacities from above and the DSM from below, as in process_folder
+        rows.append([
+            resolution, capacities['dem.tif'][0], capacities['dsm.tif'][0],
+            capacities['dem.tif'][1], capacities['dsm.tif'][1]
+        ])
+
+    with open(os.path.join(folder_path, 'resolution_sensitivity.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Resolution', 'Upper_spillway_capacity', 'Lower_spillway_capacity', 'Upper_crest_capacity', 'Lower_crest_capacity'])
+        writer.writerows(rows)
+    return rows
+
+def process_resolution_sweep(resolutions=SWEEP_RESOLUTIONS, cache=None, folders=None, output_profile=None):
+    """Run resolution_sweep on every survey folder under data/ and print the capacities."""
+    if folders is None:
+        folders = [f for f in natsorted(os.listdir('data')) if os.path.isdir(os.path.join('data', f))]
+    for folder in folders:
+        rows = resolution_sweep(os.path.join('data', folder), resolutions, cache, output_profile=output_profile)
+        if rows is None:
+            continue
+        print(f"{folder}: crest capacity by resolution")
+        for resolution, _, _, upper_crest, lower_crest in rows:
+            print(f"  {resolution:6g} m {lower_crest:12.1f} - {upper_crest:12.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Capacity sensitivity to the grid resolution, from point pyramids of the LAS files under data/.")
+    parser.add_argument('--resolution', type=float, action='append', default=None, help=f"grid resolution (repeatable), default {', '.join(map(str, SWEEP_RESOLUTIONS))}")
+    parser.add_argument('--folder', action='append', default=None, help="only process this folder (repeatable)")
+    parser.add_argument('--cache', action='store_true', help="memoize the LAS hashes in the cache directory")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help="directory of the cache")
+    parser.add_argument('--output-profile', choices=sorted(OUTPUT_PROFILES), default=None, help="write float32, compressed, tiled rasters with overviews (COG)")
+    args = parser.parse_args()
+    cache = ContentCache(args.cache_dir) if args.cache else None
+    process_resolution_sweep(args.resolution or SWEEP_RESOLUTIONS, cache, args.folder, args.output_profile)
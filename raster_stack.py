@@ -0,0 +1,270 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+from lazy import LazyModule
+from utils import interpolate_nodata, largest_contour_mask, from_origin
+from capacity_estimation import GRID_RESOLUTION
+from change_detection import survey_folders, survey_source, source_bounds, snapped_grid, grid_on, dem_of_difference, write_changes
+
+rasterio_crs = LazyModule('rasterio.crs')
+
+DEFAULT_STACK_DIR = 'stack'
+
+class RasterStack:
+    """
+    Multi-temporal raster stack of one basin on disk.
+
+    The surveys are gridded onto one snapped grid (see change_detection.shared_grid)
+    and stored as a (time, row, col) float32 array in stack.f32, memory-mapped
+    on access, with NaN where a survey has no data. index.json records the grid
+    and the date and source of every layer, in increasing date order, so
+    stack.array[:, row, col] is the time series of a cell without a copy.
+    """
+
+    def __init__(self, stack_dir):
+        self.stack_dir = stack_dir
+        self.data_path = os.path.join(stack_dir, 'stack.f32')
+        self.index_path = os.path.join(stack_dir, 'index.json')
+        with open(self.index_path, 'r') as f:
+            self.index = json.load(f)
+        self._array = None
+
+    @classmethod
+    def create(cls, stack_dir, min_x, min_y, n_rows, n_cols, resolution, crs=None):
+        """Create an empty stack on the given grid."""
+        os.makedirs(stack_dir, exist_ok=True)
+        index = {
+            'min_x': float(min_x),
+            'min_y': float(min_y),
+            'n_rows': int(n_rows),
+            'n_cols': int(n_cols),
+            'resolution': float(resolution),
+            'crs': rasterio_crs.CRS.from_user_input(crs).to_wkt() if crs else None,
+            'dates': [],
+            'sources': []
+        }
+        open(os.path.join(stack_dir, 'stack.f32'), 'wb').close()
+        _write_index(os.path.join(stack_dir, 'index.json'), index)
+        return cls(stack_dir)
+
+    @property
+    def dates(self):
+        return self.index['dates']
+
+    @property
+    def shape(self):
+        return (len(self.dates), self.index['n_rows'], self.index['n_cols'])
+
+    @property
+    def transform(self):
+        """Affine transform of the grid, row 0 at min_y as written by utils.write_dem."""
+        resolution = self.index['resolution']
+        return from_origin(self.index['min_x'], self.index['min_y'], resolution, -resolution)
+
+    @property
+    def array(self):
+        """The (time, row, col) array, memory-mapped read-only."""
+        if self._array is None:
+            if len(self.dates) == 0:
+                return np.empty(self.shape, dtype=np.float32)
+            self._array = np.memmap(self.data_path, dtype=np.float32, mode='r', shape=self.shape)
+        return self._array
+
+    def bounds(self):
+        """(min_x, min_y, max_x, max_y) of the grid nodes."""
+        resolution = self.index['resolution']
+        return (
+            self.index['min_x'],
+            self.index['min_y'],
+            self.index['min_x'] + (self.index['n_cols'] - 1) * resolution,
+            self.index['min_y'] + (self.index['n_rows'] - 1) * resolution
+        )
+
+    def cell(self, x, y):
+        """(row, col) of the grid node nearest to a map coordinate."""
+        resolution = self.index['resolution']
+        col = int(np.rint((x - self.index['min_x']) / resolution))
+        row = int(np.rint((y - self.index['min_y']) / resolution))
+        if not (0 <= row < self.index['n_rows'] and 0 <= col < self.index['n_cols']):
+            raise ValueError(f"({x}, {y}) is outside the stack")
+        return row, col
+
+    def layer(self, date):
+        """Elevations of one survey date, a view into the memory map."""
+        return self.array[self.dates.index(date)]
+
+    def series(self, x, y):
+        """Dates and elevations of the cell nearest to (x, y), a view into the memory map."""
+        row, col = self.cell(x, y)
+        return self.dates, self.array[:, row, col]
+
+    def filled(self, date):
+        """
+        One layer in the form of utils.load_filled_dem, for utils.capacity_curve
+        and the other volume functions: the NaN holes interpolated, and the
+        largest region of valid data kept, 9999 outside.
+        """
+        layer = self.layer(date)
+        valid = ~np.isnan(layer)
+        dem_filled = interpolate_nodata(np.asarray(layer), np.nan)
+        dem_filled = np.where(largest_contour_mask(valid), dem_filled, 9999)
+        resolution = self.index['resolution']
+        profile = {
+            'driver': 'GTiff',
+            'height': self.index['n_rows'],
+            'width': self.index['n_cols'],
+            'count': 1,
+            'dtype': 'float64',
+            'nodata': 9999,
+            'transform': self.transform,
+            'crs': self.index['crs']
+        }
+        return dem_filled, resolution, resolution, profile
+
+    def differences(self, min_change=0.0):
+        """DEM of difference between consecutive dates, see change_detection.dem_of_difference."""
+        resolution = self.index['resolution']
+        return dem_of_difference(self.array, resolution * resolution, min_change)
+
+    def covers(self, bounds):
+        """Whether (min_x, min_y, max_x, max_y) lies within the grid."""
+        own = self.bounds()
+        return bounds[0] >= own[0] and bounds[1] >= own[1] and bounds[2] <= own[2] and bounds[3] <= own[3]
+
+    def expand(self, bounds):
+        """
+        Widen the grid by whole cells to cover bounds, copying the layers over.
+        The nodes are snapped, so existing layers move by whole cells and are
+        not resampled.
+        """
+        resolution = self.index['resolution']
+        min_x, min_y, n_rows, n_cols = snapped_grid([self.bounds(), bounds], resolution)
+        row0 = int(round((self.index['min_y'] - min_y) / resolution))
+        col0 = int(round((self.index['min_x'] - min_x) / resolution))
+        if len(self.dates) > 0:
+            old = self.array
+            tmp_path = self.data_path + '.tmp'
+            new = np.memmap(tmp_path, dtype=np.float32, mode='w+', shape=(len(self.dates), n_rows, n_cols))
+            new[:] = np.nan
+            new[:, row0:row0 + old.shape[1], col0:col0 + old.shape[2]] = old
+            new.flush()
+            del new, old
+            self._array = None
+            os.replace(tmp_path, self.data_path)
+        self.index.update({'min_x': float(min_x), 'min_y': float(min_y), 'n_rows': n_rows, 'n_cols': n_cols})
+        _write_index(self.index_path, self.index)
+
+    def append(self, date, grid_z, source=None):
+        """
+        Add the layer of a survey date, gridded on this stack's grid.
+
+        Layers arrive in date order in the usual case and are appended to the
+        end of stack.f32; an older date is inserted, which rewrites the file.
+        """
+        if date in self.dates:
+            raise ValueError(f"Date {date} is already in the stack")
+        layer = np.asarray(grid_z, dtype=np.float32)
+        if layer.shape != self.shape[1:]:
+            raise ValueError(f"Layer of shape {layer.shape} does not match the grid {self.shape[1:]}")
+
+        position = int(np.searchsorted(self.dates, date))
+        self._array = None
+        if position == len(self.dates):
+            with open(self.data_path, 'ab') as f:
+                f.write(layer.tobytes())
+        else:
+            old = np.memmap(self.data_path, dtype=np.float32, mode='r', shape=self.shape)
+            tmp_path = self.data_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(old[:position].tobytes())
+                f.write(layer.tobytes())
+                f.write(old[position:].tobytes())
+            del old
+            os.replace(tmp_path, self.data_path)
+        self.index['dates'].insert(position, int(date))
+        self.index['sources'].insert(position, source)
+        _write_index(self.index_path, self.index)
+
+def _write_index(index_path, index):
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_path, index_path)
+
+def update_stack(basin, surveys, stack_root=DEFAULT_STACK_DIR, resolution=GRID_RESOLUTION):
+    """
+    Open the stack of a basin and append the survey dates it does not hold yet.
+
+    Parameters
+    ----------
+    basin : str
+        Basin name.
+    surveys : list of (int, str)
+        (date, folder path) of each survey.
+    stack_root : str, optional
+        The stack lives in <stack_root>/<basin>/.
+    resolution : float, optional
+        Grid spacing of a new stack. Default is GRID_RESOLUTION.
+
+    Returns
+    -------
+    stack : RasterStack
+    """
+    stack_dir = os.path.join(stack_root, basin)
+    new_surveys = [(date, survey_source(folder_path)) for date, folder_path in surveys]
+    if os.path.exists(os.path.join(stack_dir, 'index.json')):
+        stack = RasterStack(stack_dir)
+        new_surveys = [(date, path) for date, path in new_surveys if date not in stack.dates]
+    else:
+        stack = None
+    if len(new_surveys) == 0:
+        return stack
+
+    bounds = [source_bounds(path) for _, path in new_surveys]
+    if stack is None:
+        min_x, min_y, n_rows, n_cols = snapped_grid(bounds, resolution)
+        stack = RasterStack.create(stack_dir, min_x, min_y, n_rows, n_cols, resolution)
+    else:
+        bounds = np.asarray(bounds)
+        union = (bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max())
+        if not stack.covers(union):
+            stack.expand(union)
+
+    min_x, min_y, n_rows, n_cols = stack.index['min_x'], stack.index['min_y'], stack.index['n_rows'], stack.index['n_cols']
+    for date, path in new_surveys:
+        grid_z, crs_info = grid_on(path, min_x, min_y, n_rows, n_cols, stack.index['resolution'])
+        if stack.index['crs'] is None and crs_info:
+            stack.index['crs'] = rasterio_crs.CRS.from_user_input(crs_info).to_wkt()
+        stack.append(date, grid_z, source=path)
+        print(f"Appended {date} to the stack of {basin} ({len(stack.dates)} dates)")
+    return stack
+
+def process_stacks(stack_root=DEFAULT_STACK_DIR, resolution=GRID_RESOLUTION, basins=None, changes_dir=None, min_change=0.0):
+    """
+    Run update_stack for every basin under data/. With changes_dir, also write
+    the DEMs of difference of each stack, as change_detection.py does.
+    """
+    for basin, surveys in survey_folders().items():
+        if basins is not None and basin not in basins:
+            continue
+        stack = update_stack(basin, surveys, stack_root, resolution)
+        if changes_dir is None or stack is None or len(stack.dates) < 2:
+            continue
+        dod, deposition, erosion = stack.differences(min_change)
+        write_changes(
+            os.path.join(changes_dir, basin), stack.dates, dod, deposition, erosion,
+            stack.index['min_x'], stack.index['min_y'], stack.index['resolution'], stack.index['crs']
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Append new survey dates to the raster stack of each basin under data/.")
+    parser.add_argument('--stack-dir', default=DEFAULT_STACK_DIR, help="root directory of the stacks")
+    parser.add_argument('--resolution', type=float, default=GRID_RESOLUTION, help="grid spacing of new stacks")
+    parser.add_argument('--basin', action='append', default=None, help="only process this basin (repeatable)")
+    parser.add_argument('--changes-dir', default=None, help="also write the DEMs of difference from the stacks to this directory")
+    parser.add_argument('--min-change', type=float, default=0.0, help="level of detection of the DEMs of difference")
+    args = parser.parse_args()
+    process_stacks(args.stack_dir, args.resolution, args.basin, args.changes_dir, args.min_change)
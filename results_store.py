@@ -0,0 +1,168 @@
+import csv
+import json
+import os
+import sqlite3
+import time
+
+DEFAULT_DB_PATH = 'data/capacity.sqlite'
+DEFAULT_CSV_PATH = 'data/capacity.csv'
+
+# capacity.csv columns, in order, as keys of a result dict
+CAPACITY_KEYS = ['Upper_spillway_capacity', 'Lower_spillway_capacity', 'Upper_crest_capacity', 'Lower_crest_capacity']
+CSV_HEADER = 'Name, Date, Upper_spillway_capacity, Lower_spillway_capacity, Upper_crest_capacity, Lower_crest_capacity\n'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS capacities (
+    name TEXT PRIMARY KEY,
+    basin TEXT NOT NULL,
+    date INTEGER NOT NULL,
+    upper_spillway_capacity REAL,
+    lower_spillway_capacity REAL,
+    upper_crest_capacity REAL,
+    lower_crest_capacity REAL,
+    parameters TEXT,
+    inputs TEXT,
+    timings TEXT,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS capacities_basin_date ON capacities (basin, date);
+"""
+
+class ResultsStore:
+    """
+    Capacity results in an embedded SQLite database, one row per survey folder.
+
+    Rows are keyed by folder name and indexed by (basin, date), so lookups and
+    upserts are O(log n) and a new survey never rewrites the history.
+    Each row also keeps its provenance as JSON: the processing parameters, the
+    hashes of the input files and the timings of the run that produced it.
+    capacity.csv is kept as an export for the scripts and people that read it.
+
+    On first use, the rows of an existing capacity.csv are imported.
+    """
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, csv_path=DEFAULT_CSV_PATH):
+        self.db_path = db_path
+        is_new = not os.path.exists(db_path)
+        self.connection = sqlite3.connect(db_path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+        if is_new and csv_path is not None and os.path.exists(csv_path):
+            self.import_csv(csv_path)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def upsert(self, result, parameters=None, inputs=None, timings=None):
+        """
+        Insert or update the row of a result dict from process_folder
+        ('Name', 'Date' and CAPACITY_KEYS), with its provenance.
+        """
+        name = result['Name'].strip()
+        with self.connection:
+            self.connection.execute(
+                """
+                INSERT INTO capacities (
+                    name, basin, date, upper_spillway_capacity, lower_spillway_capacity,
+                    upper_crest_capacity, lower_crest_capacity, parameters, inputs, timings, updated_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET
+                    basin = excluded.basin,
+                    date = excluded.date,
+                    upper_spillway_capacity = excluded.upper_spillway_capacity,
+                    lower_spillway_capacity = excluded.lower_spillway_capacity,
+                    upper_crest_capacity = excluded.upper_crest_capacity,
+                    lower_crest_capacity = excluded.lower_crest_capacity,
+                    parameters = COALESCE(excluded.parameters, parameters),
+                    inputs = COALESCE(excluded.inputs, inputs),
+                    timings = COALESCE(excluded.timings, timings),
+                    updated_at = excluded.updated_at
+                """,
+                (
+                    name, name.split('_')[0], int(result['Date']),
+                    *[float(result[key]) for key in CAPACITY_KEYS],
+                    _to_json(parameters), _to_json(inputs), _to_json(timings),
+                    time.strftime('%Y-%m-%dT%H:%M:%S')
+                )
+            )
+
+    def get(self, name):
+        """The capacities of one folder as a dict, or None."""
+        row = self.connection.execute('SELECT * FROM capacities WHERE name = ?', (name,)).fetchone()
+        return None if row is None else _row_dict(row)
+
+    def capacities(self):
+        """
+        {name: {'Date': date, <CAPACITY_KEYS>: value}} of every folder, the
+        form check_capacity_csv used to parse out of capacity.csv.
+        """
+        rows = self.connection.execute('SELECT * FROM capacities ORDER BY name')
+        return {row['name']: _row_dict(row) for row in rows}
+
+    def basin(self, basin):
+        """{date: capacities} of one basin, in date order."""
+        rows = self.connection.execute('SELECT * FROM capacities WHERE basin = ? ORDER BY date', (basin,))
+        return {row['date']: _row_dict(row) for row in rows}
+
+    def basins(self):
+        """Names of the basins in the store."""
+        return [row[0] for row in self.connection.execute('SELECT DISTINCT basin FROM capacities ORDER BY basin')]
+
+    def provenance(self, name):
+        """Parameters, input hashes and timings recorded with a folder's row, or None."""
+        row = self.connection.execute(
+            'SELECT parameters, inputs, timings, updated_at FROM capacities WHERE name = ?', (name,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            'parameters': _from_json(row['parameters']),
+            'inputs': _from_json(row['inputs']),
+            'timings': _from_json(row['timings']),
+            'updated_at': row['updated_at']
+        }
+
+    def import_csv(self, csv_path=DEFAULT_CSV_PATH):
+        """Upsert the rows of a capacity.csv, without provenance."""
+        with open(csv_path, 'r') as f:
+            reader = csv.reader(f)
+            # skip the header
+            next(reader, None)
+            for row in reader:
+                if len(row) < 6:
+                    continue
+                result = {'Name': row[0], 'Date': int(row[1])}
+                result.update({key: float(value) for key, value in zip(CAPACITY_KEYS, row[2:6])})
+                self.upsert(result)
+
+    def export_csv(self, csv_path=DEFAULT_CSV_PATH):
+        """Write capacity.csv, sorted by name, from the store."""
+        tmp_path = f"{csv_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(CSV_HEADER)
+            for name, capacities in self.capacities().items():
+                values = ', '.join(str(capacities[key]) for key in CAPACITY_KEYS)
+                f.write(f"{name}, {capacities['Date']}, {values}\n")
+        os.replace(tmp_path, csv_path)
+
+def _row_dict(row):
+    return {
+        'Date': row['date'],
+        'Upper_spillway_capacity': row['upper_spillway_capacity'],
+        'Lower_spillway_capacity': row['lower_spillway_capacity'],
+        'Upper_crest_capacity': row['upper_crest_capacity'],
+        'Lower_crest_capacity': row['lower_crest_capacity']
+    }
+
+def _to_json(value):
+    return None if value is None else json.dumps(value, sort_keys=True, default=str)
+
+def _from_json(text):
+    return None if text is None else json.loads(text)
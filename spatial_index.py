@@ -0,0 +1,353 @@
+import argparse
+import copy
+import os
+import time
+
+import numpy as np
+from natsort import natsorted
+
+from lazy import LazyModule
+
+laspy = LazyModule('laspy')
+
+# The leaf tiles are a 2 ** INDEX_DEPTH by 2 ** INDEX_DEPTH grid over the LAS bounds
+INDEX_DEPTH = 6
+INDEX_DEPTH_MAX = 16
+INDEX_SUFFIX = '.index.npz'
+# Runs of points closer than this are read through rather than seeked over
+MAX_GAP = 4096
+
+def points_in_polygon(x, y, polygon):
+    """
+    Even-odd test of points against a polygon.
+
+    Parameters
+    ----------
+    x, y : 1D np.ndarray
+        Point coordinates.
+    polygon : array_like
+        (n, 2) vertices of the polygon, in order, closed or not.
+
+    Returns
+    -------
+    inside : 1D np.ndarray of bool
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    polygon = np.asarray(polygon, dtype=float)
+    inside = np.zeros(len(x), dtype=bool)
+    x0, y0 = polygon[-1]
+    for x1, y1 in polygon:
+        # only the points whose horizontal ray crosses the edge's y range
+        crossing = np.flatnonzero((y1 > y) != (y0 > y))
+        x_cross = x0 + (y[crossing] - y0) * (x1 - x0) / (y1 - y0)
+        inside[crossing[x[crossing] < x_cross]] ^= True
+        x0, y0 = x1, y1
+    return inside
+
+def distance_to_polygon(x, y, polygon):
+    """Distance from each point to the nearest edge of a polygon."""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    polygon = np.asarray(polygon, dtype=float)
+    squared = np.full(len(x), np.inf)
+    x0, y0 = polygon[-1]
+    for x1, y1 in polygon:
+        dx, dy = x1 - x0, y1 - y0
+        # nearest point of the edge, as a fraction t along it
+        t = np.clip(((x - x0) * dx + (y - y0) * dy) / max(dx * dx + dy * dy, 1e-12), 0, 1)
+        squared = np.minimum(squared, (x - x0 - t * dx) ** 2 + (y - y0 - t * dy) ** 2)
+        x0, y0 = x1, y1
+    return np.sqrt(squared)
+
+def region_mask(x, y, bounds=None, polygon=None, buffer=0.0):
+    """
+    Points inside the (min_x, min_y, max_x, max_y) bounds and the polygon, when
+    given, both widened by buffer.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    mask = np.ones(len(x), dtype=bool)
+    if bounds is not None:
+        mask &= (x >= bounds[0] - buffer) & (y >= bounds[1] - buffer) & (x <= bounds[2] + buffer) & (y <= bounds[3] + buffer)
+    if polygon is not None:
+        candidates = np.flatnonzero(mask)
+        inside = points_in_polygon(x[candidates], y[candidates], polygon)
+        if buffer > 0:
+            outside = np.flatnonzero(~inside)
+            inside[outside] = distance_to_polygon(x[candidates[outside]], y[candidates[outside]], polygon) <= buffer
+        mask[candidates] = inside
+    return mask
+
+def _morton(row, col):
+    """Interleave the bits of row and col into quadtree order."""
+    code = np.zeros(np.shape(row), dtype=np.int64)
+    row = np.asarray(row, dtype=np.int64)
+    col = np.asarray(col, dtype=np.int64)
+    for bit in range(INDEX_DEPTH_MAX):
+        code |= ((col >> bit) & 1) << (2 * bit)
+        code |= ((row >> bit) & 1) << (2 * bit + 1)
+    return code
+
+def _coalesce(tiles, starts, ends, max_gap):
+    """
+    Sort point ranges by tile and start, and merge the ranges of a tile whose
+    gap is at most max_gap points.
+    """
+    order = np.lexsort((starts, tiles))
+    tiles, starts, ends = tiles[order], starts[order], ends[order]
+    new = np.r_[True, (tiles[1:] != tiles[:-1]) | (starts[1:] - ends[:-1] > max_gap)]
+    first = np.flatnonzero(new)
+    return tiles[first], starts[first], np.maximum.reduceat(ends, first)
+
+class SpatialIndex:
+    """
+    Point ranges of a LAS file per tile, stored next to it as <name>.index.npz.
+
+    The bounds of the LAS are split into a 2 ** depth by 2 ** depth grid of
+    leaf tiles numbered in quadtree (Morton) order. For each tile, the index
+    keeps the ranges [start, end) of point indices that hold its points, with
+    gaps of at most max_gap points read through. A query seeks to and reads
+    only the ranges of the tiles that intersect the region, then drops the
+    points outside it, so the I/O follows the size of the region rather than
+    of the file.
+
+    How few ranges a tile needs depends on the point order. Points in flight
+    line order give long runs; sort_las rewrites a LAS in tile order, after
+    which every tile, and every quadtree node, is a single range.
+    """
+
+    def __init__(self, bounds, depth, tiles, starts, ends, n_points, source_size=None, source_mtime_ns=None):
+        self.bounds = tuple(bounds)
+        self.depth = depth
+        self.tiles = tiles
+        self.starts = starts
+        self.ends = ends
+        self.n_points = n_points
+        self.source_size = source_size
+        self.source_mtime_ns = source_mtime_ns
+
+    @property
+    def n_tiles(self):
+        return 2 ** self.depth
+
+    def tile_size(self):
+        return (
+            max(self.bounds[2] - self.bounds[0], 1e-9) / self.n_tiles,
+            max(self.bounds[3] - self.bounds[1], 1e-9) / self.n_tiles
+        )
+
+    def tile_of(self, x, y):
+        """Quadtree code of the leaf tile of each point."""
+        tile_width, tile_height = self.tile_size()
+        col = np.clip(((np.asarray(x) - self.bounds[0]) / tile_width).astype(np.int64), 0, self.n_tiles - 1)
+        row = np.clip(((np.asarray(y) - self.bounds[1]) / tile_height).astype(np.int64), 0, self.n_tiles - 1)
+        return _morton(row, col)
+
+    def tiles_in(self, bounds):
+        """Quadtree codes of the leaf tiles that intersect (min_x, min_y, max_x, max_y)."""
+        if bounds[2] < self.bounds[0] or bounds[0] > self.bounds[2] or bounds[3] < self.bounds[1] or bounds[1] > self.bounds[3]:
+            return np.zeros(0, dtype=np.int64)
+        tile_width, tile_height = self.tile_size()
+        col0, col1 = [int(np.clip(np.floor((b - self.bounds[0]) / tile_width), 0, self.n_tiles - 1)) for b in (bounds[0], bounds[2])]
+        row0, row1 = [int(np.clip(np.floor((b - self.bounds[1]) / tile_height), 0, self.n_tiles - 1)) for b in (bounds[1], bounds[3])]
+        rows, cols = np.meshgrid(np.arange(row0, row1 + 1), np.arange(col0, col1 + 1), indexing='ij')
+        return np.sort(_morton(rows.ravel(), cols.ravel()))
+
+    def ranges(self, bounds, max_gap=MAX_GAP):
+        """
+        Sorted, disjoint [start, end) point ranges covering every point in the
+        tiles that intersect the bounds.
+        """
+        selected = np.isin(self.tiles, self.tiles_in(bounds))
+        if not np.any(selected):
+            return np.zeros((0, 2), dtype=np.int64)
+        starts, ends = self.starts[selected], self.ends[selected]
+        _, starts, ends = _coalesce(np.zeros(len(starts), dtype=np.int64), starts, ends, max_gap)
+        return np.column_stack((starts, ends))
+
+    def is_current(self, las_path):
+        """Whether the LAS file is unchanged since the index was built."""
+        stat = os.stat(las_path)
+        return stat.st_size == self.source_size and stat.st_mtime_ns == self.source_mtime_ns
+
+    def save(self, path):
+        # write next to the file and rename, so an index is never half written
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_path, bounds=np.asarray(self.bounds), depth=self.depth, tiles=self.tiles,
+            starts=self.starts, ends=self.ends, n_points=self.n_points,
+            source_size=self.source_size, source_mtime_ns=self.source_mtime_ns
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(
+                arrays['bounds'], int(arrays['depth']), arrays['tiles'], arrays['starts'], arrays['ends'],
+                int(arrays['n_points']), int(arrays['source_size']), int(arrays['source_mtime_ns'])
+            )
+
+def index_path(las_path):
+    return os.path.splitext(las_path)[0] + INDEX_SUFFIX
+
+def build_index(las_path, depth=INDEX_DEPTH, max_gap=MAX_GAP, chunk_size=5_000_000):
+    """
+    Build and save the SpatialIndex of a LAS file in one streamed read.
+
+    Parameters
+    ----------
+    las_path : str
+        Path to the LAS/LAZ file.
+    depth : int, optional
+        Depth of the quadtree; the leaf tiles are a 2 ** depth square grid. Default is 6.
+    max_gap : int, optional
+        Ranges of a tile separated by at most this many points are merged. Default is 4096.
+    chunk_size : int, optional
+        Number of points read per chunk. Default is 5,000,000.
+
+    Returns
+    -------
+    index : SpatialIndex
+    """
+    if depth > INDEX_DEPTH_MAX:
+        raise ValueError(f"depth must be at most {INDEX_DEPTH_MAX}")
+    start_time = time.perf_counter()
+    stat = os.stat(las_path)
+    with laspy.open(las_path) as reader:
+        header = reader.header
+        bounds = (header.mins[0], header.mins[1], header.maxs[0], header.maxs[1])
+        index = SpatialIndex(bounds, depth, None, None, None, header.point_count, stat.st_size, stat.st_mtime_ns)
+        parts = []
+        offset = 0
+        for chunk in reader.chunk_iterator(chunk_size):
+            # 1. Runs of consecutive points in the same tile
+            tiles = index.tile_of(chunk.x, chunk.y)
+            run_starts = np.flatnonzero(np.r_[True, tiles[1:] != tiles[:-1]])
+            run_ends = np.r_[run_starts[1:], len(tiles)]
+            parts.append(_coalesce(tiles[run_starts], run_starts + offset, run_ends + offset, max_gap))
+            offset += len(chunk)
+
+    # 2. Merge the runs of each tile across chunks
+    index.tiles, index.starts, index.ends = _coalesce(*[np.concatenate(arrays) for arrays in zip(*parts)], max_gap)
+    index.save(index_path(las_path))
+    elapsed = time.perf_counter() - start_time
+    print(f"Index saved to: {index_path(las_path)} ({len(index.tiles)} ranges over "
+          f"{len(np.unique(index.tiles))} tiles, {index.n_points / max(len(index.tiles), 1):,.0f} points per range, {elapsed:.2f} s)")
+    return index
+
+def load_index(las_path, **kwargs):
+    """The SpatialIndex of a LAS file, built if it is missing or older than the file."""
+    path = index_path(las_path)
+    if os.path.exists(path):
+        index = SpatialIndex.load(path)
+        if index.is_current(las_path):
+            return index
+    return build_index(las_path, **kwargs)
+
+def region_bounds(bounds=None, polygon=None, buffer=0.0):
+    """
+    (min_x, min_y, max_x, max_y) of the intersection of the bounds and the
+    polygon's bounding box, widened by buffer.
+    """
+    if polygon is None:
+        return (bounds[0] - buffer, bounds[1] - buffer, bounds[2] + buffer, bounds[3] + buffer)
+    polygon = np.asarray(polygon, dtype=float)
+    polygon_bounds = (
+        polygon[:, 0].min() - buffer, polygon[:, 1].min() - buffer,
+        polygon[:, 0].max() + buffer, polygon[:, 1].max() + buffer
+    )
+    if bounds is None:
+        return polygon_bounds
+    bounds = (bounds[0] - buffer, bounds[1] - buffer, bounds[2] + buffer, bounds[3] + buffer)
+    return (
+        max(bounds[0], polygon_bounds[0]), max(bounds[1], polygon_bounds[1]),
+        min(bounds[2], polygon_bounds[2]), min(bounds[3], polygon_bounds[3])
+    )
+
+def iter_region(las_path, bounds=None, polygon=None, chunk_size=5_000_000, index=None, buffer=0.0):
+    """
+    Yield the points of a LAS file inside a region, in chunks of at most
+    chunk_size points read, using its SpatialIndex.
+
+    Parameters
+    ----------
+    las_path : str
+        Path to the LAS/LAZ file.
+    bounds : tuple of float, optional
+        (min_x, min_y, max_x, max_y) of the region.
+    polygon : array_like, optional
+        (n, 2) vertices of the region. With bounds too, the region is their intersection.
+    chunk_size : int, optional
+        Largest number of points read at once.
+    index : SpatialIndex, optional
+        Default is load_index(las_path).
+    buffer : float, optional
+        Width by which the region is widened. Default is 0.
+
+    Yields
+    ------
+    points : laspy.ScaleAwarePointRecord
+        Points inside the region.
+    """
+    index = index or load_index(las_path)
+    with laspy.open(las_path) as reader:
+        for start, end in index.ranges(region_bounds(bounds, polygon, buffer)):
+            reader.seek(int(start))
+            remaining = int(end - start)
+            while remaining > 0:
+                points = reader.read_points(min(remaining, chunk_size))
+                remaining -= len(points)
+                mask = region_mask(np.asarray(points.x), np.asarray(points.y), bounds, polygon, buffer)
+                yield points[mask]
+
+def read_region(las_path, bounds=None, polygon=None, index=None, buffer=0.0):
+    """
+    The points of a LAS file inside a region (see iter_region), as a
+    laspy.LasData with the header of the file, like laspy.read.
+    """
+    with laspy.open(las_path) as reader:
+        header = copy.deepcopy(reader.header)
+    chunks = list(iter_region(las_path, bounds, polygon, index=index, buffer=buffer))
+    if len(chunks) == 0:
+        array = np.zeros(0, dtype=header.point_format.dtype())
+    else:
+        array = np.concatenate([chunk.array for chunk in chunks])
+    points = laspy.ScaleAwarePointRecord(array, header.point_format, header.scales, header.offsets)
+    las = laspy.LasData(header=header, points=points)
+    las.update_header()
+    return las
+
+def sort_las(las_path, depth=INDEX_DEPTH):
+    """
+    Rewrite a LAS file in place with its points in quadtree tile order, then
+    index it, so every tile of the index is one range of points. The whole
+    file is read into memory once.
+    """
+    las = laspy.read(las_path)
+    index = SpatialIndex((las.header.mins[0], las.header.mins[1], las.header.maxs[0], las.header.maxs[1]), depth, None, None, None, len(las.points))
+    order = np.argsort(index.tile_of(las.x, las.y), kind='stable')
+    sorted_las = laspy.LasData(header=copy.deepcopy(las.header), points=las.points[order])
+    tmp_path = f"{os.path.splitext(las_path)[0]}.{os.getpid()}.tmp{os.path.splitext(las_path)[1]}"
+    sorted_las.write(tmp_path)
+    os.replace(tmp_path, las_path)
+    print(f"Sorted {len(order)} points of {las_path} into tile order")
+    return build_index(las_path, depth=depth)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the spatial index of every LAS file under data/.")
+    parser.add_argument('--depth', type=int, default=INDEX_DEPTH, help="quadtree depth; the leaf tiles are a 2**depth square grid")
+    parser.add_argument('--sort', action='store_true', help="rewrite each LAS in tile order first, so every tile is one range of points")
+    args = parser.parse_args()
+    for folder in natsorted(os.listdir('data')):
+        folder_path = os.path.join('data', folder)
+        if not os.path.isdir(folder_path):
+            continue
+        for f in natsorted(os.listdir(folder_path)):
+            if f.endswith('.las'):
+                las_path = os.path.join(folder_path, f)
+                if args.sort:
+                    sort_las(las_path, args.depth)
+                else:
+                    build_index(las_path, depth=args.depth)
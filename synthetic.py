@@ -0,0 +1,199 @@
+import numpy as np
+
+from lazy import LazyModule, lazy_function
+
+laspy = LazyModule('laspy')
+rasterio = LazyModule('rasterio')
+from_origin = lazy_function('rasterio.transform', 'from_origin')
+
+# Classification codes of the vegetation points, and the range of their height above ground
+VEGETATION_CLASSES = (3, 4, 5)
+VEGETATION_HEIGHT = (0.2, 6.0)
+
+def basin_surface(x, y, width, height, depth=8.0, seed=0):
+    """
+    Elevation of a synthetic debris basin: an elliptical bowl below the dam
+    crest elevation, on a slope rising upstream (with y), with gentle ripples.
+
+    Parameters
+    ----------
+    x, y : np.ndarray
+        Coordinates relative to the lower-left corner of the extent.
+    width, height : float
+        Extent of the survey.
+    depth : float, optional
+        Depth of the bowl below the dam crest. Default is 8.0.
+    seed : int, optional
+        Seed of the ripple phases.
+
+    Returns
+    -------
+    z : np.ndarray
+        Elevations, with the dam crest at 100.
+    """
+    rng = np.random.default_rng(seed)
+    phase = rng.uniform(0, 2 * np.pi, 2)
+    u = (x - 0.5 * width) / (0.45 * width)
+    v = (y - 0.45 * height) / (0.4 * height)
+    bowl = -depth * np.clip(1 - u ** 2 - v ** 2, 0, None)
+    slope = 4.0 * y / height
+    ripples = 0.3 * np.sin(x / 7.0 + phase[0]) * np.cos(y / 11.0 + phase[1])
+    return 100 + bowl + slope + ripples
+
+def hole_mask(x, y, width, height, hole_fraction, seed=0):
+    """
+    True for coordinates inside random circular holes (e.g., water or
+    occlusions) that cover about hole_fraction of the extent.
+    """
+    mask = np.zeros(np.shape(x), dtype=bool)
+    if hole_fraction <= 0:
+        return mask
+    rng = np.random.default_rng(seed + 1)
+    radius = 0.03 * min(width, height)
+    n_holes = int(np.ceil(hole_fraction * width * height / (np.pi * radius ** 2)))
+    centers = rng.uniform((0, 0), (width, height), (n_holes, 2))
+    for cx, cy in centers:
+        mask |= (x - cx) ** 2 + (y - cy) ** 2 < radius ** 2
+    return mask
+
+def make_basin_las(
+    las_path,
+    width=200.0,
+    height=150.0,
+    density=10.0,
+    hole_fraction=0.02,
+    vegetation_fraction=0.3,
+    noise=0.03,
+    origin=(400000.0, 3780000.0),
+    seed=0
+):
+    """
+    Write a deterministic synthetic LAS survey of a debris basin.
+
+    Ground points (class 2) sample basin_surface with Gaussian noise. A
+    vegetation_fraction of the points are classified 3, 4 or 5 and lifted
+    above the ground. Points inside the holes of hole_mask are dropped.
+
+    Parameters
+    ----------
+    las_path : str
+        Path to the output LAS file.
+    width, height : float, optional
+        Extent of the survey in meters. Default is 200 x 150.
+    density : float, optional
+        Points per square meter before the holes are cut. Default is 10.
+    hole_fraction : float, optional
+        Fraction of the extent without points. Default is 0.02.
+    vegetation_fraction : float, optional
+        Fraction of non-ground points. Default is 0.3.
+    noise : float, optional
+        Standard deviation of the vertical noise. Default is 0.03.
+    origin : tuple of float, optional
+        Map coordinates of the lower-left corner.
+    seed : int, optional
+        Seed of the generator; the same arguments always give the same file.
+
+    Returns
+    -------
+    n_points : int
+        Number of points written.
+    """
+    rng = np.random.default_rng(seed)
+    n_points = int(width * height * density)
+    x = rng.uniform(0, width, n_points)
+    y = rng.uniform(0, height, n_points)
+    keep = ~hole_mask(x, y, width, height, hole_fraction, seed)
+    x, y = x[keep], y[keep]
+    n_points = len(x)
+
+    z = basin_surface(x, y, width, height, seed=seed) + rng.normal(0, noise, n_points)
+    classification = np.full(n_points, 2, dtype=np.uint8)
+    vegetation = rng.random(n_points) < vegetation_fraction
+    classification[vegetation] = rng.choice(VEGETATION_CLASSES, vegetation.sum())
+    z[vegetation] += rng.uniform(*VEGETATION_HEIGHT, vegetation.sum())
+    return_number = np.where(vegetation & (rng.random(n_points) < 0.5), 1, 2).astype(np.uint8)
+
+    header = laspy.LasHeader(point_format=3, version="1.2")
+    header.scales = [0.001, 0.001, 0.001]
+    header.offsets = [origin[0], origin[1], 0.0]
+    las = laspy.LasData(header)
+    las.x = x + origin[0]
+    las.y = y + origin[1]
+    las.z = z
+    las.classification = classification
+    las.return_number = return_number
+    las.number_of_returns = np.full(n_points, 2, dtype=np.uint8)
+    las.write(las_path)
+    return n_points
+
+def basin_dem(width=200.0, height=150.0, resolution=0.5, hole_fraction=0.02, nodata_value=-9999,
+              origin=(400000.0, 3780000.0), seed=0):
+    """
+    Deterministic synthetic DEM of a debris basin, with nodata holes and
+    nodata outside an elliptical footprint, as written by make_basin_dem.
+
+    Returns
+    -------
+    z : 2D np.ndarray
+        Elevations.
+    profile : dict
+        Rasterio profile of the DEM.
+    """
+    x, y = np.meshgrid(np.arange(0, width, resolution), np.arange(0, height, resolution))
+    z = basin_surface(x, y, width, height, seed=seed)
+    footprint = ((x - 0.5 * width) / (0.5 * width)) ** 2 + ((y - 0.5 * height) / (0.5 * height)) ** 2 < 1
+    z[~footprint | hole_mask(x, y, width, height, hole_fraction, seed)] = nodata_value
+
+    profile = {
+        "driver": "GTiff",
+        "height": z.shape[0],
+        "width": z.shape[1],
+        "count": 1,
+        "dtype": str(z.dtype),
+        "nodata": nodata_value,
+        "transform": from_origin(origin[0], origin[1], resolution, -resolution),
+        "crs": None
+    }
+    return z, profile
+
+def make_basin_dem(
+    dem_path,
+    width=200.0,
+    height=150.0,
+    resolution=0.5,
+    hole_fraction=0.02,
+    nodata_value=-9999,
+    origin=(400000.0, 3780000.0),
+    seed=0
+):
+    """
+    Write a deterministic synthetic DEM of a debris basin, laid out like the
+    output of utils.write_dem, with nodata holes and nodata outside an
+    elliptical footprint.
+
+    Parameters
+    ----------
+    dem_path : str
+        Path to the output GeoTIFF.
+    width, height : float, optional
+        Extent in meters. Default is 200 x 150.
+    resolution : float, optional
+        Cell size. Default is 0.5.
+    hole_fraction : float, optional
+        Fraction of the extent set to nodata. Default is 0.02.
+    nodata_value : float, optional
+        Default is -9999.
+    origin : tuple of float, optional
+        Map coordinates of the lower-left corner.
+    seed : int, optional
+        Seed of the generator.
+
+    Returns
+    -------
+    n_cells : int
+        Number of cells of the raster.
+    """
+    z, profile = basin_dem(width, height, resolution, hole_fraction, nodata_value, origin, seed)
+    with rasterio.open(dem_path, 'w', **profile) as dst:
+        dst.write(z, 1)
+    return z.size
@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+import pytest
+import rasterio
+
+from capacity_estimation import VOLUME_METHOD, estimate_capacities, _capacity_curve, _outdated
+from synthetic import basin_dem, make_basin_dem
+from uncertainty import monte_carlo_capacities
+from utils import capacity_curve, capacity_curve_windowed, estimate_volume, flood_capacity_curve, load_filled_dem
+
+ELEVATIONS = [96.0, 100.0, 104.0, 110.0]
+
+@pytest.fixture
+def dem_path(tmp_path):
+    path = str(tmp_path / 'dem.tif')
+    make_basin_dem(path)
+    return path
+
+def test_windowed_matches_in_memory(dem_path):
+    # 400 x 300 pixels over 128-pixel tiles; holes are filled per tile, which
+    # moves the volumes by well under 1e-5 of themselves
+    in_memory = capacity_curve(dem_path, ELEVATIONS, method='contour')
+    windowed = capacity_curve_windowed(dem_path, ELEVATIONS, tile_size=128)
+    assert np.allclose(windowed, in_memory, rtol=1e-5, atol=0.0)
+
+@pytest.fixture
+def dsm_path(tmp_path):
+    # a stand of trees inside the pool, above the water at every elevation
+    z, profile = basin_dem()
+    z[140:160, 190:210] = np.where(z[140:160, 190:210] == profile['nodata'], profile['nodata'], 112.0)
+    path = str(tmp_path / 'dsm.tif')
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(z, 1)
+    return path
+
+@pytest.mark.parametrize('path', ['dem_path', 'dsm_path'])
+def test_production_curve_matches_estimate_volume(path, request):
+    # production capacities subtract the ground above the water inside the
+    # pool, as estimate_volume does
+    path = request.getfixturevalue(path)
+    volumes = _capacity_curve(load_filled_dem(path), ELEVATIONS, None, None, None)
+    expected = [estimate_volume(path, elevation) for elevation in ELEVATIONS]
+    assert np.allclose(volumes, expected, rtol=1e-9, atol=0.0)
+
+def test_outdated_rows():
+    def provenance(**parameters):
+        return {'parameters': parameters}
+    # rows imported from capacity.csv and rows from before the method was recorded
+    assert not _outdated(None)
+    assert not _outdated({'parameters': {}})
+    assert not _outdated(provenance(outlet_xy=None))
+    assert not _outdated(provenance(outlet_xy=[402135.2, 3782410.8]))
+    assert not _outdated(provenance(outlet_xy=None, volume_method=VOLUME_METHOD))
+    assert _outdated(provenance(outlet_xy=None, volume_method='cumulative'))
+    assert _outdated(provenance(outlet_xy=None, volume_method='flood'))
+
+def test_unperturbed_uncertainty_reproduces_capacities(dsm_path):
+    samples = monte_carlo_capacities(
+        dsm_path, ELEVATIONS, n_samples=4, reference_sigma=0.0, bias_sigma=0.0, noise_sigma=0.0
+    )
+    volumes = _capacity_curve(load_filled_dem(dsm_path), ELEVATIONS, None, None, None)
+    assert np.allclose(samples, volumes[:, None], rtol=1e-9, atol=0.0)
+
+def test_outlet_on_nodata_is_rejected(dem_path):
+    # the corners of the synthetic basin lie outside its elliptical footprint
+    corner_xy = (400001.0, 3780001.0)
+    with pytest.raises(ValueError, match='nodata'):
+        flood_capacity_curve(dem_path, ELEVATIONS, corner_xy)
+    with pytest.raises(ValueError, match='outside'):
+        flood_capacity_curve(dem_path, ELEVATIONS, (399000.0, 3779000.0))
+
+@pytest.mark.parametrize('outlet_xy', [None, (400100.0, 3780075.0)])
+def test_equal_heights_save_both_rasters(dem_path, outlet_xy, tmp_path):
+    spillway, crest = estimate_capacities(dem_path, 99.0, 99.0, str(tmp_path), 'dem', outlet_xy=outlet_xy)
+    assert spillway == crest > 0
+    for name in ('dem_spillway_masked.tif', 'dem_crest_masked.tif'):
+        assert os.path.exists(os.path.join(tmp_path, name))
+
+def test_windowed_saves_repeated_elevations(dem_path, tmp_path):
+    save_paths = [(99.0, str(tmp_path / 'spillway.tif')), (99.0, str(tmp_path / 'crest.tif'))]
+    capacity_curve_windowed(dem_path, [99.0, 99.0], save_paths, tile_size=128)
+    for _, path in save_paths:
+        assert os.path.exists(path)
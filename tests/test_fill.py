@@ -0,0 +1,71 @@
+import numpy as np
+import rasterio
+
+from synthetic import basin_dem
+from raster_stack import RasterStack
+from utils import interpolate_nodata, interpolate_nodata_global, load_filled_dem, estimate_volume, capacity_curve, fill_dem
+
+def write_dem(path, z, profile):
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(z, 1)
+
+def test_raster_without_nodata_tag(tmp_path):
+    # rasterio reads nodata=None from a GeoTIFF without a nodata tag
+    z, profile = basin_dem(hole_fraction=0.0)
+    z = np.where(z == profile['nodata'], 104.0, z)
+    profile = dict(profile, nodata=None)
+    dem_path = str(tmp_path / 'dem.tif')
+    write_dem(dem_path, z, profile)
+
+    np.testing.assert_array_equal(interpolate_nodata(z, None), z)
+    dem_filled, _, _, _ = load_filled_dem(dem_path)
+    assert np.all(np.isfinite(dem_filled))
+    volume = estimate_volume(dem_path, 99.0)
+    assert volume > 0
+    assert np.isclose(capacity_curve(dem_path, [99.0], method='contour')[0], volume)
+
+def diamond_footprint(profile):
+    # a diamond well inside the elliptical footprint of the synthetic basin,
+    # whose bounding box has nodata corners outside the diamond
+    x0, y0 = profile['transform'].c, profile['transform'].f
+    return np.array([(x0 + 100, y0 + 50), (x0 + 130, y0 + 75), (x0 + 100, y0 + 100), (x0 + 70, y0 + 75)])
+
+def assert_filled(dem_filled):
+    # 9999 outside the footprint, filled elevations inside it
+    assert np.all((dem_filled == 9999) | ((dem_filled > 90) & (dem_filled < 110)))
+
+def test_fill_hole_free_footprint():
+    z, profile = basin_dem(hole_fraction=0.0)
+    dem_filled, _, _, _ = fill_dem(z, 0.5, 0.5, profile['nodata'], profile, footprint=diamond_footprint(profile))
+    assert_filled(dem_filled)
+
+def test_fill_footprint_with_a_hole():
+    z, profile = basin_dem(hole_fraction=0.0)
+    z[145:155, 190:210] = profile['nodata']
+    dem_filled, _, _, _ = fill_dem(z, 0.5, 0.5, profile['nodata'], profile, footprint=diamond_footprint(profile))
+    assert_filled(dem_filled)
+
+def test_stack_layer_nan_holes(tmp_path):
+    # a stack layer keeps NaN for nodata; its holes must be filled too
+    z, profile = basin_dem(hole_fraction=0.0)
+    z[145:155, 190:210] = profile['nodata']
+    layer = np.where(z == profile['nodata'], np.nan, z)
+    x0, y0 = profile['transform'].c, profile['transform'].f
+    stack = RasterStack.create(str(tmp_path), x0, y0, layer.shape[0], layer.shape[1], 0.5)
+    stack.append(20240101, layer)
+    assert_filled(stack.filled(20240101)[0])
+
+# Largest difference, in metres, allowed between the ring fill and the fill
+# triangulated over the whole grid; the two triangulations differ slightly
+# across the wider holes (about 0.03 m on the synthetic basin)
+RING_FILL_TOLERANCE = 0.05
+
+def test_ring_fill_matches_global_fill():
+    z, profile = basin_dem(seed=0)
+    hole_free, _ = basin_dem(hole_fraction=0.0, seed=0)
+    # compare the holes inside the basin, not the nodata around it
+    holes = (z == profile['nodata']) & (hole_free != profile['nodata'])
+    ring = interpolate_nodata(z, profile['nodata'])
+    full = interpolate_nodata_global(z, profile['nodata'])
+    assert np.all(ring[holes] != profile['nodata'])
+    assert np.allclose(ring[holes], full[holes], rtol=0.0, atol=RING_FILL_TOLERANCE)
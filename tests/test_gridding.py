@@ -0,0 +1,20 @@
+import numpy as np
+
+from utils import RasterAccumulator
+
+def test_points_past_the_last_node_are_binned():
+    # a grid floored to the extent of the points, as np.arange(min, max, resolution) gives
+    rng = np.random.default_rng(0)
+    x = rng.uniform(0, 10.3, 100_000)
+    y = rng.uniform(0, 7.8, 100_000)
+    n_cols = len(np.arange(x.min(), x.max(), 0.5))
+    n_rows = len(np.arange(y.min(), y.max(), 0.5))
+    accumulator = RasterAccumulator(x.min(), y.min(), n_rows, n_cols, 0.5, reducer='max')
+    accumulator.add(np.r_[x, 100.0], np.r_[y, 100.0], np.r_[np.zeros_like(x), 1.0])
+
+    grid_z = accumulator.result()
+    # every point is on the grid, including those near its maximum, and the
+    # point far outside it is dropped
+    assert accumulator.counts.sum() == len(x)
+    assert not np.any(np.isnan(grid_z[-1, :])) and not np.any(np.isnan(grid_z[:, -1]))
+    assert np.nanmax(grid_z) == 0.0
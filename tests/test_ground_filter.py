@@ -0,0 +1,55 @@
+import os
+
+import laspy
+import numpy as np
+import pytest
+
+from capacity_estimation import prepare_folder
+from cache import file_hash
+from ground_filter import GROUND_CLASS, UNCLASSIFIED_CLASS, classify_ground, ground_las_path
+from synthetic import VEGETATION_CLASSES, make_basin_las
+from watch import folder_signature
+
+@pytest.fixture
+def raw_las(tmp_path):
+    """A synthetic survey exported without classes, and its true classes."""
+    folder_path = tmp_path / 'data' / 'Basin_20250125'
+    os.makedirs(folder_path)
+    las_path = str(folder_path / 'pointcloud.las')
+    make_basin_las(las_path, density=4.0)
+    las = laspy.read(las_path)
+    truth = np.array(las.classification)
+    las.classification = np.full(len(truth), UNCLASSIFIED_CLASS, dtype=np.uint8)
+    las.write(las_path)
+    return las_path, truth
+
+def test_filter_separates_ground_from_vegetation(raw_las):
+    las_path, truth = raw_las
+    raw_hash = file_hash(las_path)
+    classify_ground(las_path)
+
+    # the survey is kept as it is and the classes go to its sibling
+    assert file_hash(las_path) == raw_hash
+    classified = np.array(laspy.read(ground_las_path(las_path)).classification)
+    ground = classified == GROUND_CLASS
+    true_ground = truth == GROUND_CLASS
+    vegetation = np.isin(truth, VEGETATION_CLASSES)
+    assert np.mean(ground[true_ground]) > 0.99
+    assert np.mean(ground[vegetation]) < 0.02
+
+def test_prepare_folder_grids_the_classified_copy(raw_las, tmp_path, monkeypatch):
+    las_path, _ = raw_las
+    monkeypatch.chdir(tmp_path)
+    folder_path = os.path.dirname(las_path)
+    with open(os.path.join(folder_path, 'height_references.csv'), 'w') as f:
+        f.write("spillway_elevation, 98.0\ncrest_elevation, 100.0\n")
+    raw_hash = file_hash(las_path)
+    signature = folder_signature(folder_path)
+
+    ground_path = os.path.join('data', 'Basin_20250125', 'pointcloud.ground.las')
+    plan = prepare_folder('Basin_20250125', classify_ground=True)
+    assert plan['las_file'] == ground_path
+    assert file_hash(las_path) == raw_hash
+    # the classified copy neither counts as a second LAS nor changes the inputs
+    assert folder_signature(folder_path) == signature
+    assert prepare_folder('Basin_20250125')['las_file'] == ground_path
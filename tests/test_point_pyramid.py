@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+import pytest
+
+from capacity_estimation import estimate_capacities, read_footprint, read_height_references
+from point_pyramid import resolution_sweep
+from synthetic import make_basin_las
+
+ORIGIN = (400000.0, 3780000.0)
+
+@pytest.fixture
+def folder_path(tmp_path):
+    # a survey folder with an outlet at the bottom of the bowl and a footprint
+    folder_path = str(tmp_path / 'Basin_20250125')
+    os.makedirs(folder_path)
+    make_basin_las(os.path.join(folder_path, 'pointcloud.las'), density=4.0, origin=ORIGIN)
+    with open(os.path.join(folder_path, 'height_references.csv'), 'w') as f:
+        f.write("spillway_elevation, 98.0\ncrest_elevation, 100.0\n")
+        f.write(f"outlet_x, {ORIGIN[0] + 100.0}\noutlet_y, {ORIGIN[1] + 75.0}\n")
+    with open(os.path.join(folder_path, 'footprint.csv'), 'w') as f:
+        f.write("x, y\n")
+        for x, y in ((30, 15), (170, 15), (170, 135), (30, 135)):
+            f.write(f"{ORIGIN[0] + x}, {ORIGIN[1] + y}\n")
+    return folder_path
+
+def test_sweep_matches_production(folder_path, tmp_path):
+    rows = resolution_sweep(folder_path, resolutions=[1.0])
+    spillway_height, crest_height, outlet_xy = read_height_references(folder_path)
+    footprint = read_footprint(folder_path)
+    # the production capacities of the rasters the sweep gridded
+    capacities = {
+        product: estimate_capacities(
+            os.path.join(folder_path, 'resolution', f'{product}_1.tif'), spillway_height, crest_height,
+            str(tmp_path), product, outlet_xy=outlet_xy, footprint=footprint
+        )
+        for product in ('dem', 'dsm')
+    }
+    expected = [
+        capacities['dem'][0], capacities['dsm'][0],
+        capacities['dem'][1], capacities['dsm'][1]
+    ]
+    assert np.allclose(rows[0][1:], expected, rtol=1e-9, atol=0.0)
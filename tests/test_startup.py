@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import cli
+
+# Start-up budget, in seconds, of `python cli.py <command> --help`, and of the
+# bookkeeping commands, which must also start without the HEAVY_MODULES
+STARTUP_BUDGET = 0.5
+HEAVY_MODULES = ('rasterio', 'cv2', 'laspy', 'scipy', 'matplotlib', 'pandas')
+BOOKKEEPING_COMMANDS = ('clean', 'sort')
+
+CLI_PATH = os.path.abspath(cli.__file__)
+
+def run_timed(command, **kwargs):
+    start_time = time.perf_counter()
+    completed = subprocess.run(command, capture_output=True, text=True, **kwargs)
+    return time.perf_counter() - start_time, completed
+
+@pytest.mark.parametrize('command', sorted(cli.COMMANDS))
+def test_help_within_budget(command):
+    # Python itself starts in part of the budget; take the best of a few runs
+    # so a busy machine does not fail the test
+    elapsed, completed = min(
+        (run_timed([sys.executable, CLI_PATH, command, '--help']) for _ in range(3)),
+        key=lambda result: result[0]
+    )
+    assert completed.returncode == 0, completed.stderr
+    assert elapsed < STARTUP_BUDGET, f"{command} --help took {elapsed:.3f} s"
+
+def test_bookkeeping_commands_skip_heavy_modules():
+    probe = (
+        "import sys; import cli; "
+        f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    _, completed = run_timed([sys.executable, '-c', probe], cwd=os.path.dirname(CLI_PATH))
+    assert completed.returncode == 0, completed.stderr
+    assert completed.stdout.strip() == '', f"{'/'.join(BOOKKEEPING_COMMANDS)} load {completed.stdout.strip()}"
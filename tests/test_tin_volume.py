@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+import rasterio
+
+from synthetic import basin_dem, basin_surface
+from tin_volume import tin_capacity_curve
+from utils import capacity_curve, flood_capacity_curve
+
+ORIGIN = (400000.0, 3780000.0)
+ELEVATIONS = [96.0, 98.0, 99.0]
+OUTLET_XY = (ORIGIN[0] + 100.0, ORIGIN[1] + 75.0)
+# relative difference allowed between the TIN of scattered points and the
+# 0.5 m grid of the same surface (about 3e-4 on the synthetic basin)
+TIN_TOLERANCE = 2e-3
+
+@pytest.fixture(scope='module')
+def points():
+    rng = np.random.default_rng(0)
+    x = rng.uniform(0, 200.0, 120_000)
+    y = rng.uniform(0, 150.0, 120_000)
+    return x + ORIGIN[0], y + ORIGIN[1], basin_surface(x, y, 200.0, 150.0)
+
+@pytest.fixture(scope='module')
+def dem_path(tmp_path_factory):
+    z, profile = basin_dem(hole_fraction=0.0, origin=ORIGIN)
+    path = str(tmp_path_factory.mktemp('tin') / 'dem.tif')
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(z, 1)
+    return path
+
+def test_largest_pool_matches_grid(points, dem_path):
+    tin = tin_capacity_curve(*points, ELEVATIONS)
+    grid = capacity_curve(dem_path, ELEVATIONS, method='contour')
+    assert np.allclose(tin, grid, rtol=TIN_TOLERANCE, atol=0.0)
+
+def test_outlet_pool_matches_grid(points, dem_path):
+    tin = tin_capacity_curve(*points, ELEVATIONS, outlet_xy=OUTLET_XY)
+    grid = flood_capacity_curve(dem_path, ELEVATIONS, OUTLET_XY)
+    assert np.allclose(tin, grid, rtol=TIN_TOLERANCE, atol=0.0)
@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+import pytest
+
+from capacity_estimation import FOOTPRINT_BUFFER, estimate_capacities
+from synthetic import make_basin_dem
+from uncertainty import monte_carlo_capacities, process_uncertainty, read_uncertainty
+
+ORIGIN = (400000.0, 3780000.0)
+FOOTPRINT = np.array([(30, 15), (170, 15), (170, 135), (30, 135)]) + np.array(ORIGIN)
+
+@pytest.fixture
+def folder_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    folder_path = os.path.join('data', 'Basin_20250125')
+    os.makedirs(folder_path)
+    make_basin_dem(os.path.join(folder_path, 'dem.tif'), origin=ORIGIN)
+    make_basin_dem(os.path.join(folder_path, 'dsm.tif'), origin=ORIGIN, seed=1)
+    write_references(folder_path, 98.0, 100.0)
+    return folder_path
+
+def write_references(folder_path, spillway_height, crest_height):
+    with open(os.path.join(folder_path, 'height_references.csv'), 'w') as f:
+        f.write(f"spillway_elevation, {spillway_height}\ncrest_elevation, {crest_height}\n")
+
+def test_stale_bands_are_recomputed(folder_path, capsys):
+    process_uncertainty(n_samples=50)
+    assert 'Uncertainty of Basin_20250125' in capsys.readouterr().out
+    # skipped while its inputs are unchanged
+    process_uncertainty(n_samples=50)
+    assert capsys.readouterr().out == ''
+
+    write_references(folder_path, 98.0, 99.0)
+    process_uncertainty(n_samples=50)
+    out = capsys.readouterr().out
+    assert 'Inputs of Basin_20250125 changed' in out
+    assert 'Uncertainty of Basin_20250125' in out
+    assert len(read_uncertainty(os.path.join(folder_path, 'uncertainty.csv'))) > 0
+
+@pytest.mark.parametrize('outlet_xy', [None, (ORIGIN[0] + 100.0, ORIGIN[1] + 75.0)])
+def test_unperturbed_bands_reproduce_capacities(folder_path, outlet_xy, tmp_path):
+    dem_file = os.path.join(folder_path, 'dem.tif')
+    samples = monte_carlo_capacities(
+        dem_file, [98.0, 100.0], n_samples=4, reference_sigma=0.0, bias_sigma=0.0, noise_sigma=0.0,
+        outlet_xy=outlet_xy, footprint=FOOTPRINT, buffer=FOOTPRINT_BUFFER
+    )
+    capacities = estimate_capacities(
+        dem_file, 98.0, 100.0, str(tmp_path), 'dem', outlet_xy=outlet_xy, footprint=FOOTPRINT
+    )
+    assert np.allclose(samples, np.array(capacities)[:, None], rtol=1e-9, atol=0.0)
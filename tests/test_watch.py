@@ -0,0 +1,23 @@
+import os
+
+from watch import FolderWatcher
+
+def test_processing_does_not_requeue(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    folder_path = os.path.join('data', 'Basin_20250125')
+    os.makedirs(folder_path)
+    with open(os.path.join(folder_path, 'pointcloud.las'), 'wb') as f:
+        f.write(b'LASF')
+
+    watcher = FolderWatcher(settle=0)
+    assert list(watcher.poll()) == ['Basin_20250125']
+    # processing a folder without height references writes a template
+    with open(os.path.join(folder_path, 'height_references.csv'), 'w') as f:
+        f.write("spillway_elevation, 0\ncrest_elevation, 0\n")
+    watcher.mark_processed('Basin_20250125')
+    assert watcher.poll() == {}
+
+    # a later change of the inputs queues it again
+    with open(os.path.join(folder_path, 'height_references.csv'), 'w') as f:
+        f.write("spillway_elevation, 98.0\ncrest_elevation, 100.0\n")
+    assert list(watcher.poll()) == ['Basin_20250125']
@@ -0,0 +1,304 @@
+import argparse
+import csv
+import os
+import time
+
+import numpy as np
+from natsort import natsorted
+
+from cache import ContentCache, DEFAULT_CACHE_DIR
+from capacity_estimation import FOOTPRINT_BUFFER, VOLUME_METHOD, read_height_references, read_footprint
+from ground_filter import classified_las, survey_las_files
+from instrumentation import span
+from lazy import lazy_function
+from point_pyramid import load_pyramid
+from results_store import ResultsStore, CAPACITY_KEYS
+from spatial_index import region_mask
+
+Delaunay = lazy_function('scipy.spatial', 'Delaunay')
+coo_matrix = lazy_function('scipy.sparse', 'coo_matrix')
+connected_components = lazy_function('scipy.sparse.csgraph', 'connected_components')
+
+# Points are thinned to about one per cell of this size, half the grid resolution, before they are triangulated
+TIN_CELL_SIZE = 0.25
+# Pools smaller than this are ignored, as pool_mask ignores contours of fewer than 20 cells of 0.5 m
+MIN_POOL_AREA = 5.0
+TIN_CSV = 'data/tin_capacity.csv'
+# product of the pyramid behind each capacity, as in process_folder
+PRODUCT_KEYS = {
+    'Upper_spillway_capacity': ('dem.tif', 0),
+    'Lower_spillway_capacity': ('dsm.tif', 0),
+    'Upper_crest_capacity': ('dem.tif', 1),
+    'Lower_crest_capacity': ('dsm.tif', 1)
+}
+
+def wet_prisms(triangle_z, areas, elevations):
+    """
+    Volume and area below each elevation of every triangle of a TIN.
+
+    The depth h - z is linear over a triangle, so with the depths at its
+    vertices sorted d1 >= d2 >= d3 and A its plan area, the volume of water is
+    A (d1 + d2 + d3) / 3 when the triangle is all wet, the tetrahedron
+    A d1^3 / (3 (d1 - d2)(d1 - d3)) when one vertex is wet, and the full
+    prism minus the dry tetrahedron A (-d3)^3 / (3 (d1 - d3)(d2 - d3)) when
+    two are. All triangles and elevations are computed in one broadcast.
+
+    Parameters
+    ----------
+    triangle_z : (n, 3) np.ndarray
+        Elevations of the vertices of every triangle.
+    areas : (n,) np.ndarray
+        Plan areas of the triangles.
+    elevations : (m,) np.ndarray
+        Reference elevations.
+
+    Returns
+    -------
+    volumes, wet_areas : (n, m) np.ndarray
+    """
+    depths = np.sort(elevations[None, :, None] - triangle_z[:, None, :], axis=2)
+    d3, d2, d1 = depths[..., 0], depths[..., 1], depths[..., 2]
+    area = areas[:, None]
+    one = (d1 > 0) & (d2 <= 0)
+    two = (d2 > 0) & (d3 < 0)
+    full = d3 >= 0
+
+    volumes = np.zeros(d1.shape)
+    wet_areas = np.zeros(d1.shape)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # one wet vertex: the wet part is a triangle similar to the whole
+        fraction = d1 ** 2 / ((d1 - d2) * (d1 - d3))
+        volumes = np.where(one, area * fraction * d1 / 3, volumes)
+        wet_areas = np.where(one, area * fraction, wet_areas)
+        # two wet vertices: the whole prism minus the dry corner
+        dry_fraction = d3 ** 2 / ((d1 - d3) * (d2 - d3))
+        volumes = np.where(two, area * ((d1 + d2 + d3) / 3 - dry_fraction * d3 / 3), volumes)
+        wet_areas = np.where(two, area * (1 - dry_fraction), wet_areas)
+    volumes = np.where(full, area * (d1 + d2 + d3) / 3, volumes)
+    wet_areas = np.where(full, area, wet_areas)
+    return volumes, wet_areas
+
+def _components(tin, linked):
+    """Connected components of the triangles through the edges where linked(triangles, neighbors, j) holds."""
+    rows, cols = [], []
+    for j in range(3):
+        # neighbor j shares the edge opposite vertex j
+        neighbors = tin.neighbors[:, j]
+        triangles = np.flatnonzero(neighbors >= 0)
+        triangles = triangles[linked(triangles, neighbors[triangles], j)]
+        rows.append(triangles)
+        cols.append(neighbors[triangles])
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    n = len(tin.simplices)
+    graph = coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n))
+    return connected_components(graph, directed=False)[1]
+
+def enclosed_triangles(tin, pool, active):
+    """
+    Triangles outside a pool that it encloses, the dry islands that
+    largest_contour_mask fills, i.e., the sets of active triangles outside the
+    pool that do not reach the edge of the TIN or of the active triangles.
+    """
+    dry = active & ~pool
+    labels = _components(tin, lambda triangles, neighbors, j: dry[triangles] & dry[neighbors])
+    # dry triangles on the edge of the TIN or next to inactive triangles
+    edge = dry & np.any((tin.neighbors < 0) | ~active[tin.neighbors], axis=1)
+    outside = np.zeros(len(labels), dtype=bool)
+    outside[labels[edge]] = True
+    return dry & ~outside[labels]
+
+def pool_triangles(tin, z, elevation, wet_areas, active, seed_simplex=None):
+    """
+    Triangles of the pool below an elevation: those connected through edges
+    with a vertex below it, to the seed triangle if given, else the connected
+    set with the largest wet area, as pool_mask keeps the largest contour.
+
+    Returns
+    -------
+    pool : (n,) np.ndarray of bool or None
+        None if there is no pool of at least MIN_POOL_AREA.
+    """
+    simplices = tin.simplices
+    wet = active & (wet_areas > 0)
+
+    def wet_edge(triangles, neighbors, j):
+        edge_z = np.minimum(z[simplices[triangles, (j + 1) % 3]], z[simplices[triangles, (j + 2) % 3]])
+        return wet[triangles] & wet[neighbors] & (edge_z < elevation)
+
+    labels = _components(tin, wet_edge)
+    n = len(simplices)
+
+    if seed_simplex is not None:
+        if seed_simplex < 0 or not wet[seed_simplex]:
+            return None
+        pool = labels == labels[seed_simplex]
+    else:
+        if not np.any(wet):
+            return None
+        component_areas = np.bincount(labels[wet], weights=wet_areas[wet], minlength=n)
+        pool = labels == np.argmax(component_areas)
+    pool &= wet
+    if np.sum(wet_areas[pool]) < MIN_POOL_AREA:
+        return None
+    return pool
+
+def tin_capacity_curve(x, y, z, elevations, method='contour', outlet_xy=None, footprint=None, buffer=0.0):
+    """
+    Reservoir volumes below reference elevations from a Delaunay triangulation
+    of the points, without gridding them.
+
+    Parameters
+    ----------
+    x, y, z : 1D np.ndarray
+        Point coordinates, e.g., thinned by PointPyramid.points.
+    elevations : array_like
+        Reference elevations.
+    method : {'cumulative', 'contour', 'wet'}, optional
+        With 'cumulative', the pool is delineated once at the highest elevation,
+        with its islands, and the water below every elevation within it is
+        counted, as in utils.capacity_curve. With 'contour', the pool is
+        delineated per elevation, and the ground above the water inside its
+        outline, e.g., trees in the DSM or islands, counts with a negative
+        volume, as cells above the elevation inside the pool outline do in
+        utils.estimate_volume. With 'wet', only the water of the pool at each
+        elevation is counted, as in utils.flood_capacity_curve. Default is
+        'contour'.
+    outlet_xy : tuple of float, optional
+        If given, the pool is the set of triangles connected to the one under
+        the outlet, as utils.flood_capacity_curve floods from the outlet, and
+        only the water is counted.
+    footprint : array_like, optional
+        (n, 2) vertices of the basin footprint; only the triangles whose
+        centroid lies within buffer of it are counted.
+    buffer : float, optional
+        Width by which the footprint is widened. Default is 0.
+
+    Returns
+    -------
+    volumes : 1D np.ndarray
+        The volume at each elevation, in the order given.
+    """
+    if method not in ('cumulative', 'contour', 'wet'):
+        raise ValueError(f"Unknown method '{method}', expected 'cumulative', 'contour' or 'wet'")
+    elevations = np.atleast_1d(np.asarray(elevations, dtype=float))
+    # triangulate around the origin; qhull is slower and less exact on map coordinates
+    origin = np.array([np.mean(x), np.mean(y)])
+    xy = np.column_stack((x, y)) - origin
+    with span('triangulate', points=len(z)):
+        tin = Delaunay(xy)
+    corners = xy[tin.simplices]
+    areas = 0.5 * np.abs(
+        (corners[:, 1, 0] - corners[:, 0, 0]) * (corners[:, 2, 1] - corners[:, 0, 1])
+        - (corners[:, 2, 0] - corners[:, 0, 0]) * (corners[:, 1, 1] - corners[:, 0, 1])
+    )
+    active = np.ones(len(areas), dtype=bool)
+    if footprint is not None:
+        centroids = corners.mean(axis=1) + origin
+        active = region_mask(centroids[:, 0], centroids[:, 1], polygon=footprint, buffer=buffer)
+    seed_simplex = None
+    if outlet_xy is not None:
+        seed_simplex = int(tin.find_simplex(np.asarray([outlet_xy], dtype=float) - origin)[0])
+        if seed_simplex < 0:
+            raise ValueError(f"Outlet {outlet_xy} is outside the triangulation")
+
+    with span('wet_prisms', triangles=len(areas), elevations=len(elevations)):
+        volumes, wet_areas = wet_prisms(z[tin.simplices], areas, elevations)
+    curve = np.zeros(len(elevations))
+    if method == 'cumulative' and outlet_xy is None:
+        top = int(np.argmax(elevations))
+        pool = pool_triangles(tin, z, elevations[top], wet_areas[:, top], active)
+        if pool is not None:
+            region = pool | enclosed_triangles(tin, pool, active)
+            curve = np.sum(volumes[region], axis=0)
+        return curve
+    for i, elevation in enumerate(elevations):
+        pool = pool_triangles(tin, z, elevation, wet_areas[:, i], active, seed_simplex)
+        if pool is None:
+            continue
+        if method == 'wet' or outlet_xy is not None:
+            curve[i] = np.sum(volumes[pool, i])
+            continue
+        # inside the outline of the pool and its islands, the ground above the
+        # water counts too, with a negative volume; on the outline, only the water
+        region = pool | enclosed_triangles(tin, pool, active)
+        interior = region & np.all((tin.neighbors >= 0) & region[tin.neighbors], axis=1)
+        signed = areas * (elevation - z[tin.simplices].mean(axis=1))
+        curve[i] = np.sum(np.where(interior, signed, volumes[:, i])[region])
+    return curve
+
+def tin_capacities(folder_path, cache=None, cell_size=TIN_CELL_SIZE):
+    """
+    Capacities of one survey folder from TINs of its ground (upper) and
+    all (lower) points, thinned by the folder's PointPyramid.
+
+    Returns
+    -------
+    capacities : dict or None
+        Maps CAPACITY_KEYS to the capacities, or None if the folder has no
+        single LAS file or no height references.
+    """
+    las_files = survey_las_files(os.listdir(folder_path))
+    if len(las_files) != 1 or not os.path.exists(os.path.join(folder_path, 'height_references.csv')):
+        return None
+    spillway_height, crest_height, outlet_xy = read_height_references(folder_path)
+    if spillway_height == 0 or crest_height == 0:
+        return None
+    footprint = read_footprint(folder_path)
+
+    pyramid = load_pyramid(classified_las(os.path.join(folder_path, las_files[0])), cache)
+    curves = dict()
+    for product in pyramid.products:
+        x, y, z = pyramid.points(product, cell_size)
+        curves[product] = tin_capacity_curve(
+            x, y, z, [spillway_height, crest_height], method=VOLUME_METHOD,
+            outlet_xy=outlet_xy, footprint=footprint, buffer=FOOTPRINT_BUFFER
+        )
+    return {key: float(curves[product][i]) for key, (product, i) in PRODUCT_KEYS.items()}
+
+def process_tin_capacities(folders=None, cache=None, cell_size=TIN_CELL_SIZE, csv_path=TIN_CSV):
+    """
+    Run tin_capacities on the survey folders under data/ and cross-check them
+    against the raster capacities in the results store. Both, and their
+    relative differences, are written to data/tin_capacity.csv.
+    """
+    if folders is None:
+        folders = [f for f in natsorted(os.listdir('data')) if os.path.isdir(os.path.join('data', f))]
+    with ResultsStore() as store:
+        raster_data = store.capacities()
+
+    rows = []
+    for folder in folders:
+        start_time = time.perf_counter()
+        capacities = tin_capacities(os.path.join('data', folder), cache, cell_size)
+        if capacities is None:
+            print(f"Skipping folder {folder}: no single LAS file or height references")
+            continue
+        wall_time = time.perf_counter() - start_time
+        raster = raster_data.get(folder)
+        row = [folder]
+        print(f"{folder}: TIN capacities in {wall_time:.2f} s")
+        for key in CAPACITY_KEYS:
+            tin_capacity = capacities[key]
+            raster_capacity = raster[key] if raster is not None else None
+            difference = (tin_capacity - raster_capacity) / raster_capacity if raster_capacity else None
+            row += [tin_capacity, raster_capacity, difference]
+            check = f" raster {raster_capacity:12.1f} ({100 * difference:+.2f}%)" if difference is not None else ''
+            print(f"  {key:<25} {tin_capacity:12.1f}{check}")
+        rows.append(row)
+
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Name'] + [f'{key}{suffix}' for key in CAPACITY_KEYS for suffix in ('_tin', '_raster', '_difference')])
+        writer.writerows(rows)
+    print(f"TIN capacities saved to: {csv_path}")
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Capacities from TINs of the LAS points, without rasters, cross-checked against the results store.")
+    parser.add_argument('--folder', action='append', default=None, help="only process this folder (repeatable)")
+    parser.add_argument('--cell-size', type=float, default=TIN_CELL_SIZE, help="thin the points to about one per cell of this size")
+    parser.add_argument('--cache', action='store_true', help="memoize the LAS hashes in the cache directory")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help="directory of the cache")
+    args = parser.parse_args()
+    cache = ContentCache(args.cache_dir) if args.cache else None
+    process_tin_capacities(args.folder, cache, args.cell_size)
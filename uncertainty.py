@@ -0,0 +1,309 @@
+import argparse
+import csv
+import os
+import time
+
+import numpy as np
+from natsort import natsorted
+
+from cache import cache_key, file_hash
+from lazy import LazyModule
+from utils import load_filled_dem, pool_mask, outlet_cell, spill_levels
+from capacity_estimation import FOOTPRINT_BUFFER, VOLUME_METHOD, read_height_references, read_footprint, _footprint_key
+
+warp = LazyModule('rasterio.warp')
+
+# Default 1-sigma errors, in meters
+REFERENCE_SIGMA = 0.03  # RTK survey of the spillway and crest elevations
+BIAS_SIGMA = 0.05  # vertical bias of a lidar survey
+NOISE_SIGMA = 0.05  # vertical noise of the lidar surface
+NOISE_CORRELATION = 1.0  # correlation length of the noise, in map units
+
+def align_to(src, dst):
+    """
+    Resample a filled raster (from load_filled_dem) onto the grid of another.
+
+    DEM and DSM are gridded over the bounding boxes of different point sets,
+    so their grids are offset by a fraction of a cell.
+    """
+    src_filled, _, _, src_profile = src
+    dst_filled, _, _, dst_profile = dst
+    # both grids share one CRS; any CRS stands in when the rasters carry none
+    crs = dst_profile.get('crs') or src_profile.get('crs') or 'EPSG:3857'
+    aligned = np.full(dst_filled.shape, 9999.0)
+    warp.reproject(
+        source=src_filled,
+        destination=aligned,
+        src_transform=src_profile['transform'],
+        src_crs=crs,
+        dst_transform=dst_profile['transform'],
+        dst_crs=crs,
+        src_nodata=9999,
+        dst_nodata=9999,
+        resampling=warp.Resampling.bilinear
+    )
+    return aligned
+
+def monte_carlo_capacities(
+    dem_path,
+    elevations,
+    dsm_path=None,
+    n_samples=10000,
+    reference_sigma=REFERENCE_SIGMA,
+    bias_sigma=BIAS_SIGMA,
+    noise_sigma=NOISE_SIGMA,
+    noise_correlation=NOISE_CORRELATION,
+    n_blend_levels=11,
+    outlet_xy=None,
+    footprint=None,
+    buffer=0.0,
+    seed=0
+):
+    """
+    Monte Carlo distribution of reservoir volumes at several reference elevations.
+
+    The pool is delineated as for the reported capacities (see
+    capacity_estimation._capacity_curve): the largest contour below each
+    nominal elevation (or below the highest one with VOLUME_METHOD
+    'cumulative'), or the area flooded from the outlet, so the unperturbed
+    realizations reproduce them. The contour of a nominal elevation is not
+    traced again at the perturbed elevations of its realizations.
+
+    Each realization draws an error on the reference elevation, a vertical bias
+    of the surface, a noise field and, if a DSM is given, a blend weight w
+    between the DSM (w=0, lower bound) and the DEM (w=1, upper bound). All
+    realizations share one load of the rasters and are evaluated in batched form:
+      - bias and reference error shift the effective elevation h - b;
+      - for each of n_blend_levels blend weights, the pool cells of the blended
+        surface are sorted once, by elevation or by flood level, and the
+        volumes of all realizations are read from cumulative sums (as
+        capacity_curve and flood_capacity_curve do) and interpolated in w;
+      - the noise field changes the volume by minus its sum over the pool,
+        drawn from its variance noise_sigma**2 * n_pool * n_corr, where n_corr
+        is the number of cells within one correlation length at the grid
+        resolution.
+
+    Parameters
+    ----------
+    dem_path : str
+        The file path to the DEM in GeoTIFF format.
+    elevations : array_like
+        Nominal reference elevations in the same units as the DEM.
+    dsm_path : str, optional
+        The file path to the DSM. If given, the surface is blended between both.
+    n_samples : int, optional
+        Number of realizations. Default is 10000.
+    reference_sigma, bias_sigma, noise_sigma : float, optional
+        1-sigma reference elevation error, vertical bias and vertical noise.
+    noise_correlation : float, optional
+        Correlation length of the noise field in map units.
+    n_blend_levels : int, optional
+        Number of blend weights the volume is tabulated at. Default is 11.
+    outlet_xy : tuple of float, optional
+        If given, the pool is flooded from this outlet (see utils.flood_capacity_curve).
+    footprint : array_like, optional
+        (n, 2) vertices of the basin footprint the rasters are clipped to,
+        widened by buffer (see utils.clip_to_footprint).
+    buffer : float, optional
+        Width by which the footprint is widened. Default is 0.
+    seed : int, optional
+        Seed of the random generator.
+
+    Returns
+    -------
+    samples : 2D np.ndarray
+        Volumes of shape (len(elevations), n_samples).
+    """
+    rng = np.random.default_rng(seed)
+    elevations = np.atleast_1d(np.asarray(elevations, dtype=float))
+
+    dem = load_filled_dem(dem_path, footprint, buffer)
+    dem_filled, pixel_width, pixel_height, profile = dem
+    cell_area = pixel_width * pixel_height
+    if dsm_path is not None:
+        dsm_filled = align_to(load_filled_dem(dsm_path, footprint, buffer), dem)
+        blend_levels = np.linspace(0, 1, n_blend_levels)
+        weights = rng.uniform(0, 1, n_samples)
+    else:
+        dsm_filled = dem_filled
+        blend_levels = np.array([1.0])
+        weights = np.ones(n_samples)
+    outside = (dem_filled == 9999) | (dsm_filled == 9999)
+
+    # 1. Effective elevations of every realization, shape (n_elevations, n_samples)
+    bias = rng.normal(0, bias_sigma, n_samples)
+    effective = (
+        elevations[:, None]
+        + rng.normal(0, reference_sigma, (len(elevations), n_samples))
+        - bias[None, :]
+    )
+
+    # 2. Volumes and pool sizes tabulated at each blend level. With the
+    #    per-elevation contours, the pool of each nominal elevation is kept for
+    #    its realizations and the volume is linear in the effective elevation,
+    #    cells above it inside the pool counting negative as in estimate_volume.
+    #    Otherwise the pool cells are sorted by elevation within the pool of the
+    #    highest nominal elevation, or by flood level from the outlet
+    volumes = np.zeros((len(blend_levels),) + effective.shape)
+    n_pool = np.zeros_like(volumes)
+    for i, w in enumerate(blend_levels):
+        surface = np.where(outside, 9999, dsm_filled + w * (dem_filled - dsm_filled))
+        if outlet_xy is None and VOLUME_METHOD == 'contour':
+            for j, elevation in enumerate(elevations):
+                region = pool_mask(surface, elevation)
+                if region is None:
+                    continue
+                z_pool = surface[region.astype(bool)]
+                volumes[i, j] = (effective[j] * len(z_pool) - np.sum(z_pool)) * cell_area
+                n_pool[i, j] = len(z_pool)
+            continue
+        if outlet_xy is None:
+            region = pool_mask(surface, elevations.max())
+            if region is None:
+                continue
+            z_pool = surface[region.astype(bool)]
+            order = np.argsort(z_pool)
+            keys = z_pool[order]
+        else:
+            levels = spill_levels(surface, *outlet_cell(surface, pixel_width, pixel_height, profile, outlet_xy))
+            z_pool = surface.ravel()
+            order = np.argsort(levels, axis=None)
+            keys = levels.ravel()[order]
+        z_cumsum = np.r_[0.0, np.cumsum(z_pool[order])]
+        n_below = np.searchsorted(keys, effective, side='left')
+        volumes[i] = (effective * n_below - z_cumsum[n_below]) * cell_area
+        n_pool[i] = n_below
+
+    # 3. Linear interpolation between the two blend levels around each weight
+    if len(blend_levels) > 1:
+        position = weights * (len(blend_levels) - 1)
+        lower = np.minimum(position.astype(int), len(blend_levels) - 2)
+        fraction = position - lower
+        columns = np.arange(n_samples)
+        samples = (1 - fraction) * volumes[lower, :, columns].T + fraction * volumes[lower + 1, :, columns].T
+        pool_cells = (1 - fraction) * n_pool[lower, :, columns].T + fraction * n_pool[lower + 1, :, columns].T
+    else:
+        samples = volumes[0]
+        pool_cells = n_pool[0]
+
+    # 4. Noise field: minus its sum over the pool
+    correlation_cells = max(1.0, np.pi * noise_correlation ** 2 / cell_area)
+    noise_std = noise_sigma * np.sqrt(pool_cells * correlation_cells) * cell_area
+    samples = samples - rng.standard_normal(samples.shape) * noise_std
+
+    return np.maximum(samples, 0)
+
+def save_uncertainty(csv_path, names, elevations, samples, percentiles=(5, 50, 95), inputs_key=None):
+    """
+    Save mean, standard deviation and percentiles of Monte Carlo volumes.
+
+    Parameters
+    ----------
+    csv_path : str
+        Output CSV path.
+    names : list of str
+        Name of each reference elevation, e.g., ['spillway', 'crest'].
+    elevations : array_like
+        Nominal reference elevations.
+    samples : 2D np.ndarray
+        Volumes from monte_carlo_capacities.
+    percentiles : tuple of float, optional
+        Percentiles to save. Default is (5, 50, 95).
+    inputs_key : str, optional
+        Key of the inputs the volumes were computed from (see uncertainty_key),
+        saved in the 'Inputs' column.
+    """
+    values = np.percentile(samples, percentiles, axis=1)
+    with open(csv_path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Reference', 'Elevation', 'Mean', 'Std'] + [f'P{p:g}' for p in percentiles] + ['Inputs'])
+        for i, name in enumerate(names):
+            writer.writerow([name, elevations[i], samples[i].mean(), samples[i].std()] + list(values[:, i]) + [inputs_key or ''])
+
+def read_uncertainty(csv_path):
+    """Read a CSV from save_uncertainty as {reference name: {column: value}}, without its 'Inputs' key."""
+    if not os.path.exists(csv_path):
+        return {}
+    data = dict()
+    with open(csv_path, 'r') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            name = row.pop('Reference')
+            row.pop('Inputs', None)
+            data[name] = {key: float(value) for key, value in row.items()}
+    return data
+
+def saved_inputs_key(csv_path):
+    """The 'Inputs' key of a CSV from save_uncertainty, or None if it has none."""
+    if not os.path.exists(csv_path):
+        return None
+    with open(csv_path, 'r') as f:
+        for row in csv.DictReader(f):
+            return row.get('Inputs') or None
+    return None
+
+def uncertainty_key(dem_file, dsm_file, elevations, outlet_xy, footprint, n_samples, seed):
+    """
+    Key of the inputs of a folder's uncertainty.csv: the content of its
+    rasters, its height references and footprint, the volume method and the
+    sampling parameters. uncertainty.csv is recomputed when it changes.
+    """
+    return cache_key(
+        'uncertainty', file_hash(dem_file), file_hash(dsm_file), elevations, outlet_xy or VOLUME_METHOD,
+        n_samples, seed, REFERENCE_SIGMA, BIAS_SIGMA, NOISE_SIGMA, NOISE_CORRELATION, *_footprint_key(footprint)
+    )
+
+def process_uncertainty(n_samples=10000, overwrite=False, seed=0):
+    """
+    Write uncertainty.csv, the Monte Carlo distribution of the spillway and
+    crest capacities, into every survey folder under data/ with a DEM, a DSM
+    and surveyed height references. A folder is skipped while the key of its
+    inputs (see uncertainty_key) matches the one saved in its uncertainty.csv,
+    so the distribution is recomputed whenever the capacities would be.
+
+    Parameters
+    ----------
+    n_samples : int, optional
+        Number of realizations per folder. Default is 10000.
+    overwrite : bool, optional
+        Recompute folders whose uncertainty.csv is up to date. Default is False.
+    seed : int, optional
+        Seed of the random generator.
+    """
+    folders = [f for f in os.listdir('data') if os.path.isdir(os.path.join('data', f))]
+    for folder in natsorted(folders):
+        folder_path = os.path.join('data', folder)
+        csv_path = os.path.join(folder_path, 'uncertainty.csv')
+        dem_file = os.path.join(folder_path, 'dem.tif')
+        dsm_file = os.path.join(folder_path, 'dsm.tif')
+        if not (os.path.exists(dem_file) and os.path.exists(dsm_file)):
+            continue
+        if not os.path.exists(os.path.join(folder_path, 'height_references.csv')):
+            continue
+        spillway_height, crest_height, outlet_xy = read_height_references(folder_path)
+        if spillway_height == 0 or crest_height == 0:
+            continue
+        footprint = read_footprint(folder_path)
+        elevations = [spillway_height, crest_height]
+        inputs_key = uncertainty_key(dem_file, dsm_file, elevations, outlet_xy, footprint, n_samples, seed)
+        saved_key = saved_inputs_key(csv_path)
+        if saved_key == inputs_key and not overwrite:
+            continue
+        if os.path.exists(csv_path) and saved_key != inputs_key:
+            print(f"Inputs of {folder} changed since its uncertainty.csv")
+
+        start_time = time.perf_counter()
+        samples = monte_carlo_capacities(
+            dem_file, elevations, dsm_path=dsm_file, n_samples=n_samples, outlet_xy=outlet_xy,
+            footprint=footprint, buffer=FOOTPRINT_BUFFER, seed=seed
+        )
+        save_uncertainty(csv_path, ['spillway', 'crest'], elevations, samples, inputs_key=inputs_key)
+        print(f"Uncertainty of {folder}: {n_samples} realizations in {time.perf_counter() - start_time:.2f} s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monte Carlo uncertainty of the capacities of the folders under data/.")
+    parser.add_argument('--samples', type=int, default=10000, help="number of realizations per folder")
+    parser.add_argument('--overwrite', action='store_true', help="recompute folders whose uncertainty.csv is up to date")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the random generator")
+    args = parser.parse_args()
+    process_uncertainty(n_samples=args.samples, overwrite=args.overwrite, seed=args.seed)
@@ -1,11 +1,27 @@
 import numpy as np
-import rasterio
-from scipy.interpolate import griddata
-import cv2
-import laspy
 import os
 import copy
-from rasterio.transform import from_origin
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from instrumentation import span, peak_rss_mb
+from lazy import LazyModule, lazy_function
+from spatial_index import iter_region, read_region, region_bounds, region_mask
+
+# Geospatial libraries are imported on first use (see lazy.LazyModule)
+rasterio = LazyModule('rasterio')
+cv2 = LazyModule('cv2')
+laspy = LazyModule('laspy')
+griddata = lazy_function('scipy.interpolate', 'griddata')
+binary_dilation = lazy_function('scipy.ndimage', 'binary_dilation')
+coo_matrix = lazy_function('scipy.sparse', 'coo_matrix')
+breadth_first_order = lazy_function('scipy.sparse.csgraph', 'breadth_first_order')
+minimum_spanning_tree = lazy_function('scipy.sparse.csgraph', 'minimum_spanning_tree')
+from_origin = lazy_function('rasterio.transform', 'from_origin')
+Window = lazy_function('rasterio.windows', 'Window')
+window_transform = lazy_function('rasterio.windows', 'transform')
+rasterio_copy = lazy_function('rasterio.shutil', 'copy')
 
 def clear_las():
     data_folders = [os.path.join('data', f) for f in os.listdir('data') if os.path.isdir(os.path.join('data', f))]
@@ -26,13 +42,93 @@ def clear_data():
                 continue
             os.remove(os.path.join(folder, f))
 
-def interpolate_nodata(dem_data, nodata_value):
+def interpolate_nodata(dem_data, nodata_value, ring_width=2, mask=None):
     """
     Interpolate and fill nodata cells in a 2D DEM array using
     a two-step approach:
       1) Linear interpolation (via griddata)
       2) Nearest-neighbor fallback for any unfilled cells
 
+    Only the valid cells within `ring_width` pixels of a nodata cell take part
+    in the interpolation, and only the nodata cells are sampled, so the fill
+    time scales with the area of the holes rather than with the raster.
+
+    Parameters
+    ----------
+    dem_data : 2D np.ndarray
+        DEM array with valid elevation values and nodata_value for missing areas.
+    nodata_value : float or None
+        The value in dem_data that represents nodata/missing data, NaN
+        included. None, as read from a raster without a nodata tag, means
+        there are no nodata cells.
+    ring_width : int or None, optional
+        Width in pixels of the ring of valid cells around the holes that the
+        interpolation uses. Default is 2. If None, every valid cell is used and
+        the whole grid is interpolated (the original, global fill).
+    mask : 2D np.ndarray of bool, optional
+        If given, only the nodata cells where mask is True are filled,
+        e.g., the cells within a basin footprint.
+
+    Returns
+    -------
+    filled_dem : 2D np.ndarray
+        A copy of the DEM array with nodata cells filled.
+        Cells that could not be filled remain with nodata_value.
+    """
+    if ring_width is None:
+        return interpolate_nodata_global(dem_data, nodata_value)
+
+    # 1. Identify nodata cells to fill, and skip all work if there are none
+    if nodata_value is None:
+        # a raster without a nodata tag has no nodata cells
+        nodata_mask = np.zeros(dem_data.shape, dtype=bool)
+    elif np.isnan(nodata_value):
+        nodata_mask = np.isnan(dem_data)
+    else:
+        nodata_mask = (dem_data == nodata_value)
+    filled_dem = dem_data.astype(float)
+    valid_mask = ~nodata_mask
+    if mask is not None:
+        nodata_mask &= mask
+    if not np.any(nodata_mask) or not np.any(valid_mask):
+        return filled_dem
+
+    # 2. The ring of valid cells bordering the holes
+    #    The nearest valid cell of any hole cell lies on this ring, and the
+    #    triangles covering a hole are spanned by cells on its border.
+    ring_mask = binary_dilation(
+        nodata_mask, structure=np.ones((3, 3), dtype=bool), iterations=ring_width
+    )
+    ring_mask &= valid_mask
+
+    # 3. Prepare input points and values for interpolation
+    ring_rows, ring_cols = np.nonzero(ring_mask)
+    hole_rows, hole_cols = np.nonzero(nodata_mask)
+    points = np.column_stack((ring_cols, ring_rows))
+    values = filled_dem[ring_rows, ring_cols]
+
+    # 4. First Pass: Linear interpolation at the hole cells only
+    hole_values = griddata(points, values, (hole_cols, hole_rows), method='linear')
+
+    # 5. Second Pass: Nearest-neighbor interpolation for the leftover NaNs
+    still_nan = np.isnan(hole_values)
+    if np.any(still_nan):
+        hole_values[still_nan] = griddata(
+            points, values, (hole_cols[still_nan], hole_rows[still_nan]), method='nearest'
+        )
+
+    filled_dem[hole_rows, hole_cols] = hole_values
+    return filled_dem
+
+def interpolate_nodata_global(dem_data, nodata_value):
+    """
+    Interpolate and fill nodata cells in a 2D DEM array using
+    a two-step approach over the full grid:
+      1) Linear interpolation (via griddata)
+      2) Nearest-neighbor fallback for any unfilled cells
+
+    This is the reference implementation behind interpolate_nodata(ring_width=None).
+
     Parameters
     ----------
     dem_data : 2D np.ndarray
@@ -97,6 +193,97 @@ def interpolate_nodata(dem_data, nodata_value):
 
     return filled_dem
 
+# Compact output profiles for the GeoTIFFs written by the pipeline: float32,
+# compressed with a floating-point predictor, internally tiled, with overviews
+# in Cloud-Optimized GeoTIFF layout. None keeps the source profile
+# (float64, uncompressed, striped).
+OUTPUT_PROFILES = {
+    'cog': {'dtype': 'float32', 'compress': 'deflate', 'predictor': 3},
+    'cog-zstd': {'dtype': 'float32', 'compress': 'zstd', 'predictor': 3},
+}
+COG_OPTIONS = {'blocksize': 512, 'overview_resampling': 'average'}
+
+_raster_bytes_written = 0
+# The list write_raster queues its writes into, or None when they are written at once
+_deferred_writes = None
+
+def raster_bytes_written():
+    """Total size in bytes of the GeoTIFFs written by this process so far."""
+    return _raster_bytes_written
+
+def _record_bytes_written(path):
+    global _raster_bytes_written
+    _raster_bytes_written += os.path.getsize(path)
+
+def output_creation_profile(profile, output_profile=None):
+    """
+    Rasterio creation profile of a GeoTIFF written with one of OUTPUT_PROFILES.
+
+    Parameters
+    ----------
+    profile : dict
+        Source profile (size, transform, CRS, nodata, ...).
+    output_profile : {'cog', 'cog-zstd'}, optional
+        If None, the source profile is returned unchanged.
+    """
+    if output_profile is None:
+        return dict(profile)
+    if output_profile not in OUTPUT_PROFILES:
+        raise ValueError(f"Unknown output profile '{output_profile}', expected one of {tuple(OUTPUT_PROFILES)}")
+    layout_keys = ('driver', 'blockxsize', 'blockysize', 'tiled', 'compress', 'predictor', 'interleave')
+    creation = {key: value for key, value in profile.items() if key not in layout_keys}
+    creation.update(OUTPUT_PROFILES[output_profile])
+    creation.update(COG_OPTIONS)
+    creation['driver'] = 'COG'
+    return creation
+
+@contextmanager
+def defer_raster_writes():
+    """
+    Queue the GeoTIFF writes of the enclosed code instead of writing them, e.g.,
+    to hand them to an I/O thread (see pipeline.py). Yields the list of queued
+    (path, array, profile, output_profile) writes, which write_raster(*write)
+    performs later. Queued writes return 0 bytes.
+    """
+    global _deferred_writes
+    previous = _deferred_writes
+    _deferred_writes = []
+    try:
+        yield _deferred_writes
+    finally:
+        _deferred_writes = previous
+
+def write_raster(path, array, profile, output_profile=None):
+    """
+    Write a single-band array to a GeoTIFF.
+
+    Parameters
+    ----------
+    path : str
+        Output path.
+    array : 2D np.ndarray
+        Values to write.
+    profile : dict
+        Source profile (size, transform, CRS, nodata, ...).
+    output_profile : {'cog', 'cog-zstd'}, optional
+        Compact output profile (see OUTPUT_PROFILES). If None, use `profile` as is.
+
+    Returns
+    -------
+    n_bytes : int
+        Size of the written file, 0 if the write is deferred (see defer_raster_writes).
+    """
+    if _deferred_writes is not None:
+        _deferred_writes.append((path, array, profile, output_profile))
+        return 0
+    creation = output_creation_profile(profile, output_profile)
+    with span('write_raster', path=path, cells=array.size) as attrs:
+        with rasterio.open(path, 'w', **creation) as dst:
+            dst.write(array.astype(creation['dtype'], copy=False), 1)
+        _record_bytes_written(path)
+        attrs['bytes'] = os.path.getsize(path)
+    return attrs['bytes']
+
 def read_dem(dem_path):
     """
     Read a single-band DEM (GeoTIFF) using Rasterio.
@@ -119,9 +306,10 @@ def read_dem(dem_path):
     profile : dict
         Raster metadata/profile from Rasterio.
     """
-    with rasterio.open(dem_path) as src:
+    with span('read_dem', path=dem_path) as attrs, rasterio.open(dem_path) as src:
         # Read the first (and typically only) band
         dem_data = src.read(1)
+        attrs['cells'] = dem_data.size
         
         # Profile contains metadata such as transform, CRS, dtype, etc.
         profile = src.profile
@@ -137,62 +325,150 @@ def read_dem(dem_path):
     
     return dem_data, pixel_width, pixel_height, nodata_value, profile
 
-def estimate_volume(dem_path, reference_elevation, save_path=None):
+def largest_contour_mask(binary_mask, area_threshold=None):
     """
-    Estimate the volume of a reservoir above a reference elevation.
-    
+    Filled largest external contour of a binary mask.
+
+    Parameters
+    ----------
+    binary_mask : 2D np.ndarray
+        Mask whose nonzero cells are traced.
+    area_threshold : float, optional
+        Contours with an area not above this threshold are ignored.
+
+    Returns
+    -------
+    contour_mask : 2D np.ndarray of uint8 or None
+        1 inside the largest contour, or None if there is no contour
+        (above area_threshold).
+    """
+    # Find contours in the binary image
+    contours, _ = cv2.findContours(binary_mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    # Sort the contours by area (largest first)
+    contours = sorted(contours, key=cv2.contourArea, reverse=True)
+
+    # remove small contours 
+    if area_threshold is not None:
+        contours = [contour for contour in contours if cv2.contourArea(contour) > area_threshold]
+
+    if len(contours) == 0:
+        return None
+    contour_mask = np.zeros(binary_mask.shape, dtype=np.uint8)
+    cv2.drawContours(contour_mask, [contours[0]], 0, 1, thickness=cv2.FILLED)
+    return contour_mask
+
+def clip_to_footprint(dem_data, nodata_value, profile, footprint, buffer=0.0):
+    """
+    Crop a DEM to the bounding box of a footprint polygon widened by buffer,
+    and set the cells whose centers lie farther than buffer outside the
+    polygon to nodata.
+
+    Returns
+    -------
+    dem_data : 2D np.ndarray
+        The cropped DEM.
+    profile : dict
+        The profile of the cropped DEM, with its transform and shape.
+    inside : 2D np.ndarray of bool
+        The cells within the buffered footprint.
+    """
+    transform = profile['transform']
+    x = transform.c + (np.arange(dem_data.shape[1]) + 0.5) * transform.a
+    y = transform.f + (np.arange(dem_data.shape[0]) + 0.5) * transform.e
+    min_x, min_y, max_x, max_y = region_bounds(polygon=footprint, buffer=buffer)
+    cols = np.flatnonzero((x >= min_x) & (x <= max_x))
+    rows = np.flatnonzero((y >= min_y) & (y <= max_y))
+    if len(cols) == 0 or len(rows) == 0:
+        raise ValueError("The footprint does not overlap the DEM")
+    window = Window(cols[0], rows[0], cols[-1] - cols[0] + 1, rows[-1] - rows[0] + 1)
+    dem_data = dem_data[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1].copy()
+
+    # Cells outside the buffered footprint become nodata
+    grid_x, grid_y = np.meshgrid(x[cols[0]:cols[-1] + 1], y[rows[0]:rows[-1] + 1])
+    inside = region_mask(grid_x.ravel(), grid_y.ravel(), polygon=footprint, buffer=buffer).reshape(dem_data.shape)
+    dem_data[~inside] = nodata_value
+
+    profile = dict(profile, height=dem_data.shape[0], width=dem_data.shape[1], transform=window_transform(window, transform))
+    return dem_data, profile, inside
+
+def load_filled_dem(dem_path, footprint=None, buffer=0.0):
+    """
+    Read a DEM, fill its nodata cells and keep only the largest region of valid data.
+
     Parameters
     ----------
     dem_path : str
         The file path to the DEM in GeoTIFF format.
-    reference_elevation : float
-        The reference elevation in the same units as the DEM.
-    
+    footprint : array_like, optional
+        (n, 2) vertices of the basin footprint. If given, the DEM is clipped to
+        the footprint widened by buffer (see clip_to_footprint) before the
+        nodata cells are filled and the largest region is traced.
+    buffer : float, optional
+        Width by which the footprint is widened. Default is 0.
+
     Returns
     -------
-    volume : float
-        The estimated volume above the reference elevation.
+    dem_filled : 2D np.ndarray
+        Filled elevations inside the largest contour of valid data, 9999 outside.
+    pixel_width : float
+        Horizontal size of each pixel in map units (e.g., meters).
+    pixel_height : float
+        Vertical size of each pixel in map units (e.g., meters).
+    profile : dict
+        Raster metadata/profile from Rasterio.
     """
     # Read the DEM
-    dem_data, pixel_width, pixel_height, nodata_value, profile = read_dem(dem_path)
+    return fill_dem(*read_dem(dem_path), footprint=footprint, buffer=buffer)
+
+def fill_dem(dem_data, pixel_width, pixel_height, nodata_value, profile, footprint=None, buffer=0.0):
+    """
+    load_filled_dem of a DEM already in memory, as returned by read_dem.
+    """
+    inside = None
+    if footprint is not None:
+        if nodata_value is None:
+            nodata_value = -9999
+            profile = dict(profile, nodata=nodata_value)
+        with span('clip_to_footprint', cells=dem_data.size):
+            dem_data, profile, inside = clip_to_footprint(dem_data, nodata_value, profile, footprint, buffer)
 
-    # Get the center pixel coordinates of the DEM
-    rows, cols = dem_data.shape
-    center_x = cols // 2
-    center_y = rows // 2
-    
     # Linearly interpolate the elevation values at nodata pixels
-    dem_filled = interpolate_nodata(dem_data, nodata_value)
+    with span('interpolate_nodata', cells=dem_data.size):
+        dem_filled = interpolate_nodata(dem_data, nodata_value, mask=inside)
 
     # find the largest contour in dem_data
-    dem_data_mask = np.where(dem_data != nodata_value, 1, 0)
-    contours, _ = cv2.findContours(dem_data_mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    contours = sorted(contours, key=cv2.contourArea, reverse=True)
-    largest_contour = contours[0]
-    dem_data_contour = np.zeros_like(dem_data, dtype=np.uint8)
-    cv2.drawContours(dem_data_contour, [largest_contour], 0, 1, thickness=cv2.FILLED)
+    with span('contour', cells=dem_data.size):
+        dem_data_contour = largest_contour_mask(dem_data != nodata_value)
 
     # keep the values of the largest contour in dem_filled
     dem_filled = np.where(dem_data_contour, dem_filled, 9999)
 
-    # Get a mask of DEM cells below the reference elevation
-    below_ref_mask = dem_filled < reference_elevation
+    return dem_filled, pixel_width, pixel_height, profile
 
-    # Find contours in the binary image
-    contours, _ = cv2.findContours(below_ref_mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+def pool_mask(dem_filled, reference_elevation):
+    """
+    Mask of the reservoir below a reference elevation: the largest contour of
+    cells below it, filled.
 
-    # Sort the contours by area (largest first)
-    contours = sorted(contours, key=cv2.contourArea, reverse=True)
+    Parameters
+    ----------
+    dem_filled : 2D np.ndarray
+        Filled DEM from load_filled_dem.
+    reference_elevation : float
+        The reference elevation in the same units as the DEM.
 
-    # remove small contours 
-    area_threshold = 20
-    contours = [contour for contour in contours if cv2.contourArea(contour) > area_threshold]
+    Returns
+    -------
+    ref_mask : 2D np.ndarray of uint8 or None
+        1 inside the reservoir, or None if no contour is larger than 20 pixels.
+    """
+    # Get a mask of DEM cells below the reference elevation
+    below_ref_mask = dem_filled < reference_elevation
 
-    if len(contours) == 0:
-        return 0
-    largest_contour = contours[0]
-    ref_mask = np.zeros_like(dem_filled, dtype=np.uint8)
-    cv2.drawContours(ref_mask, [largest_contour], 0, 1, thickness=cv2.FILLED)
+    # Fill the largest contour, ignoring small contours
+    with span('pool_mask', reference_elevation=float(reference_elevation)):
+        ref_mask = largest_contour_mask(below_ref_mask, area_threshold=20)
 
     # # Calculate the centroid of each contour
     # centroids = [np.mean(contour, axis=0).squeeze() for contour in contours]
@@ -209,123 +485,789 @@ def estimate_volume(dem_path, reference_elevation, save_path=None):
     # ref_mask = np.zeros_like(dem_filled, dtype=np.uint8)
     # cv2.drawContours(ref_mask, [closest_contour], -1, 1, thickness=cv2.FILLED)
 
+    return ref_mask
 
+def save_masked_dem(save_path, dem_filled, ref_mask, reference_elevation, profile, output_profile=None):
+    """Save the DEM inside ref_mask, with reference_elevation as nodata elsewhere."""
+    masked_dem = np.where(ref_mask, dem_filled, reference_elevation)
+    profile = dict(profile)
+    profile.update(nodata=reference_elevation)
+    write_raster(save_path, masked_dem, profile, output_profile)
 
-    # Calculate the volume between the reference elevation and the DEM
-    volume = np.sum((reference_elevation - dem_filled) * ref_mask) * pixel_width * pixel_height
+def estimate_volume(dem_path, reference_elevation, save_path=None, tile_size=None, output_profile=None):
+    """
+    Estimate the volume of a reservoir above a reference elevation.
+    
+    Parameters
+    ----------
+    dem_path : str
+        The file path to the DEM in GeoTIFF format.
+    reference_elevation : float
+        The reference elevation in the same units as the DEM.
+    save_path : str, optional
+        Path where the DEM masked to the reservoir is saved.
+    tile_size : int, optional
+        If given, process the DEM in tiles of this size (see capacity_curve_windowed)
+        instead of loading it whole.
+    output_profile : {'cog', 'cog-zstd'}, optional
+        Compact layout of the saved raster (see OUTPUT_PROFILES).
+    
+    Returns
+    -------
+    volume : float
+        The estimated volume above the reference elevation.
+    """
+    if tile_size is not None:
+        save_paths = [(reference_elevation, save_path)] if save_path is not None else None
+        return capacity_curve_windowed(
+            dem_path, [reference_elevation], save_paths, tile_size=tile_size, output_profile=output_profile
+        )[0]
+
+    with span('estimate_volume', path=dem_path, reference_elevation=reference_elevation):
+        dem_filled, pixel_width, pixel_height, profile = load_filled_dem(dem_path)
 
-    if save_path is not None:
-        # save the dem with the ref_mask
-        masked_dem = np.where(ref_mask, dem_filled, reference_elevation)
-        profile.update(nodata=reference_elevation)
-        with rasterio.open(save_path, 'w', **profile) as dst:
-            dst.write(masked_dem, 1)
+        ref_mask = pool_mask(dem_filled, reference_elevation)
+        if ref_mask is None:
+            return 0
+
+        # Calculate the volume between the reference elevation and the DEM
+        volume = np.sum((reference_elevation - dem_filled) * ref_mask) * pixel_width * pixel_height
+
+        if save_path is not None:
+            # save the dem with the ref_mask
+            save_masked_dem(save_path, dem_filled, ref_mask, reference_elevation, profile, output_profile)
 
     return volume
-    
-def extract_ground_points(input_las, output_las=None):
-    las = laspy.read(input_las)
+
+def save_path_pairs(save_paths):
+    """(elevation, path) pairs of a save_paths argument, given as pairs or as a dict keyed by elevation."""
+    if save_paths is None:
+        return []
+    if isinstance(save_paths, dict):
+        return list(save_paths.items())
+    return list(save_paths)
+
+def _paths_at(save_paths, reference_elevation, previous_elevations):
+    # the paths of an elevation, saved once even if it is repeated in elevations
+    if reference_elevation in previous_elevations:
+        return []
+    return [save_path for elevation, save_path in save_paths if elevation == reference_elevation]
+
+def capacity_curve(dem, elevations, method='cumulative', save_paths=None, tile_size=None, output_profile=None):
+    """
+    Estimate reservoir volumes for many reference elevations from one DEM load.
+
+    The DEM is read and filled once. With method='cumulative', the reservoir is
+    the pool of the highest elevation (see pool_mask); its cells are sorted once
+    and the volume at every elevation h is read from cumulative sums as
+    h * n(h) - sum(z < h), so a curve at 1 cm steps costs about one volume.
+    Cells inside the pool outline that stand above h are not counted, whereas
+    estimate_volume subtracts them. With method='contour', the pool is traced
+    per elevation exactly as in estimate_volume.
+
+    Parameters
+    ----------
+    dem : str or tuple
+        The file path to the DEM in GeoTIFF format, or the tuple returned by
+        load_filled_dem for a DEM that is already loaded.
+    elevations : array_like
+        Reference elevations in the same units as the DEM.
+    method : {'cumulative', 'contour'}, optional
+        How the reservoir is delineated. Default is 'cumulative'.
+    save_paths : list of (float, str) or dict, optional
+        (elevation, path) pairs of the masked DEMs to save, as with
+        estimate_volume(save_path=...); several paths may share an elevation.
+        A dict maps elevations to paths.
+    tile_size : int, optional
+        If given, process the DEM path in tiles of this size with the 'contour'
+        method (see capacity_curve_windowed) instead of loading it whole.
+    output_profile : {'cog', 'cog-zstd'}, optional
+        Compact layout of the saved rasters (see OUTPUT_PROFILES).
+
+    Returns
+    -------
+    volumes : 1D np.ndarray
+        The estimated volume at each elevation, in the order given.
+    """
+    if method not in ('cumulative', 'contour'):
+        raise ValueError(f"Unknown method '{method}', expected 'cumulative' or 'contour'")
+
+    if tile_size is not None:
+        return capacity_curve_windowed(
+            dem, elevations, save_paths, tile_size=tile_size, output_profile=output_profile
+        )
+
+    elevations = np.atleast_1d(np.asarray(elevations, dtype=float))
+    save_paths = save_path_pairs(save_paths)
+    volumes = np.zeros(len(elevations))
+    if len(elevations) == 0:
+        return volumes
+
+    if isinstance(dem, tuple):
+        dem_filled, pixel_width, pixel_height, profile = dem
+    else:
+        dem_filled, pixel_width, pixel_height, profile = load_filled_dem(dem)
+    cell_area = pixel_width * pixel_height
+
+    if method == 'contour':
+        for i, reference_elevation in enumerate(elevations):
+            ref_mask = pool_mask(dem_filled, reference_elevation)
+            if ref_mask is None:
+                continue
+            volumes[i] = np.sum((reference_elevation - dem_filled) * ref_mask) * cell_area
+            for save_path in _paths_at(save_paths, reference_elevation, elevations[:i]):
+                save_masked_dem(save_path, dem_filled, ref_mask, reference_elevation, profile, output_profile)
+        return volumes
+
+    region = pool_mask(dem_filled, elevations.max())
+    if region is None:
+        return volumes
+    region = region.astype(bool)
+
+    # Sort the pool cells once and integrate with cumulative sums
+    z_sorted = np.sort(dem_filled[region])
+    z_cumsum = np.r_[0.0, np.cumsum(z_sorted)]
+    n_below = np.searchsorted(z_sorted, elevations, side='left')
+    volumes = (elevations * n_below - z_cumsum[n_below]) * cell_area
+
+    for reference_elevation, save_path in save_paths:
+        ref_mask = region & (dem_filled < reference_elevation)
+        save_masked_dem(save_path, dem_filled, ref_mask, reference_elevation, profile, output_profile)
+
+    return volumes
+
+def spill_levels(dem_filled, seed_row, seed_col):
+    """
+    Priority-flood level of every cell when flooding from a seed cell.
+
+    The level of a cell is the lowest water elevation at which it is connected
+    to the seed, i.e., the smallest possible maximum elevation along an
+    8-connected path from the seed to the cell. The pool at elevation h is then
+    every cell whose level is below h, connected to the seed by construction.
+
+    Levels are computed in one O(n log n) pass: the minimax paths from the seed
+    run along the minimum spanning tree of the grid graph whose edges weigh the
+    higher of their two cells, and the path maxima are propagated up that tree
+    by pointer jumping, without a per-cell Python loop.
+
+    Parameters
+    ----------
+    dem_filled : 2D np.ndarray
+        Filled DEM from load_filled_dem.
+    seed_row, seed_col : int
+        The seed cell, e.g., the outlet of the basin.
+
+    Returns
+    -------
+    levels : 2D np.ndarray
+        Flood level of each cell, inf for cells not connected to the seed.
+
+    Raises
+    ------
+    ValueError
+        If the seed lies outside the DEM or on nodata, where every level
+        would be 9999 and every volume 0.
+    """
+    rows, cols = dem_filled.shape
+    if not (0 <= seed_row < rows and 0 <= seed_col < cols):
+        raise ValueError(f"Seed cell ({seed_row}, {seed_col}) is outside the DEM")
+    if not np.isfinite(dem_filled[seed_row, seed_col]) or dem_filled[seed_row, seed_col] == 9999:
+        raise ValueError(f"Seed cell ({seed_row}, {seed_col}) is on nodata")
+    n_cells = rows * cols
+    z = dem_filled.ravel().astype(float)
+    index = np.arange(n_cells).reshape(rows, cols)
+
+    # 1. 8-connected grid graph, each edge weighing the higher of its cells
+    #    (shifted to be positive, since zero weights are dropped by scipy)
+    a = np.concatenate([
+        index[:, :-1].ravel(), index[:-1, :].ravel(), index[:-1, :-1].ravel(), index[:-1, 1:].ravel()
+    ])
+    b = np.concatenate([
+        index[:, 1:].ravel(), index[1:, :].ravel(), index[1:, 1:].ravel(), index[1:, :-1].ravel()
+    ])
+    weights = np.maximum(z[a], z[b]) - z.min() + 1.0
+    graph = coo_matrix((weights, (a, b)), shape=(n_cells, n_cells)).tocsr()
+
+    # 2. Minimum spanning tree, rooted at the seed
+    tree = minimum_spanning_tree(graph)
+    seed = seed_row * cols + seed_col
+    _, parent = breadth_first_order(tree, seed, directed=False, return_predecessors=True)
+    unreached = parent < 0
+    parent[unreached] = np.flatnonzero(unreached)
+
+    # 3. Maximum elevation from each cell up to the seed, by pointer jumping
+    levels = np.maximum(z, z[parent])
+    levels[unreached] = np.inf
+    levels[seed] = z[seed]
+    ancestor = parent
+    while True:
+        levels = np.maximum(levels, levels[ancestor])
+        next_ancestor = ancestor[ancestor]
+        if np.array_equal(next_ancestor, ancestor):
+            break
+        ancestor = next_ancestor
+
+    return levels.reshape(rows, cols)
+
+def outlet_cell(dem_filled, pixel_width, pixel_height, profile, outlet_xy, snap_radius=0.0):
+    """
+    (row, col) of the cell of a filled DEM under an outlet coordinate, or of the
+    lowest cell within snap_radius of it.
+
+    Raises
+    ------
+    ValueError
+        If the outlet lies outside the DEM or on nodata (9999 in a filled DEM),
+        from which no pool could be flooded.
+    """
+    rows, cols = dem_filled.shape
+    seed_row, seed_col = rasterio.transform.rowcol(profile['transform'], outlet_xy[0], outlet_xy[1])
+    if not (0 <= seed_row < rows and 0 <= seed_col < cols):
+        raise ValueError(f"Outlet {outlet_xy} is outside the DEM")
+    if snap_radius > 0:
+        radius = int(np.ceil(snap_radius / min(pixel_width, pixel_height)))
+        row0, col0 = max(seed_row - radius, 0), max(seed_col - radius, 0)
+        window = dem_filled[row0:seed_row + radius + 1, col0:seed_col + radius + 1]
+        low_row, low_col = np.unravel_index(np.argmin(window), window.shape)
+        seed_row, seed_col = row0 + low_row, col0 + low_col
+    if not np.isfinite(dem_filled[seed_row, seed_col]) or dem_filled[seed_row, seed_col] == 9999:
+        raise ValueError(f"Outlet {outlet_xy} is on nodata")
+    return int(seed_row), int(seed_col)
+
+def flood_capacity_curve(
+    dem,
+    elevations,
+    outlet_xy,
+    snap_radius=0.0,
+    save_paths=None,
+    levels_path=None,
+    output_profile=None
+):
+    """
+    Estimate reservoir volumes by flooding from the basin outlet.
+
+    Unlike pool_mask, which keeps the largest contour below each elevation and
+    can pick a disconnected depression, the pool here is the set of cells
+    connected to the outlet below each elevation (see spill_levels). Cells
+    sorted by flood level give the volume at every elevation from cumulative
+    sums, so the whole curve costs one flood.
+
+    Parameters
+    ----------
+    dem : str or tuple
+        The file path to the DEM in GeoTIFF format, or the tuple returned by
+        load_filled_dem.
+    elevations : array_like
+        Reference elevations in the same units as the DEM.
+    outlet_xy : tuple of float
+        Map coordinates (x, y) of a point inside the pool, e.g., the outlet
+        riser at the bottom of the basin.
+    snap_radius : float, optional
+        If positive, the seed moves to the lowest cell within this distance
+        (in map units) of outlet_xy. Default is 0.
+    save_paths : list of (float, str) or dict, optional
+        (elevation, path) pairs of the DEMs masked to the connected pool to
+        save (see capacity_curve).
+    levels_path : str, optional
+        Path where the flood level raster is saved. The connected pool at any
+        elevation h is the area where the level is below h.
+    output_profile : {'cog', 'cog-zstd'}, optional
+        Compact layout of the saved rasters (see OUTPUT_PROFILES).
+
+    Returns
+    -------
+    volumes : 1D np.ndarray
+        The estimated volume at each elevation, in the order given.
+
+    Raises
+    ------
+    ValueError
+        If the outlet lies outside the DEM or on nodata (see outlet_cell).
+    """
+    elevations = np.atleast_1d(np.asarray(elevations, dtype=float))
+    save_paths = save_path_pairs(save_paths)
+
+    if isinstance(dem, tuple):
+        dem_filled, pixel_width, pixel_height, profile = dem
+    else:
+        dem_filled, pixel_width, pixel_height, profile = load_filled_dem(dem)
+
+    # 1. Seed cell at the outlet, optionally snapped to the lowest nearby cell
+    seed_row, seed_col = outlet_cell(dem_filled, pixel_width, pixel_height, profile, outlet_xy, snap_radius)
+
+    # 2. Flood once, then integrate every elevation from cumulative sums
+    levels = spill_levels(dem_filled, seed_row, seed_col)
+    order = np.argsort(levels, axis=None)
+    levels_sorted = levels.ravel()[order]
+    z_cumsum = np.r_[0.0, np.cumsum(dem_filled.ravel()[order])]
+    n_below = np.searchsorted(levels_sorted, elevations, side='left')
+    volumes = (elevations * n_below - z_cumsum[n_below]) * pixel_width * pixel_height
+
+    for reference_elevation, save_path in save_paths:
+        save_masked_dem(
+            save_path, dem_filled, levels < reference_elevation, reference_elevation, profile, output_profile
+        )
+    if levels_path is not None:
+        levels_profile = dict(profile, nodata=-9999)
+        write_raster(levels_path, np.where(np.isfinite(levels), levels, -9999), levels_profile, output_profile)
+
+    return volumes
+
+def tile_windows(height, width, tile_size):
+    """Row-major windows of at most tile_size x tile_size pixels covering a raster."""
+    for row_off in range(0, height, tile_size):
+        for col_off in range(0, width, tile_size):
+            yield Window(
+                col_off, row_off,
+                min(tile_size, width - col_off), min(tile_size, height - row_off)
+            )
+
+def halo_window(window, halo, height, width):
+    """
+    Grow a window by `halo` pixels on every side, clipped to the raster.
+
+    Returns
+    -------
+    outer : rasterio.windows.Window
+        The grown window.
+    inner : tuple of slice
+        Where the original window sits inside an array read with `outer`.
+    """
+    row0 = max(window.row_off - halo, 0)
+    col0 = max(window.col_off - halo, 0)
+    row1 = min(window.row_off + window.height + halo, height)
+    col1 = min(window.col_off + window.width + halo, width)
+    outer = Window(col0, row0, col1 - col0, row1 - row0)
+    inner = (
+        slice(window.row_off - row0, window.row_off - row0 + window.height),
+        slice(window.col_off - col0, window.col_off - col0 + window.width)
+    )
+    return outer, inner
+
+def window_slices(window):
+    """Array slices of a window in a full-size array."""
+    return (
+        slice(window.row_off, window.row_off + window.height),
+        slice(window.col_off, window.col_off + window.width)
+    )
+
+def capacity_curve_windowed(dem_path, elevations, save_paths=None, tile_size=1024, halo=64, output_profile=None):
+    """
+    Estimate reservoir volumes tile by tile for DEMs larger than memory.
+
+    Follows capacity_curve(method='contour') in three passes over rasterio windows:
+      1) each tile is read with a halo of `halo` pixels, filled with
+         interpolate_nodata and written to a temporary filled GeoTIFF;
+      2) per elevation, the cells below it are collected tile by tile into a
+         uint8 mask and the pool is traced on that mask as in pool_mask;
+      3) the volume is summed tile by tile, and the masked DEM is written
+         window by window.
+    Elevations are only ever held a tile at a time. The full-size arrays are
+    uint8 masks, about 1 byte per pixel against the ~40 bytes per pixel of the
+    in-memory path. Holes wider than the halo can be filled slightly
+    differently from the in-memory path near tile edges.
+
+    Parameters
+    ----------
+    dem_path : str
+        The file path to the DEM in GeoTIFF format.
+    elevations : array_like
+        Reference elevations in the same units as the DEM.
+    save_paths : list of (float, str) or dict, optional
+        (elevation, path) pairs of the masked DEMs to save (see capacity_curve).
+    tile_size : int, optional
+        Tile edge in pixels, rounded down to a multiple of 16. Default is 1024.
+    halo : int, optional
+        Overlap in pixels read around each tile for filling. Default is 64.
+    output_profile : {'cog', 'cog-zstd'}, optional
+        Compact layout of the saved rasters (see OUTPUT_PROFILES). They are
+        written tile by tile to a temporary tiled GeoTIFF, then copied to
+        Cloud-Optimized layout.
+
+    Returns
+    -------
+    volumes : 1D np.ndarray
+        The estimated volume at each elevation, in the order given.
+    """
+    elevations = np.atleast_1d(np.asarray(elevations, dtype=float))
+    save_paths = save_path_pairs(save_paths)
+    volumes = np.zeros(len(elevations))
+    tile_size = max(16, tile_size // 16 * 16)
+    block_size = min(256, tile_size)
+
+    tmp_dir = tempfile.mkdtemp()
+    filled_path = os.path.join(tmp_dir, 'filled.tif')
+    try:
+        # 1. Fill the nodata cells tile by tile, keeping a uint8 mask of valid data
+        with rasterio.open(dem_path) as src:
+            profile = src.profile
+            height, width = src.height, src.width
+            pixel_width = abs(src.transform[0])
+            pixel_height = abs(src.transform[4])
+            nodata_value = profile.get('nodata', None)
+            tiled_profile = dict(
+                profile, dtype='float64', tiled=True, blockxsize=block_size, blockysize=block_size
+            )
+            valid_mask = np.zeros((height, width), dtype=np.uint8)
+            with rasterio.open(filled_path, 'w', **tiled_profile) as dst:
+                for window in tile_windows(height, width, tile_size):
+                    outer, inner = halo_window(window, halo, height, width)
+                    dem_data = src.read(1, window=outer)
+                    dst.write(interpolate_nodata(dem_data, nodata_value)[inner], 1, window=window)
+                    valid_mask[window_slices(window)] = dem_data[inner] != nodata_value
+
+        # keep the largest contour of valid data, as in load_filled_dem
+        footprint = largest_contour_mask(valid_mask)
+        del valid_mask
+        if footprint is None:
+            return volumes
+
+        with rasterio.open(filled_path) as filled_src:
+            for i, reference_elevation in enumerate(elevations):
+                # 2. Cells below the reference elevation, then the pool as in pool_mask
+                below_ref_mask = np.zeros((height, width), dtype=np.uint8)
+                for window in tile_windows(height, width, tile_size):
+                    sl = window_slices(window)
+                    below_ref_mask[sl] = footprint[sl] & (filled_src.read(1, window=window) < reference_elevation)
+                ref_mask = largest_contour_mask(below_ref_mask, area_threshold=20)
+                del below_ref_mask
+                if ref_mask is None:
+                    continue
+
+                # 3. Sum the volume and write the masked DEM tile by tile; other
+                #    paths at the same elevation get a copy
+                paths = _paths_at(save_paths, reference_elevation, elevations[:i])
+                save_path = paths[0] if len(paths) > 0 else None
+                dst = None
+                if save_path is not None:
+                    masked_profile = dict(tiled_profile, nodata=reference_elevation)
+                    write_path = save_path
+                    if output_profile is not None:
+                        masked_profile.update(OUTPUT_PROFILES[output_profile])
+                        write_path = os.path.join(tmp_dir, 'masked.tif')
+                    dst = rasterio.open(write_path, 'w', **masked_profile)
+                try:
+                    volume = 0.0
+                    for window in tile_windows(height, width, tile_size):
+                        tile_mask = ref_mask[window_slices(window)]
+                        dem_filled = filled_src.read(1, window=window)
+                        volume += np.sum((reference_elevation - dem_filled) * tile_mask)
+                        if dst is not None:
+                            dst.write(np.where(tile_mask, dem_filled, reference_elevation), 1, window=window)
+                finally:
+                    if dst is not None:
+                        dst.close()
+                if save_path is not None:
+                    if output_profile is not None:
+                        # streamed copy into Cloud-Optimized layout, overviews included
+                        rasterio_copy(
+                            write_path, save_path, driver='COG',
+                            compress=OUTPUT_PROFILES[output_profile]['compress'],
+                            predictor=OUTPUT_PROFILES[output_profile]['predictor'],
+                            **COG_OPTIONS
+                        )
+                    _record_bytes_written(save_path)
+                    for copy_path in paths[1:]:
+                        shutil.copyfile(save_path, copy_path)
+                        _record_bytes_written(copy_path)
+                volumes[i] = volume * pixel_width * pixel_height
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return volumes
+
+def report_throughput(n_points, start_time, label='Processed'):
+    """Print points/s and peak RSS at the end of a streamed run."""
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    rss = peak_rss_mb()
+    rss_text = f"{rss:.0f} MB" if rss is not None else "n/a"
+    print(f"{label} {n_points} points in {elapsed:.2f} s "
+          f"({n_points / elapsed:,.0f} points/s), peak RSS {rss_text}")
+
+def extract_ground_points(input_las, output_las=None, chunk_size=None, bounds=None, polygon=None, buffer=0.0):
+    """
+    Extract ground-classified (2) points from a LAS/LAZ file.
+
+    Parameters
+    ----------
+    input_las : str
+        Path to the input LAS/LAZ file.
+    output_las : str, optional
+        Path to write the ground points to.
+    chunk_size : int, optional
+        If given, stream the file in chunks of this many points and write the
+        ground points chunk by chunk, so memory is bounded by the chunk size.
+        Requires output_las.
+    bounds : tuple of float, optional
+        (min_x, min_y, max_x, max_y) of the area of interest. With bounds or a
+        polygon, only the points inside are read, through the spatial index
+        of the LAS file (see spatial_index.SpatialIndex).
+    polygon : array_like, optional
+        (n, 2) vertices of the area of interest.
+    buffer : float, optional
+        Width by which the area of interest is widened. Default is 0.
+
+    Returns
+    -------
+    ground_points : laspy.LasData or int
+        The ground points, or the number of ground points written when streaming.
+    """
+    if chunk_size is not None:
+        if output_las is None:
+            raise ValueError("output_las is required when chunk_size is given")
+        start_time = time.perf_counter()
+        n_read = 0
+        n_ground = 0
+        with laspy.open(input_las) as reader:
+            with laspy.open(output_las, mode='w', header=copy.deepcopy(reader.header)) as writer:
+                if bounds is None and polygon is None:
+                    chunks = reader.chunk_iterator(chunk_size)
+                else:
+                    chunks = iter_region(input_las, bounds, polygon, chunk_size, buffer=buffer)
+                for chunk in chunks:
+                    ground_mask = (chunk.classification == 2)
+                    writer.write_points(chunk[ground_mask])
+                    n_read += len(chunk)
+                    n_ground += int(np.count_nonzero(ground_mask))
+        print(f"Ground points saved to: {output_las}")
+        report_throughput(n_read, start_time, label='Streamed')
+        return n_ground
+
+    if bounds is None and polygon is None:
+        las = laspy.read(input_las)
+    else:
+        las = read_region(input_las, bounds, polygon, buffer=buffer)
     
     # Boolean mask for ground-classified points (2)
     ground_mask = (las.classification == 2)
     
-    # Create a new, empty LasData object with the same point format and version
-    ground_points = laspy.create(
-        point_format=las.header.point_format,
-        file_version=las.header.version
+    # Slice the raw point record once instead of copying dimension by dimension,
+    # keeping the header (including scale, offset, etc.) of the input
+    ground_points = laspy.LasData(
+        header=copy.deepcopy(las.header),
+        points=las.points[ground_mask]
     )
     
-    # Copy the header (including scale, offset, etc.) using deepcopy
-    ground_points.header = copy.deepcopy(las.header)
-    
-    # Slice each dimension in the original file to keep only ground points
-    for dim_name in las.point_format.dimension_names:
-        ground_points[dim_name] = las[dim_name][ground_mask]
-    
     if output_las is not None:
         ground_points.write(output_las)
         print(f"Ground points saved to: {output_las}")
     
     return ground_points
 
-def pointcloud2dem(
-    las_path,
-    dem_path,
-    resolution=1.0,
-    method='linear',
-    classification_filter=None
-):
+REDUCERS = ('min', 'mean', 'max', 'median', 'last_return')
+
+class RasterAccumulator:
     """
-    Convert a LAS/LAZ point cloud into a DEM (GeoTIFF) by gridding the z-values.
-    
+    Running per-cell reduction of points that arrive in chunks.
+
+    Grid node (row, col) sits at (min_x + col * resolution, min_y + row * resolution),
+    the same locations sampled by the griddata path of pointcloud2dem, and each
+    point is assigned to its nearest node. Points up to one cell past the last
+    node of a row or column, which a grid floored to the extent of the points
+    leaves without a node, are assigned to the last node; points farther out
+    are dropped.
+
+    'min', 'max', 'mean' and 'last_return' are exact whatever the chunking.
+    'median' is the lower median of each cell within a chunk; across chunks the
+    chunk medians are combined by a count-weighted mean, so it is exact when all
+    points of a cell arrive in the same chunk and approximate otherwise.
+    'last_return' expects the caller to pass only last-return points and
+    averages them like 'mean'.
+    """
+
+    def __init__(self, min_x, min_y, n_rows, n_cols, resolution, reducer='mean'):
+        if reducer not in REDUCERS:
+            raise ValueError(f"Unknown reducer '{reducer}', expected one of {REDUCERS}")
+        self.min_x = min_x
+        self.min_y = min_y
+        self.n_rows = n_rows
+        self.n_cols = n_cols
+        self.resolution = resolution
+        self.reducer = reducer
+        self.n_points = 0
+
+        n_cells = n_rows * n_cols
+        self.counts = np.zeros(n_cells, dtype=np.int64)
+        if reducer == 'min':
+            self.values = np.full(n_cells, np.inf)
+        elif reducer == 'max':
+            self.values = np.full(n_cells, -np.inf)
+        else:
+            self.values = np.zeros(n_cells)
+
+    def add(self, x, y, z, weights=None):
+        """
+        Accumulate one chunk of points. With weights, each point stands for
+        that many points, e.g., a cell of a point_pyramid.PointPyramid level
+        with the mean elevation of its points.
+        """
+        # 1. Map every point to the flat index of its nearest grid node
+        col = np.rint((np.asarray(x) - self.min_x) / self.resolution).astype(np.int64)
+        row = np.rint((np.asarray(y) - self.min_y) / self.resolution).astype(np.int64)
+        z = np.asarray(z, dtype=float)
+        # a grid floored to the extent ends less than one cell before its
+        # maximum, so the points nearest to the missing next node go to the last one
+        col[col == self.n_cols] = self.n_cols - 1
+        row[row == self.n_rows] = self.n_rows - 1
+        inside = (col >= 0) & (col < self.n_cols) & (row >= 0) & (row < self.n_rows)
+        if not np.all(inside):
+            col, row, z = col[inside], row[inside], z[inside]
+            if weights is not None:
+                weights = np.asarray(weights)[inside]
+        cell = row * self.n_cols + col
+        n_cells = self.counts.size
+
+        # 2. Reduce the chunk and merge it into the running state
+        if weights is None:
+            counts = np.bincount(cell, minlength=n_cells)
+            self.n_points += len(z)
+        else:
+            counts = np.bincount(cell, weights=weights, minlength=n_cells).astype(np.int64)
+            self.n_points += int(np.sum(weights))
+        self.counts += counts
+        if self.reducer in ('mean', 'last_return'):
+            z_weights = z if weights is None else z * weights
+            self.values += np.bincount(cell, weights=z_weights, minlength=n_cells)
+            return
+
+        # Sort by cell, then by elevation, so each cell is a contiguous, ordered run
+        order = np.lexsort((z, cell))
+        cell_sorted = cell[order]
+        z_sorted = z[order]
+        starts = np.flatnonzero(np.r_[True, cell_sorted[1:] != cell_sorted[:-1]])
+        ends = np.r_[starts[1:], len(cell_sorted)]
+        cells = cell_sorted[starts]
+        if self.reducer == 'min':
+            self.values[cells] = np.minimum(self.values[cells], z_sorted[starts])
+        elif self.reducer == 'max':
+            self.values[cells] = np.maximum(self.values[cells], z_sorted[ends - 1])
+        else:
+            medians = z_sorted[starts + (ends - starts - 1) // 2]
+            self.values[cells] += medians * counts[cells]
+
+    def result(self):
+        """
+        Returns
+        -------
+        grid_z : 2D np.ndarray
+            Reduced elevations, NaN where no point fell into the cell.
+        """
+        grid_z = np.full(self.counts.size, np.nan)
+        occupied = self.counts > 0
+        if self.reducer in ('min', 'max'):
+            grid_z[occupied] = self.values[occupied]
+        else:
+            grid_z[occupied] = self.values[occupied] / self.counts[occupied]
+        return grid_z.reshape(self.n_rows, self.n_cols)
+
+def bin_points(x, y, z, min_x, min_y, n_rows, n_cols, resolution, reducer='mean'):
+    """
+    Rasterize points by binning them to the nearest grid node in one pass.
+
     Parameters
     ----------
-    las_path : str
-        Path to the input LAS/LAZ file.
-    dem_path : str
-        Path to the output GeoTIFF DEM.
-    resolution : float, optional
-        The desired output cell size (in the same horizontal units as the LAS).
-        Default is 1.0 (e.g., 1 meter).
+    x, y, z : 1D np.ndarray
+        Point coordinates.
+    min_x, min_y : float
+        Coordinates of grid node (0, 0).
+    n_rows, n_cols : int
+        Grid shape.
+    resolution : float
+        Grid spacing.
+    reducer : {'min', 'mean', 'max', 'median', 'last_return'}, optional
+        How the points falling into one cell are reduced to a single elevation
+        (see RasterAccumulator).
+
+    Returns
+    -------
+    grid_z : 2D np.ndarray
+        Binned elevations, NaN where no point fell into the cell.
+    """
+    accumulator = RasterAccumulator(min_x, min_y, n_rows, n_cols, resolution, reducer)
+    accumulator.add(x, y, z)
+    return accumulator.result()
+
+def fill_empty_cells(grid_z, method='linear', mask=None):
+    """
+    Fill NaN cells of a binned grid by TIN interpolation from the occupied cells.
+
+    Only the empty cells are sampled, and the triangulation is built on occupied
+    cells rather than on raw points. Cells outside the convex hull of the occupied
+    cells stay NaN, as they would with griddata on the raw points.
+
+    Parameters
+    ----------
+    grid_z : 2D np.ndarray
+        Grid with NaN for empty cells. Modified in place.
     method : {'linear', 'nearest', 'cubic'}, optional
         Interpolation method passed to scipy.interpolate.griddata.
-    classification_filter : list of int, optional
-        List of classification codes to keep. If None, use all points.
-        Example: [2] to keep only ground points. 
-    """
-    # 1. Read the LAS file
-    las = laspy.read(las_path)
-    
-    # 2. Extract coordinates and classification
-    #    Note: las.x, las.y, las.z are NumPy arrays (scaled by header offsets/scales)
-    x = las.x
-    y = las.y
-    z = las.z
-    
-    # If the LAS has classification data and we only want certain classes:
-    if classification_filter is not None and hasattr(las, "classification"):
-        class_mask = np.isin(las.classification, classification_filter)
-        x = x[class_mask]
-        y = y[class_mask]
-        z = z[class_mask]
+    mask : 2D np.ndarray of bool, optional
+        If given, only the empty cells where mask is True are filled,
+        e.g., the cells within a basin footprint.
 
-    # 3. Determine the bounding box
-    min_x, max_x = np.min(x), np.max(x)
-    min_y, max_y = np.min(y), np.max(y)
+    Returns
+    -------
+    grid_z : 2D np.ndarray
+        The same array with interior empty cells filled.
+    """
+    empty_mask = np.isnan(grid_z)
+    if not np.any(empty_mask) or np.all(empty_mask):
+        return grid_z
 
-    # 4. Create a grid of desired resolution
-    #    We'll define a 2D array that spans [min_x, max_x] and [min_y, max_y]
-    grid_x, grid_y = np.meshgrid(
-        np.arange(min_x, max_x, resolution),
-        np.arange(min_y, max_y, resolution)
+    valid_rows, valid_cols = np.nonzero(~empty_mask)
+    if mask is not None:
+        empty_mask &= mask
+    empty_rows, empty_cols = np.nonzero(empty_mask)
+    points = np.column_stack((valid_cols, valid_rows))
+    grid_z[empty_rows, empty_cols] = griddata(
+        points, grid_z[valid_rows, valid_cols], (empty_cols, empty_rows), method=method
     )
+    return grid_z
 
-    # 5. Interpolate z-values onto the grid
-    #    Using griddata with the chosen method (e.g., 'linear' or 'nearest')
-    points = np.column_stack((x, y))
-    grid_z = griddata(points, z, (grid_x, grid_y), method=method)
+def write_dem(dem_path, grid_z, min_x, min_y, resolution, crs_info=None, nodata_val=-9999, output_profile=None):
+    """
+    Write a gridded surface from pointcloud2dem to a single-band GeoTIFF.
+
+    Parameters
+    ----------
+    dem_path : str
+        Path to the output GeoTIFF DEM.
+    grid_z : 2D np.ndarray
+        Gridded elevations, row 0 at min_y. NaN cells are written as nodata_val.
+    min_x, min_y : float
+        Coordinates of grid node (0, 0).
+    resolution : float
+        Grid spacing.
+    crs_info : pyproj.CRS or str, optional
+        Coordinate reference system of the raster.
+    nodata_val : float, optional
+        The no-data value written to the raster. Default is -9999.
+    output_profile : {'cog', 'cog-zstd'}, optional
+        Compact layout of the raster (see OUTPUT_PROFILES). If None, the raster
+        is written as an uncompressed, striped float64 GeoTIFF.
+    """
+    grid_z, new_profile = dem_raster(grid_z, min_x, min_y, resolution, crs_info, nodata_val)
+    n_bytes = write_raster(dem_path, grid_z, new_profile, output_profile)
     
-    # 6. Handle any NaN cells (if 'linear' or 'cubic' can't interpolate at edges)
-    #    Simple approach: set them to a special nodata value, e.g., -9999
-    nodata_val = -9999
+    print(f"DEM saved to: {dem_path} ({n_bytes} bytes)")
+
+def dem_raster(grid_z, min_x, min_y, resolution, crs_info=None, nodata_val=-9999):
+    """
+    The array and rasterio profile write_dem writes a gridded surface with.
+    NaN cells of grid_z are set to nodata_val in place.
+    """
+    # Handle any NaN cells (if 'linear' or 'cubic' can't interpolate at edges)
+    # Simple approach: set them to a special nodata value, e.g., -9999
     nan_mask = np.isnan(grid_z)
     grid_z[nan_mask] = nodata_val
 
-    # 7. Prepare the raster metadata for rasterio
-    #    Transform assumes top-left corner is (min_x, max_y)
-    #    with pixel sizes (resolution, resolution).
-    #    But note that in many GIS conventions, 'y' decreases as we go down rows,
-    #    so we pass a negative for pixel height if we want a north-up raster.
+    # Prepare the raster metadata for rasterio
+    # Transform assumes top-left corner is (min_x, max_y)
+    # with pixel sizes (resolution, resolution).
+    # But note that in many GIS conventions, 'y' decreases as we go down rows,
+    # so we pass a negative for pixel height if we want a north-up raster.
     transform = from_origin(min_x, min_y, resolution, -resolution)
 
-    # We'll assume a single-band float32 raster.
-    # If you know your CRS, you can parse it from the LAS header or specify directly
-    # E.g., if las.header.parse_crs() works in your laspy version:
-    try:
-        crs_info = las.header.parse_crs()
-    except:
-        crs_info = None  # or set it to a known EPSG like "EPSG:32611"
-
     new_profile = {
         "driver": "GTiff",
         "height": grid_z.shape[0],
@@ -337,10 +1279,286 @@ def pointcloud2dem(
         "crs": crs_info  # or a known string like "EPSG:xxxxx"
     }
 
-    with rasterio.open(dem_path, "w", **new_profile) as dst:
-        dst.write(grid_z, 1)
+    return grid_z, new_profile
+
+def parse_las_crs(header):
+    """Parse the CRS from a LAS header, or None if it has none."""
+    # If you know your CRS, you can parse it from the LAS header or specify directly
+    # E.g., if las.header.parse_crs() works in your laspy version:
+    try:
+        return header.parse_crs()
+    except:
+        return None  # or set it to a known EPSG like "EPSG:32611"
+
+def _keep_mask(points, classification_filter, reducer):
+    """
+    Mask of the points a surface is gridded from, or None to keep them all.
+    `points` is a laspy LasData or chunk.
+    """
+    keep_mask = None
+
+    # If the LAS has classification data and we only want certain classes:
+    if classification_filter is not None and hasattr(points, "classification"):
+        keep_mask = np.isin(points.classification, classification_filter)
+
+    # The last_return reducer only bins the last return of each pulse
+    if reducer == 'last_return':
+        last_mask = np.asarray(points.return_number) == np.asarray(points.number_of_returns)
+        keep_mask = last_mask if keep_mask is None else keep_mask & last_mask
+
+    return keep_mask
+
+def footprint_mask(min_x, min_y, n_rows, n_cols, resolution, polygon=None, buffer=0.0):
+    """Grid nodes within buffer of a polygon, or None without a polygon."""
+    if polygon is None:
+        return None
+    grid_x, grid_y = np.meshgrid(min_x + np.arange(n_cols) * resolution, min_y + np.arange(n_rows) * resolution)
+    return region_mask(grid_x.ravel(), grid_y.ravel(), polygon=polygon, buffer=buffer).reshape(n_rows, n_cols)
+
+def grid_points(x, y, z, resolution=1.0, method='linear', reducer=None, polygon=None, buffer=0.0):
+    """
+    Grid points over their own bounding box.
+
+    Parameters
+    ----------
+    x, y, z : 1D np.ndarray
+        Point coordinates.
+    resolution, method, reducer
+        See pointcloud2dem.
+    polygon, buffer : optional
+        If given, only the grid nodes within buffer of the polygon are
+        interpolated, the others are NaN. Sampling the triangulation far
+        outside the convex hull of the points is slow.
+
+    Returns
+    -------
+    grid_z : 2D np.ndarray
+        Gridded elevations, row 0 at min_y, NaN where nothing could be interpolated.
+    min_x, min_y : float
+        Coordinates of grid node (0, 0).
+    """
+    # 1. Determine the bounding box
+    min_x, max_x = np.min(x), np.max(x)
+    min_y, max_y = np.min(y), np.max(y)
+
+    if reducer is None:
+        # 2. Create a grid of desired resolution
+        #    We'll define a 2D array that spans [min_x, max_x] and [min_y, max_y]
+        grid_x, grid_y = np.meshgrid(
+            np.arange(min_x, max_x, resolution),
+            np.arange(min_y, max_y, resolution)
+        )
+
+        # 3. Interpolate z-values onto the grid
+        #    Using griddata with the chosen method (e.g., 'linear' or 'nearest')
+        points = np.column_stack((x, y))
+        mask = footprint_mask(min_x, min_y, grid_x.shape[0], grid_x.shape[1], resolution, polygon, buffer)
+        with span('triangulate', points=len(x), cells=grid_x.size, method=method):
+            if mask is None:
+                grid_z = griddata(points, z, (grid_x, grid_y), method=method)
+            else:
+                grid_z = np.full(grid_x.shape, np.nan)
+                grid_z[mask] = griddata(points, z, (grid_x[mask], grid_y[mask]), method=method)
+    else:
+        # 2-3. Bin points into the same grid nodes, then fill the empty cells
+        n_cols = len(np.arange(min_x, max_x, resolution))
+        n_rows = len(np.arange(min_y, max_y, resolution))
+        with span('bin_points', points=len(x), cells=n_rows * n_cols, reducer=reducer):
+            grid_z = bin_points(x, y, z, min_x, min_y, n_rows, n_cols, resolution, reducer)
+        mask = footprint_mask(min_x, min_y, n_rows, n_cols, resolution, polygon, buffer)
+        with span('fill_empty_cells', cells=grid_z.size, method=method):
+            grid_z = fill_empty_cells(grid_z, method=method, mask=mask)
+
+    return grid_z, min_x, min_y
+
+def pointcloud2products_streaming(
+    las_path,
+    products,
+    resolution=1.0,
+    method='linear',
+    reducer='mean',
+    chunk_size=5_000_000,
+    output_profile=None,
+    bounds=None,
+    polygon=None,
+    buffer=0.0
+):
+    """
+    Grid several surfaces from one LAS/LAZ file by streaming it in chunks into
+    one RasterAccumulator per product. Peak memory is bounded by chunk_size and
+    the grids, not by the size of the file.
+
+    All products share the grid spanned by the bounding box stored in the LAS
+    header rather than the bounding box of their filtered points, so a
+    class-filtered DEM may carry a wider nodata border than the in-memory path.
+    With an area of interest, the grid spans its bounding box within the header's.
+
+    Parameters
+    ----------
+    las_path, products, resolution, method, output_profile, bounds, polygon, buffer
+        See pointcloud2products.
+    reducer : {'min', 'mean', 'max', 'median', 'last_return'}, optional
+        See RasterAccumulator. Default is 'mean'.
+    chunk_size : int, optional
+        Number of points read per chunk. Default is 5,000,000.
+    """
+    start_time = time.perf_counter()
+    n_read = 0
+    with span('stream_las', path=las_path) as attrs, laspy.open(las_path) as reader:
+        header = reader.header
+        min_x, min_y = header.mins[0], header.mins[1]
+        max_x, max_y = header.maxs[0], header.maxs[1]
+        if bounds is None and polygon is None:
+            chunks = reader.chunk_iterator(chunk_size)
+        else:
+            region = region_bounds(bounds, polygon, buffer)
+            min_x, min_y = max(min_x, region[0]), max(min_y, region[1])
+            max_x, max_y = min(max_x, region[2]), min(max_y, region[3])
+            chunks = iter_region(las_path, bounds, polygon, chunk_size, buffer=buffer)
+        n_cols = len(np.arange(min_x, max_x, resolution))
+        n_rows = len(np.arange(min_y, max_y, resolution))
+        accumulators = {
+            dem_path: RasterAccumulator(min_x, min_y, n_rows, n_cols, resolution, reducer)
+            for dem_path in products
+        }
+
+        for chunk in chunks:
+            n_read += len(chunk)
+            x, y, z = chunk.x, chunk.y, chunk.z
+            for dem_path, classification_filter in products.items():
+                keep_mask = _keep_mask(chunk, classification_filter, reducer)
+                if keep_mask is None:
+                    accumulators[dem_path].add(x, y, z)
+                else:
+                    accumulators[dem_path].add(x[keep_mask], y[keep_mask], z[keep_mask])
+
+        crs_info = parse_las_crs(header)
+        attrs['points'] = n_read
+
+    mask = footprint_mask(min_x, min_y, n_rows, n_cols, resolution, polygon, buffer)
+    for dem_path, accumulator in accumulators.items():
+        with span('fill_empty_cells', cells=accumulator.counts.size, method=method):
+            grid_z = fill_empty_cells(accumulator.result(), method=method, mask=mask)
+        write_dem(dem_path, grid_z, min_x, min_y, resolution, crs_info, output_profile=output_profile)
+    report_throughput(n_read, start_time, label='Streamed')
+
+def pointcloud2products(
+    las_path,
+    products,
+    resolution=1.0,
+    method='linear',
+    reducer=None,
+    chunk_size=None,
+    output_profile=None,
+    bounds=None,
+    polygon=None,
+    buffer=0.0
+):
+    """
+    Grid several surfaces (e.g., ground DEM and all-points DSM) from a single
+    read of a LAS/LAZ file. The coordinates are parsed once and every product
+    is gridded from masks over the shared arrays.
+
+    Parameters
+    ----------
+    las_path : str
+        Path to the input LAS/LAZ file.
+    products : dict
+        Maps each output GeoTIFF path to its list of classification codes to keep,
+        or None to use all points.
+        Example: {'dem.tif': [2], 'dsm.tif': None}.
+    resolution, method, reducer, chunk_size, output_profile, bounds, polygon, buffer
+        See pointcloud2dem.
+    """
+    if chunk_size is not None:
+        pointcloud2products_streaming(
+            las_path, products, resolution=resolution, method=method,
+            reducer=reducer or 'mean', chunk_size=chunk_size, output_profile=output_profile,
+            bounds=bounds, polygon=polygon, buffer=buffer
+        )
+        return
+
+    # 1. Read the LAS file, or only its area of interest
+    with span('read_las', path=las_path) as attrs:
+        if bounds is None and polygon is None:
+            las = laspy.read(las_path)
+        else:
+            las = read_region(las_path, bounds, polygon, buffer=buffer)
+        attrs['points'] = len(las.points)
+    
+    # 2. Extract coordinates once
+    #    Note: las.x, las.y, las.z are NumPy arrays (scaled by header offsets/scales)
+    x = np.asarray(las.x)
+    y = np.asarray(las.y)
+    z = np.asarray(las.z)
+    crs_info = parse_las_crs(las.header)
+
+    # 3. Grid and write every product from the shared arrays
+    for dem_path, classification_filter in products.items():
+        with span('filter_points', product=dem_path):
+            keep_mask = _keep_mask(las, classification_filter, reducer)
+        if keep_mask is None:
+            grid_z, min_x, min_y = grid_points(x, y, z, resolution, method, reducer, polygon, buffer)
+        else:
+            grid_z, min_x, min_y = grid_points(
+                x[keep_mask], y[keep_mask], z[keep_mask], resolution, method, reducer, polygon, buffer
+            )
+        write_dem(dem_path, grid_z, min_x, min_y, resolution, crs_info, output_profile=output_profile)
+
+def pointcloud2dem(
+    las_path,
+    dem_path,
+    resolution=1.0,
+    method='linear',
+    classification_filter=None,
+    reducer=None,
+    chunk_size=None,
+    output_profile=None,
+    bounds=None,
+    polygon=None,
+    buffer=0.0
+):
+    """
+    Convert a LAS/LAZ point cloud into a DEM (GeoTIFF) by gridding the z-values.
     
-    print(f"DEM saved to: {dem_path}")
+    Parameters
+    ----------
+    las_path : str
+        Path to the input LAS/LAZ file.
+    dem_path : str
+        Path to the output GeoTIFF DEM.
+    resolution : float, optional
+        The desired output cell size (in the same horizontal units as the LAS).
+        Default is 1.0 (e.g., 1 meter).
+    method : {'linear', 'nearest', 'cubic'}, optional
+        Interpolation method passed to scipy.interpolate.griddata.
+    classification_filter : list of int, optional
+        List of classification codes to keep. If None, use all points.
+        Example: [2] to keep only ground points. 
+    reducer : {'min', 'mean', 'max', 'median', 'last_return'}, optional
+        If None (default), all points are triangulated with griddata.
+        Otherwise points are binned into cells with this reducer (see bin_points)
+        and `method` is only used to fill the cells that received no point.
+    chunk_size : int, optional
+        If given, stream the file in chunks of this many points
+        (see pointcloud2products_streaming). Uses reducer 'mean' if reducer is None.
+    output_profile : {'cog', 'cog-zstd'}, optional
+        Compact layout of the DEM: float32, compressed, tiled, with overviews
+        (see OUTPUT_PROFILES). If None, an uncompressed float64 GeoTIFF is written.
+    bounds : tuple of float, optional
+        (min_x, min_y, max_x, max_y) of the area of interest. With bounds or a
+        polygon, only the points inside are read, through the spatial index of
+        the LAS file, which is built on first use (see spatial_index.SpatialIndex).
+    polygon : array_like, optional
+        (n, 2) vertices of the area of interest, e.g., a basin footprint.
+    buffer : float, optional
+        Width by which the area of interest is widened. Default is 0.
+    """
+    pointcloud2products(
+        las_path, {dem_path: classification_filter}, resolution=resolution,
+        method=method, reducer=reducer, chunk_size=chunk_size, output_profile=output_profile,
+        bounds=bounds, polygon=polygon, buffer=buffer
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,223 @@
+import argparse
+import os
+import signal
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from natsort import natsorted
+
+from cache import ContentCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES
+from capacity_estimation import FOOTPRINT_FILE, outdated_folders, record_outcome, _timed_process_folder
+from ground_filter import survey_las_files
+from results_store import ResultsStore
+from utils import OUTPUT_PROFILES
+
+# Seconds between polls, and how long a folder must stay unchanged before it is processed
+POLL_INTERVAL = 2.0
+SETTLE_TIME = 10.0
+
+def folder_signature(folder_path):
+    """
+    (name, size, mtime) of the input files of a survey folder: its LAS files,
+    height_references.csv and footprint.csv, and dem.tif/dsm.tif when there is
+    no LAS to grid them from. The files the pipeline writes, including the
+    classified <name>.ground.las, are left out, so processing a folder does
+    not change its signature.
+    """
+    entries = dict()
+    for entry in os.scandir(folder_path):
+        if entry.is_file():
+            entries[entry.name] = entry.stat()
+    las_files = survey_las_files(entries)
+    names = las_files + [
+        name for name in entries
+        if name in ('height_references.csv', FOOTPRINT_FILE)
+        or (len(las_files) == 0 and name in ('dem.tif', 'dsm.tif'))
+    ]
+    return tuple((name, entries[name].st_size, entries[name].st_mtime_ns) for name in sorted(names))
+
+def survey_folders():
+    return natsorted(entry.name for entry in os.scandir('data') if entry.is_dir())
+
+class FolderWatcher:
+    """
+    Polls the survey folders under data/ and reports those whose inputs
+    changed since they were last processed, once the inputs stayed unchanged
+    for `settle` seconds, e.g., until a copy finished.
+
+    A poll lists data/ and each folder, and stats nothing but directory
+    entries, so it stays cheap with hundreds of folders.
+    """
+
+    def __init__(self, processed_folders=(), settle=SETTLE_TIME):
+        self.settle = settle
+        # signature of each folder when first seen unchanged, and when processed
+        self.seen = dict()
+        self.processed = dict()
+        for folder in processed_folders:
+            folder_path = os.path.join('data', folder)
+            if os.path.isdir(folder_path):
+                self.processed[folder] = folder_signature(folder_path)
+
+    def poll(self):
+        """Folders that are ready to process, as {folder: signature}."""
+        now = time.monotonic()
+        ready = dict()
+        for folder in survey_folders():
+            try:
+                signature = folder_signature(os.path.join('data', folder))
+            except FileNotFoundError:
+                # removed while polling
+                continue
+            if len(signature) == 0:
+                continue
+            if folder not in self.seen or self.seen[folder][0] != signature:
+                self.seen[folder] = (signature, now)
+            if signature != self.processed.get(folder) and now - self.seen[folder][1] >= self.settle:
+                ready[folder] = signature
+        return ready
+
+    def mark_processed(self, folder):
+        """
+        Record the signature of a folder after it was processed, so that the
+        files processing creates, e.g., a height_references.csv template or a
+        LAS classified in place, do not queue it again.
+        """
+        try:
+            self.processed[folder] = folder_signature(os.path.join('data', folder))
+        except FileNotFoundError:
+            # removed while processing
+            self.processed.pop(folder, None)
+
+def update_reports(workers=1):
+    """
+    Rewrite data/results.csv and the capacity figures from the results store.
+    Only the basin panels whose data changed are rendered (see capacity_plots.plot_panels).
+    """
+    import capacity_plots
+    try:
+        data = capacity_plots.read_capacity_estimation_data()
+        max_capacity_data = capacity_plots.read_capacity_design_data(data)
+        capacity_plots.plot_panels(data, max_capacity_data, workers=workers)
+        capacity_plots.save_results(data, max_capacity_data)
+        print("Results saved to: data/results.csv")
+    except Exception as e:
+        # keep watching; the next update retries
+        print(f"Report update failed: {type(e).__name__}: {e}")
+
+def _ignore_interrupt():
+    # Ctrl-C stops the watcher, which shuts the workers down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def watch(workers=2, cache=None, output_profile=None, interval=POLL_INTERVAL, settle=SETTLE_TIME, rescan=False, once=False, classify_ground=False):
+    """
+    Process new and changed survey folders under data/ as they land, and keep
+    capacity.csv, results.csv and the figures up to date.
+
+    Folders are processed in a pool of `workers` processes, with at most one
+    folder per worker in flight; the others wait in order. Each finished
+    folder is upserted into the results store, then capacity.csv and the
+    reports are refreshed, once per batch of folders that finish together.
+
+    Parameters
+    ----------
+    workers : int, optional
+        Number of folders processed in parallel. Default is 2.
+    cache : cache.ContentCache, optional
+        With a cache, a folder whose LAS changed is regridded and unchanged
+        inputs are served from the cache (see capacity_estimation.process_folder).
+    output_profile : {'cog', 'cog-zstd'}, optional
+        Compact layout of the rasters written (see utils.OUTPUT_PROFILES).
+    interval : float, optional
+        Seconds between polls. Default is 2.
+    settle : float, optional
+        Seconds a folder's inputs must stay unchanged before it is processed. Default is 10.
+    rescan : bool, optional
+        If True, process every folder at start-up, not only those missing
+        from the results store or computed with another volume method.
+    once : bool, optional
+        If True, process the folders that are ready now and return.
+    classify_ground : bool, optional
+        If True, classify the ground points of the LAS files that land without
+        any (see capacity_estimation.process_folder).
+    """
+    store = ResultsStore()
+    processed_data = store.capacities()
+    outdated = outdated_folders(store)
+    up_to_date = [folder for folder in processed_data if folder not in outdated]
+    watcher = FolderWatcher(() if rescan else up_to_date, 0 if once else settle)
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_ignore_interrupt)
+    pending = deque()
+    in_flight = dict()
+    print(f"Watching data/ every {interval:g} s with {workers} workers, Ctrl-C to stop")
+    try:
+        while True:
+            # 1. Queue the folders that are ready, once each
+            ready = watcher.poll()
+            queued = set(pending) | set(folder for folder, _ in in_flight.values())
+            for folder in ready:
+                if folder not in queued:
+                    pending.append(folder)
+                    print(f"Queued folder: {folder}")
+
+            # 2. Keep every worker busy with one folder
+            while len(pending) > 0 and len(in_flight) < workers:
+                folder = pending.popleft()
+                future = executor.submit(_timed_process_folder, folder, cache, output_profile, classify_ground=classify_ground)
+                in_flight[future] = (folder, time.monotonic())
+
+            if once and len(in_flight) == 0:
+                break
+
+            # 3. Wait for a folder to finish, at most until the next poll
+            if len(in_flight) == 0:
+                time.sleep(interval)
+                continue
+            finished, _ = wait(in_flight, timeout=interval, return_when=FIRST_COMPLETED)
+            n_written = 0
+            for future in finished:
+                folder, start_time = in_flight.pop(future)
+                result, error, wall_time, n_bytes, _ = future.result()
+                status = record_outcome(store, folder, result, error, wall_time, n_bytes, processed_data.get(folder))
+                watcher.mark_processed(folder)
+                if status in ('done', 'updated'):
+                    processed_data[folder] = store.get(folder)
+                    n_written += 1
+                print(f"Processed folder: {folder} {status} in {time.monotonic() - start_time:.1f} s")
+
+            # 4. Refresh the outputs once per batch
+            if n_written > 0:
+                store.export_csv()
+                update_reports()
+    except KeyboardInterrupt:
+        print("Stopping")
+    finally:
+        executor.shutdown(cancel_futures=True)
+        store.close()
+
+def add_arguments(parser):
+    """Options of the watch mode, shared with the `watch` command of cli.py."""
+    parser.add_argument('--workers', type=int, default=2, help="number of folders processed in parallel")
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL, help="seconds between polls of data/")
+    parser.add_argument('--settle', type=float, default=SETTLE_TIME, help="seconds a folder must stay unchanged before it is processed")
+    parser.add_argument('--rescan', action='store_true', help="process every folder at start-up, not only new ones")
+    parser.add_argument('--once', action='store_true', help="process the folders that are ready now and exit")
+    parser.add_argument('--classify-ground', action='store_true', help="classify the ground points of LAS files that have none into <name>.ground.las, and grid from it")
+    parser.add_argument('--no-cache', action='store_true', help="do not reuse intermediate rasters; changed LAS files are then not regridded")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help="directory of the cache")
+    parser.add_argument('--cache-size', type=float, default=DEFAULT_MAX_BYTES / 1024 ** 3, help="cache size cap in GB")
+    parser.add_argument('--output-profile', choices=sorted(OUTPUT_PROFILES), default=None, help="write float32, compressed, tiled rasters with overviews (COG)")
+
+def main(args):
+    cache = None if args.no_cache else ContentCache(args.cache_dir, int(args.cache_size * 1024 ** 3))
+    watch(
+        workers=args.workers, cache=cache, output_profile=args.output_profile,
+        interval=args.interval, settle=args.settle, rescan=args.rescan, once=args.once,
+        classify_ground=args.classify_ground
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process survey folders under data/ as they land and keep the results up to date.")
+    add_arguments(parser)
+    main(parser.parse_args())